@@ -42,6 +42,138 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 DATA_PATH = os.path.join(BASE_DIR, 'media', 'rag_database')
 CHROMA_PATH = os.path.join(BASE_DIR, 'rag', 'chroma')
+# Public URL the uploaded files are served from, used in the sources of the chunks
+RAG_MEDIA_URL = os.getenv('RAG_MEDIA_URL', 'http://127.0.0.1:8000' + MEDIA_URL + 'rag_database/')
+# Where the chunks are stored and searched, see rag/vectordb/backends.py
+RAG_RETRIEVAL = {
+    # "chroma", "quantized" or "flat" (exact search over a memory-mapped matrix, up to a few hundred thousand chunks),
+    # or "remote" to go through the retrieval service (manage.py run_retrieval_service)
+    'BACKEND': os.getenv('RAG_RETRIEVAL_BACKEND', 'chroma'),
+    # HNSW graph of the Chroma collection, M and EF_CONSTRUCTION only apply to new collections
+    'HNSW_M': 16,
+    'HNSW_EF_CONSTRUCTION': 100,
+    'HNSW_EF_SEARCH': 10,
+    # In-process quantized backend: "float16", "int8" or "pq" (product quantization)
+    'QUANTIZATION': os.getenv('RAG_QUANTIZATION', 'int8'),
+    'PQ_SUBSPACES': 96,
+    'PQ_CENTROIDS': 256,
+    # Retrieval service: Unix socket, store it serves and largest number of texts embedded in one pass
+    'SERVICE_SOCKET': os.getenv('RAG_SERVICE_SOCKET', os.path.join(BASE_DIR, 'retrieval.sock')),
+    'SERVICE_BACKEND': os.getenv('RAG_SERVICE_BACKEND', 'chroma'),
+    'SERVICE_TIMEOUT': 60,  # Seconds a client waits for an answer
+    'SERVICE_MAX_BATCH': 64,
+}
+# Runtime of the embedding model: "torch" (sentence-transformers) or "onnx" (onnxruntime, export the model
+# first with `manage.py export_onnx_embeddings`), QUANTIZED runs the dynamic int8 export of the model
+EMBEDDING = {
+    'BACKEND': os.getenv('RAG_EMBEDDING_BACKEND', 'torch'),
+    'ONNX_PATH': os.getenv('RAG_ONNX_PATH', os.path.join(BASE_DIR, 'models', 'onnx')),
+    'QUANTIZED': os.getenv('RAG_ONNX_QUANTIZED', 'true').lower() == 'true',
+}
+# CPU threads of the embedding model, see rag/thread_budget.py. The cores are divided between the WORKERS
+# processes, in each one QUERY threads answer the queries and INGESTION threads embed the uploads.
+# None takes half of the share of the process for the queries (at most QUERY_MAX) and the rest for ingestion.
+# INGESTION only applies to onnxruntime, torch has one count per process and uses QUERY for both
+EMBEDDING_THREADS = {
+    'WORKERS': int(os.getenv('GUNICORN_WORKERS', 1)),
+    'QUERY': int(os.getenv('RAG_QUERY_THREADS', 0)) or None,
+    'INGESTION': int(os.getenv('RAG_INGESTION_THREADS', 0)) or None,
+    'QUERY_MAX': 4,
+}
+# Questions embedded at the same time by concurrent requests are encoded together, up to MAX_BATCH
+# texts. A lone question is encoded at once, others queued with it wait at most MAX_WAIT_MS for more
+# to join (see EmbeddingScheduler)
+EMBEDDING_BATCHING = {
+    'ENABLED': True,
+    'MAX_WAIT_MS': 5,
+    'MAX_BATCH': 32,
+}
+# How the pages are cut into chunks, see rag/vectordb/chunking.py: "tokens" packs whole sentences into chunks
+# of at most CHUNK_TOKENS tokens of the embedding model, "characters" is RecursiveCharacterTextSplitter with
+# 500 characters. The two give different chunks, set RAG_CHUNKER=tokens then run `manage.py rebuild_indexes`,
+# which replaces every file's chunks and locations in a new index version
+CHUNKING = {
+    'SPLITTER': os.getenv('RAG_CHUNKER', 'characters'),
+    'CHUNK_TOKENS': 128,
+    'OVERLAP_TOKENS': 16,
+}
+# With RAG_CONTEXT_COMPRESSION=true, only the sentences of the retrieved chunks closest to the question are
+# put in the prompt, at most TOKEN_BUDGET tokens of them (see rag/context_compression.py). The tokens are
+# those of the embedding model, not of the LLM. CACHE_SIZE sentence vectors are kept per process
+CONTEXT_COMPRESSION = {
+    'ENABLED': os.getenv('RAG_CONTEXT_COMPRESSION', 'false').lower() == 'true',
+    'TOKEN_BUDGET': 320,
+    'CACHE_SIZE': 4096,
+}
+# /query/batch/: largest accepted batch and number of LLM calls in flight for one batch
+RAG_QUERY_BATCH = {
+    'MAX_QUERIES': 500,
+    'LLM_CONCURRENCY': 4,
+}
+# LLM calls, see rag/llm_gateway.py
+LLM_GATEWAY = {
+    'MAX_IN_FLIGHT': 8,  # Concurrent calls per process
+    'TIMEOUT': 60,  # Seconds for a call including its retries
+    'RETRIES': 2,
+    'BACKOFF_BASE': 0.5,  # Seconds, doubled on every retry and jittered
+    'BACKOFF_MAX': 8,
+}
+# Follow-up questions are also rewritten into standalone questions for the retrieval,
+# the rewrite is only used when it is ready within BUDGET_MS (see get_history_aware_context).
+# An extra LLM call per follow-up, off by default
+HISTORY_AWARE_RETRIEVAL = {
+    'ENABLED': os.getenv('RAG_HISTORY_AWARE', 'false').lower() == 'true',
+    'BUDGET_MS': 1500,
+    # Concurrent rewrites per process, on top of LLM_GATEWAY['MAX_IN_FLIGHT']: an abandoned
+    # rewrite keeps its slot until the model answers, it must not take one from the answers
+    'MAX_IN_FLIGHT': 2,
+}
+# Model answering the queries, see rag/llm_backends.py
+LLM_BACKEND = {
+    'NAME': os.getenv('LLM_BACKEND', 'huggingface'),  # "huggingface" or "llamacpp" (local CPU model)
+    'TEMPERATURE': 0.5,
+    'WARM_UP': True,  # Load the model and cache the fixed start of the prompt before the first query
+    # Only used by "llamacpp"
+    'MODEL_PATH': os.getenv('LLM_MODEL_PATH', os.path.join(BASE_DIR, 'models', 'qwen2.5-1.5b-instruct-q4_k_m.gguf')),
+    'N_CTX': 4096,
+    'N_THREADS': int(os.getenv('LLM_THREADS', 0)) or None,  # Generation threads, defaults to the physical cores
+    'N_THREADS_BATCH': None,  # Prompt processing threads, defaults to all cores
+    'MAX_TOKENS': 256,
+}
+# Models loaded by the gunicorn master before it forks the workers (gunicorn.conf.py), the workers
+# share their memory instead of loading one copy each
+PREFORK = {
+    'EMBEDDING_MODEL': True,
+    # Only when LLM_BACKEND is "llamacpp". Loaded by every worker once forked, llama.cpp is not fork-safe
+    'LOCAL_LLM': True,
+}
+# Dedicated inference endpoint instead of the hosted model, e.g. the local stub of `manage.py run_llm_stub`
+LLM_ENDPOINT_URL = os.getenv('LLM_ENDPOINT_URL')
+
+ELASTICSEARCH_URL = os.getenv('ELASTICSEARCH_URL', 'http://localhost:9200')
+
+# Bearer token of the Prometheus scraper for /metrics, admins can also use their JWT
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+# One JSON line per request on "rag.requests", with the time spent in every stage.
+# Set RAG_LOG_LEVEL=DEBUG to also log every stage as it ends, and the prompts.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'rag.tracing.JsonFormatter'},
+        'plain': {'format': '%(asctime)s %(levelname)s %(name)s: %(message)s'},
+    },
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler', 'formatter': 'plain'},
+        'json': {'class': 'logging.StreamHandler', 'formatter': 'json'},
+    },
+    'loggers': {
+        'rag': {'handlers': ['console'], 'level': os.getenv('RAG_LOG_LEVEL', 'INFO'), 'propagate': False},
+        'matching': {'handlers': ['console'], 'level': os.getenv('RAG_LOG_LEVEL', 'INFO'), 'propagate': False},
+        'rag.requests': {'handlers': ['json'], 'level': 'INFO', 'propagate': False},
+    },
+}
 # Add the parent directory to PYTHONPATH
 sys.path.append(os.path.join(BASE_DIR, 'matching'))
 
@@ -80,10 +212,11 @@ SIMPLE_JWT = {
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'rag.authentication.TimedJWTAuthentication',
     ),
 }
 MIDDLEWARE = [
+    'rag.middleware.TracingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'rag.middleware.MediaCorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
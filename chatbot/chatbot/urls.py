@@ -19,9 +19,12 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.urls import path, include
 
+from rag.views.metrics import metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('chatbot/', include('rag.urls')),
+    path('metrics', metrics, name='metrics'),
 ]
 
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -0,0 +1,58 @@
+"""
+gunicorn settings, picked up when gunicorn is started from this directory:
+
+    gunicorn chatbot.wsgi
+
+The app and the embedding model are loaded once in the master and the workers are forked from
+it, so they share its memory. The local LLM is loaded by every worker (see rag/prefork.py).
+Every worker logs its memory when it starts and every MEMORY_LOG_INTERVAL requests, /metrics
+reports it too.
+"""
+import gc
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", 2))
+# The LLM calls are slow and wait on the network, threads keep a worker busy meanwhile
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 4))
+timeout = 120
+preload_app = True
+
+MEMORY_LOG_INTERVAL = 1000
+
+# Objects allocated in the master are frozen by gc.freeze() before the workers are forked, the
+# collections of the workers then never write to them (which would copy the pages holding them).
+# Collecting in the master until then would only leave holes in those pages.
+gc.disable()
+
+
+def when_ready(server):
+    # Runs in the master after the app was loaded (preload_app), before the first fork
+    from rag import thread_budget
+    from rag.prefork import warm_up
+
+    # The cores are shared by the workers actually started (-w overrides GUNICORN_WORKERS)
+    thread_budget.configure(workers=server.cfg.workers)
+    warm_up()
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    gc.enable()
+    from rag.prefork import worker_started
+
+    worker_started()
+
+
+def post_worker_init(worker):
+    from rag.prefork import log_memory
+
+    log_memory("Worker ready")
+
+
+def post_request(worker, req, environ, resp):
+    if worker.nr % MEMORY_LOG_INTERVAL == 0:
+        from rag.prefork import log_memory
+
+        log_memory(f"Worker served {worker.nr} requests")
@@ -2,8 +2,15 @@ from elasticsearch_dsl import Document, Text, Integer, connections
 from elasticsearch_dsl.analysis import analyzer, tokenizer
 from django.conf import settings
 import os
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, helpers
+import logging
+import threading
 import time
+from datetime import datetime
+
+from rag.tracing import stage
+
+logger = logging.getLogger(__name__)
 
 #TODO:
 # 1. By default, searches return only the top 10 matching hits. 
@@ -12,12 +19,12 @@ import time
 # (https://www.one-tab.com/page/P9mPf495Squ9ngKmZdbYKg)
 
 
-def get_elasticsearch_client():
+def create_elasticsearch_client():
     """Get Elasticsearch client with retries"""
     for _ in range(3):  # Try 3 times
         try:
             client = Elasticsearch(
-                hosts=['http://localhost:9200'],
+                hosts=[settings.ELASTICSEARCH_URL],
                 verify_certs=False,
                 ssl_show_warn=False,
                 retry_on_timeout=True,
@@ -27,20 +34,50 @@ def get_elasticsearch_client():
             if client.ping():  # Test the connection
                 return client
         except Exception as e:
-            print(f"Connection attempt failed: {e}")
+            logger.warning("Connection attempt failed: %s", e)
             time.sleep(1)  # Wait before retrying
     return None
 
-# Initialize the connection
-es_client = get_elasticsearch_client()
-if es_client:
-    connections.create_connection(
-        hosts=['http://localhost:9200'],
-        verify_certs=False,
-        ssl_show_warn=False
-    )
-else:
-    print("Failed to establish Elasticsearch connection")
+# Created on first use rather than at import, so loading the views (or running a management
+# command) never waits for Elasticsearch
+es_client = None
+_client_lock = threading.Lock()
+
+def get_elasticsearch_client():
+    """The client shared by the process, connected on the first call"""
+    if es_client is None:
+        with _client_lock:
+            if es_client is None:
+                connect()
+    return es_client
+
+def reset():
+    """Drops the client, the next call connects again (e.g. after ELASTICSEARCH_URL changed)"""
+    global es_client
+    with _client_lock:
+        es_client = None
+
+def connect():
+    """(Re)creates the client and the default connection used by the documents, e.g. after ELASTICSEARCH_URL changed"""
+    global es_client
+    es_client = create_elasticsearch_client()
+    if es_client:
+        connections.create_connection(
+            hosts=[settings.ELASTICSEARCH_URL],
+            verify_certs=False,
+            ssl_show_warn=False
+        )
+    else:
+        logger.error("Failed to establish Elasticsearch connection")
+    return es_client
+
+# The pages live in versioned indexes ("pdf_documents-v<timestamp>"). Searches go through the
+# read alias and indexing through the write alias, so a rebuild loads a new version while the
+# live one keeps answering, then both aliases are moved to it in one atomic request. The index
+# created before the aliases ("pdf_documents") becomes their first version.
+INDEX_PREFIX = 'pdf_documents'
+READ_ALIAS = 'pdf_documents_read'
+WRITE_ALIAS = 'pdf_documents_write'
 
 # Custom analyzer for better text search
 pdf_analyzer = analyzer('pdf_analyzer',
@@ -55,31 +92,118 @@ class PDFDocument(Document):
     content = Text(analyzer=pdf_analyzer)
     
     class Index:
-        name = 'pdf_documents'
+        name = READ_ALIAS
         settings = {
             'number_of_shards': 1,
             'number_of_replicas': 0
         }
 
 def setup_elasticsearch():
-    """Initialize Elasticsearch index and mappings"""
+    """Create the first index version and its aliases if they do not exist yet"""
     try:
-        PDFDocument.init()
+        client = get_elasticsearch_client()
+        if not client:
+            logger.error("Failed to get Elasticsearch client")
+            return False
+        if not client.indices.exists_alias(name=READ_ALIAS):
+            if client.indices.exists(index=INDEX_PREFIX):
+                index = INDEX_PREFIX
+            else:
+                index = create_search_index()
+            switch_aliases(index)
         return True
     except Exception as e:
-        print(f"Error setting up Elasticsearch: {e}")
+        logger.exception("Error setting up Elasticsearch: %s", e)
         return False
 
+def search_index_versions():
+    """Index version name -> names of its aliases, oldest version first"""
+    client = get_elasticsearch_client()
+    if not client:
+        raise ConnectionError("Failed to get Elasticsearch client")
+    response = client.indices.get_alias(index=f"{INDEX_PREFIX}*")
+    return {
+        name: set(response[name].get('aliases', {}))
+        for name in sorted(response)
+        if name == INDEX_PREFIX or name.startswith(f"{INDEX_PREFIX}-")
+    }
+
+def live_search_index():
+    for name, aliases in search_index_versions().items():
+        if READ_ALIAS in aliases:
+            return name
+    return None
+
+def create_search_index(version=None, bulk=False):
+    """
+    Create a new index version with the current mappings and analyzers, returns its name.
+    With `bulk`, the version has no replica and is not refreshed until finish_search_index().
+    """
+    name = f"{INDEX_PREFIX}-{version or datetime.now().strftime('v%Y%m%d-%H%M%S-%f')}"
+    index = PDFDocument._index.clone(name)
+    if bulk:
+        index.settings(number_of_replicas=0, refresh_interval='-1')
+    index.create(using=get_elasticsearch_client())
+    return name
+
+def finish_search_index(name):
+    """Restore the replicas and refreshes of a version loaded with bulk=True"""
+    client = get_elasticsearch_client()
+    if not client:
+        raise ConnectionError("Failed to get Elasticsearch client")
+    client.indices.put_settings(index=name, settings={'index': {
+        'number_of_replicas': PDFDocument._index._settings.get('number_of_replicas', 1),
+        'refresh_interval': None,
+    }})
+    client.indices.refresh(index=name)
+
+def switch_aliases(name):
+    """Point the read and write aliases to the version `name`, in one atomic request"""
+    client = get_elasticsearch_client()
+    if not client:
+        raise ConnectionError("Failed to get Elasticsearch client")
+    actions = [
+        {'remove': {'index': index, 'alias': alias}}
+        for index, aliases in search_index_versions().items()
+        for alias in sorted(aliases & {READ_ALIAS, WRITE_ALIAS})
+        if index != name
+    ]
+    actions += [{'add': {'index': name, 'alias': alias}} for alias in (READ_ALIAS, WRITE_ALIAS)]
+    client.indices.update_aliases(actions=actions)
+
+def resumable_search_index():
+    """Name of the most recent version created after the live one and not made live, if any"""
+    versions = list(search_index_versions().items())
+    for name, aliases in reversed(versions):
+        if READ_ALIAS in aliases:
+            return None
+        if not aliases:
+            return name
+    return None
+
+def prune_search_indexes(keep=1):
+    """Delete the versions older than the live one, apart from the `keep` most recent"""
+    versions = search_index_versions()
+    live = next((name for name, aliases in versions.items() if READ_ALIAS in aliases), None)
+    if live is None:
+        return []
+    older = [name for name in versions if name < live and not versions[name]]
+    removed = older[:max(0, len(older) - keep)]
+    client = get_elasticsearch_client()
+    for name in removed:
+        client.indices.delete(index=name)
+    return removed
+
 def file_exists_in_elasticsearch(filename):
     """Check if any document exists with the given filename"""
     try:
         client = get_elasticsearch_client()
         if not client:
-            print("Failed to get Elasticsearch client")
+            logger.error("Failed to get Elasticsearch client")
             return False
 
         response = client.search(
-            index=PDFDocument._index._name,
+            index=READ_ALIAS,
             body={
                 "query": {
                     "term": {
@@ -92,35 +216,87 @@ def file_exists_in_elasticsearch(filename):
         
         return response['hits']['total']['value'] > 0
     except Exception as e:
-        print(f"Error checking file existence in Elasticsearch: {e}")
+        logger.exception("Error checking file existence in Elasticsearch: %s", e)
         return False
 
+def page_document_id(filename, page_num):
+    # One ID per page, indexing a file again replaces its pages instead of duplicating them
+    return f"{filename}:{page_num}"
+
 def index_pdf_content(filename, page_num, content):
     """Index a single page of PDF content"""
     try:
         doc = PDFDocument(
+            meta={'id': page_document_id(filename, page_num)},
             filename=filename,
             page_num=page_num,
             content=content
         )
-        doc.save()
+        doc.save(using=get_elasticsearch_client(), index=WRITE_ALIAS)
         return True
     except Exception as e:
-        print(f"Error indexing document: {e}")
+        logger.exception("Error indexing document: %s", e)
         return False
 
+def bulk_index_pages(pages, index=None, chunk_size=500, replace=True):
+    """
+    Index (filename, page_num, content) tuples with bulk requests. With `replace`, the other
+    pages indexed for these files are removed (pages indexed before the IDs were per page, or
+    pages past the end of a file that got shorter). Returns the number of pages indexed.
+    """
+    client = get_elasticsearch_client()
+    if not client:
+        raise ConnectionError("Failed to get Elasticsearch client")
+    index = index or WRITE_ALIAS
+
+    pages = list(pages)
+    actions = (
+        {
+            "_index": index,
+            "_id": page_document_id(filename, page_num),
+            "_source": {"filename": filename, "page_num": page_num, "content": content},
+        }
+        for filename, page_num, content in pages
+    )
+    indexed, errors = helpers.bulk(client, actions, chunk_size=chunk_size, raise_on_error=False)
+    for error in errors:
+        logger.error("Error bulk indexing a page: %s", error)
+
+    if replace and pages:
+        client.delete_by_query(
+            index=index,
+            body={"query": {"bool": {
+                "filter": [{"terms": {"filename.raw": sorted({filename for filename, _page, _content in pages})}}],
+                "must_not": [{"ids": {"values": [page_document_id(filename, page_num) for filename, page_num, _content in pages]}}],
+            }}},
+            refresh=True,
+        )
+    return indexed
+
+def delete_files_except(filenames, index=None):
+    """Remove the pages of every file that is not in `filenames`, returns the number of pages removed"""
+    client = get_elasticsearch_client()
+    if not client:
+        raise ConnectionError("Failed to get Elasticsearch client")
+    response = client.delete_by_query(
+        index=index or WRITE_ALIAS,
+        body={"query": {"bool": {"must_not": [{"terms": {"filename.raw": sorted(filenames)}}]}}},
+        refresh=True,
+    )
+    return response.get('deleted', 0)
+
 def delete_file_from_elasticsearch(filename):
     """Delete all documents for a given filename from Elasticsearch"""
     try:
         # Get the Elasticsearch client
         client = get_elasticsearch_client()
         if not client:
-            print("Failed to get Elasticsearch client")
+            logger.error("Failed to get Elasticsearch client")
             return False
 
         # Delete by query to remove all documents matching the exact filename
         response = client.delete_by_query(
-            index=PDFDocument._index._name,
+            index=WRITE_ALIAS,
             body={
                 "query": {
                     "term": {
@@ -137,10 +313,10 @@ def delete_file_from_elasticsearch(filename):
             return True
         return False
     except Exception as e:
-        print(f"Error deleting documents from Elasticsearch: {e}")
+        logger.exception("Error deleting documents from Elasticsearch: %s", e)
         return False
 
-def search_content(query_text, request=None, minimum_score=0.25):
+def search_content(query_text, request=None, minimum_score=0.25, file_names=None):
     """Search indexed PDF content with advanced features
     
     Args:
@@ -148,9 +324,10 @@ def search_content(query_text, request=None, minimum_score=0.25):
         request: The HTTP request object
         minimum_score (float): Minimum score threshold (0 to 1). Higher values mean more relevant results.
                              Defaults to 0.25 for moderate filtering.
+        file_names: Only search the pages of these files, all of them when None.
     """
     try:
-        s = PDFDocument.search()
+        s = PDFDocument.search(using=get_elasticsearch_client())
         
         # Set size to a large number to get all results
         s = s.extra(size=10000)  # This will return up to 10,000 results
@@ -180,6 +357,8 @@ def search_content(query_text, request=None, minimum_score=0.25):
                     }
                 }
             ],
+            # Pages of other files are excluded before scoring, a filter is not scored and is cached
+            filter=[{'terms': {'filename.raw': sorted(file_names)}}] if file_names is not None else [],
             minimum_should_match=1  # At least one should clause must match
         )
         
@@ -192,7 +371,8 @@ def search_content(query_text, request=None, minimum_score=0.25):
         )
         
         # Execute search
-        response = s.execute()
+        with stage("es_query"):
+            response = s.execute()
         
         results = []
         if len(response) > 0:
@@ -223,16 +403,18 @@ def search_content(query_text, request=None, minimum_score=0.25):
         results.sort(key=lambda x: x['score'], reverse=True)
         return results
     except Exception as e:
-        print(f"Error searching documents: {e}")
+        logger.exception("Error searching documents: %s", e)
         return []
 
 
 def clear_index():
-    """Clear all indexed documents"""
+    """Clear all indexed documents, searches see the old pages until the empty version replaces them"""
     try:
-        PDFDocument._index.delete()
-        PDFDocument.init()
+        previous = live_search_index()
+        switch_aliases(create_search_index())
+        if previous:
+            get_elasticsearch_client().indices.delete(index=previous)
         return True
     except Exception as e:
-        print(f"Error clearing index: {e}")
+        logger.exception("Error clearing index: %s", e)
         return False 
\ No newline at end of file
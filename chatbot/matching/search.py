@@ -16,14 +16,14 @@ def remove_html_tags(text):
     clean_text = re.sub(r'<.*?>', '', text)
     return clean_text
 
-def perform_search(query_text, request=None):
-    """Main function to perform search using Elasticsearch."""
+def perform_search(query_text, request=None, file_names=None):
+    """Main function to perform search using Elasticsearch, in the pages of `file_names` only when given."""
     try:
         # Clean the query
         query_text = clean_query(query_text)
         
         # Perform the search using Elasticsearch
-        results = search_content(query_text, request)
+        results = search_content(query_text, request, file_names=file_names)
         
         response = {
             "results": results,
@@ -0,0 +1,11 @@
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .tracing import stage
+
+
+class TimedJWTAuthentication(JWTAuthentication):
+    """JWT authentication, timed as the "auth" stage of the request"""
+
+    def authenticate(self, request):
+        with stage("auth"):
+            return super().authenticate(request)
@@ -0,0 +1,141 @@
+"""
+Compression of the retrieved context before it is put in the prompt.
+
+The closest chunks are rarely relevant from start to end, and the prompt length drives the
+latency and the cost of the LLM call. The chunks are cut into sentences (at the boundaries the
+chunker uses), every sentence is scored by the cosine of its embedding with the question, in
+one matrix product, and the best sentences are kept up to CONTEXT_COMPRESSION["TOKEN_BUDGET"]
+tokens. The kept sentences stay in their chunk and in their order, a chunk without any is left
+out of the context and of the sources.
+
+Embeddings already computed are reused: the vector of the question is the one the search used,
+and the vectors of the sentences are kept in an LRU cache, the same chunks come back for many
+questions. The sentences not in the cache are embedded in one call. A chunk of a single sentence
+is embedded like the others rather than scored from its search distance: with a projection (see
+vectordb/projection.py) the index compares reduced vectors, every sentence is scored with the
+full vectors of the model.
+
+The tokens, of the budget and of the figures recorded per request, are counted with the
+tokenizer of the embedding model, the one already loaded. The LLM tokenizes differently (and
+may run on another server), they only approximate the tokens of its prompt.
+
+Off by default, RAG_CONTEXT_COMPRESSION=true turns it on.
+"""
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+from .tracing import CONTEXT_EMBEDDING_TOKENS, record, stage
+from .vectordb.backends import normalize
+from .vectordb.chunking import get_tokenizer, segment_bounds
+from .vectordb.embeddings import EMBEDDING_MODEL_NAME
+
+
+class SentenceVectorCache:
+    """Least recently used embeddings of sentences, keyed by their text"""
+
+    def __init__(self, size):
+        self.size = size
+        self._vectors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, sentences):
+        with self._lock:
+            found = {}
+            for sentence in sentences:
+                vector = self._vectors.get(sentence)
+                if vector is not None:
+                    self._vectors.move_to_end(sentence)
+                    found[sentence] = vector
+            return found
+
+    def put_many(self, sentences, vectors):
+        with self._lock:
+            for sentence, vector in zip(sentences, vectors):
+                self._vectors[sentence] = vector
+                self._vectors.move_to_end(sentence)
+            while len(self._vectors) > self.size:
+                self._vectors.popitem(last=False)
+
+
+sentence_vectors = SentenceVectorCache(settings.CONTEXT_COMPRESSION["CACHE_SIZE"])
+
+
+def count_tokens(texts):
+    """Tokens of each text for the embedding model, about 4 characters a token without its tokenizer"""
+    # Same cache key as the chunker's, a missing tokenizer is only looked for once
+    tokenizer = get_tokenizer(EMBEDDING_MODEL_NAME)
+    if tokenizer is None:
+        return [-(-len(text) // 4) for text in texts]
+    return [len(encoding.ids) for encoding in tokenizer.encode_batch(list(texts), add_special_tokens=False)]
+
+
+def split_sentences(text):
+    return [sentence for sentence in (text[start:end].strip() for start, end in segment_bounds(text)) if sentence]
+
+
+def sentence_scores(chunks, query_embedding, embedding_function):
+    """Cosine of every sentence of `chunks` ((sentences, search score) pairs) with the question"""
+    sentences = [sentence for chunk_sentences, _score in chunks for sentence in chunk_sentences]
+    cached = sentence_vectors.get_many(sentences)
+    missing = list(dict.fromkeys(sentence for sentence in sentences if sentence not in cached))
+    if missing:
+        with stage("sentence_embedding"):
+            vectors = normalize(embedding_function.embed_queries(missing))
+        sentence_vectors.put_many(missing, vectors)
+        cached.update(zip(missing, vectors))
+
+    vectors = np.stack([cached[sentence] for sentence in sentences])
+    return (vectors @ normalize(query_embedding)).tolist()
+
+
+def compress_context(results, query_embedding, embedding_function, token_budget=None):
+    """
+    The `results` ((Document, score) pairs) reduced to their sentences closest to the question,
+    at most `token_budget` tokens of them (the best sentence is always kept). Returns the
+    (Document, score) pairs of the chunks with a sentence kept, their text reduced to it.
+    """
+    token_budget = token_budget or settings.CONTEXT_COMPRESSION["TOKEN_BUDGET"]
+    with stage("context_compression"):
+        chunks = [(split_sentences(doc.page_content), score) for doc, score in results]
+        sentences = [sentence for chunk_sentences, _score in chunks for sentence in chunk_sentences]
+        if not sentences:
+            return results
+        tokens = count_tokens(sentences)
+        if sum(tokens) <= token_budget:
+            return results
+        scores = sentence_scores(chunks, query_embedding, embedding_function)
+
+        kept = set()
+        used = 0
+        for row in sorted(range(len(sentences)), key=lambda row: -scores[row]):
+            if used + tokens[row] <= token_budget or not kept:
+                kept.add(row)
+                used += tokens[row]
+
+        compressed = []
+        row = 0
+        for (doc, score), (chunk_sentences, _score) in zip(results, chunks):
+            chunk_kept = [sentence for offset, sentence in enumerate(chunk_sentences) if row + offset in kept]
+            row += len(chunk_sentences)
+            if chunk_kept:
+                compressed.append((doc.model_copy(update={"page_content": " ".join(chunk_kept)}), score))
+        return compressed
+
+
+def record_context_tokens(original, compressed):
+    """
+    Embedding model tokens of the context before and after the compression, in the request
+    trace and /metrics. Named after the tokenizer: they are not tokens of the LLM.
+    """
+    retrieved, kept = count_tokens([original, compressed])
+    CONTEXT_EMBEDDING_TOKENS.observe(retrieved, kind="retrieved")
+    CONTEXT_EMBEDDING_TOKENS.observe(kept, kind="kept")
+    record(
+        context_embedding_tokens_retrieved=retrieved,
+        context_embedding_tokens_kept=kept,
+        context_embedding_tokens_saved=retrieved - kept,
+    )
+    return retrieved - kept
@@ -0,0 +1,249 @@
+"""
+Bulk ingestion of PDF files, used by `manage.py ingest` and `manage.py rebuild_indexes`.
+
+Files are parsed by a pool of processes, the next batch while the current one is
+embedded, and ingested `batch_size` files at a time: the chunks are added to a
+vector store, the pages are bulk indexed in Elasticsearch, then the files of the
+batch are recorded in a checkpoint file so an interrupted run continues after the
+last finished batch. Every step can be run again on the same files without
+duplicating anything (chunk and page IDs are derived from the content and pages).
+"""
+import fcntl
+import functools
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import ChunkLocation, RagFile
+from .vectordb import (
+    add_file_metadata, calculate_chunk_ids, deduplicate_chunks, embed_texts, get_vector_store, load_pdf,
+    reassign_chunks, save_locations as save_chunk_locations, split_documents,
+)
+from .vectordb.backends import activate_index_version, index_root, index_versions, open_vector_store, storage_backend
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 50
+
+LOCK_FILE = "ingestion.lock"
+
+
+@contextmanager
+def ingestion_lock():
+    """
+    Held by the uploads and deletions while they change DATA_PATH and the live indexes, and by
+    rebuild_indexes for its last catch-up and the switch to the new versions, in every process.
+    A file added or removed in between would otherwise be missing from the new indexes.
+    """
+    os.makedirs(settings.CHROMA_PATH, exist_ok=True)
+    with open(os.path.join(settings.CHROMA_PATH, LOCK_FILE), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def pdf_paths(directory):
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.lower().endswith(".pdf") and os.path.isfile(os.path.join(directory, name))
+    )
+
+
+def parse_pdf(path, vectors=True, search=True):
+    """
+    Runs in the worker processes. Returns the pages for the vector store and the page
+    texts for Elasticsearch, extracted with the same libraries as the upload view.
+    """
+    documents = load_pdf(path) if vectors else []
+    texts = []
+    if search:
+        import pdfplumber
+
+        with pdfplumber.open(path) as pdf:
+            texts = [page.extract_text() for page in pdf.pages]
+    return documents, texts
+
+
+class Checkpoint:
+    """Files already ingested (name -> content hash), saved after every batch"""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = json.load(f)["done"]
+
+    def __contains__(self, file_name):
+        return file_name in self.done
+
+    def add(self, file_hashes):
+        self.done.update(file_hashes)
+        # Written aside then renamed, an interruption never leaves a truncated checkpoint
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"done": self.done}, f)
+        os.replace(tmp_path, self.path)
+
+
+def ingest_files(paths, file_hashes, store=None, checkpoint=None, workers=1, batch_size=DEFAULT_BATCH_SIZE,
+                 index_search=True, search_index=None, save_locations=None, user=None, register_files=False,
+                 live=False):
+    """
+    Ingests the PDF files at `paths` (in DATA_PATH). `file_hashes` maps their names to their content hash.
+
+    - `store`: vector store the chunks are added to, None to skip the vectors.
+    - `index_search`: bulk index the pages in Elasticsearch, through the write alias or in the new
+      index version `search_index`.
+    - `save_locations`: called with the ChunkLocation objects of every batch, they replace the
+      locations of their files in the table by default.
+    - `register_files`: create the RagFile rows (owned by `user`) once the files are stored.
+    - `live`: store every batch in the live indexes like an upload, holding ingestion_lock() and
+      looking up the live vector store again (a rebuild may have switched it), `store` is ignored.
+
+    Returns the names of the files ingested and of the files that could not be parsed.
+    """
+    from matching.elastic_search import bulk_index_pages
+
+    pending = [path for path in paths if checkpoint is None or os.path.basename(path) not in checkpoint]
+    batches = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+    parse = functools.partial(parse_pdf, vectors=live or store is not None, search=index_search)
+
+    ingested = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(parse, path) for path in batches[0]] if batches else []
+        for number, batch in enumerate(batches, 1):
+            current = futures
+            # The next batch is parsed while this one is embedded and stored
+            futures = [executor.submit(parse, path) for path in batches[number]] if number < len(batches) else []
+
+            documents = []
+            pages = []
+            names = []
+            for path, future in zip(batch, current):
+                name = os.path.basename(path)
+                try:
+                    file_documents, texts = future.result()
+                except Exception as e:
+                    logger.error("Could not parse %s: %s", name, e)
+                    failed.append(name)
+                    continue
+                names.append(name)
+                documents.extend(file_documents)
+                pages.extend((name, page_num, text) for page_num, text in enumerate(texts, 1) if text)
+
+            with ingestion_lock() if live else nullcontext():
+                batch_store = get_vector_store() if live else store
+                if batch_store is not None and documents:
+                    locations = add_chunks(batch_store, documents, file_hashes)
+                    if save_locations:
+                        save_locations(locations)
+                    else:
+                        save_chunk_locations(batch_store, locations)
+                if index_search and pages:
+                    # A new index version holds no stale pages to remove
+                    bulk_index_pages(pages, index=search_index, replace=search_index is None)
+                if register_files:
+                    RagFile.objects.bulk_create(
+                        [RagFile(file_name=name, user=user, file_hash=file_hashes.get(name)) for name in names],
+                        ignore_conflicts=True,
+                    )
+                if checkpoint is not None:
+                    checkpoint.add({name: file_hashes.get(name) for name in names})
+            ingested.extend(names)
+            logger.info("Batch %d/%d: %d files, %d pages", number, len(batches), len(names), len(pages))
+    return ingested, failed
+
+
+def add_chunks(store, documents, file_hashes=None):
+    """Splits the pages and adds the chunks that are not stored yet, returns the locations of all chunks"""
+    chunks = split_documents(documents)
+    add_file_metadata(chunks, file_hashes=file_hashes)
+    calculate_chunk_ids(chunks)
+    unique_chunks, locations = deduplicate_chunks(chunks)
+
+    existing_ids = store.get_existing_ids(unique_chunks)
+    new_chunks = {
+        chunk_hash: chunk for chunk_hash, chunk in unique_chunks.items() if chunk_hash not in existing_ids
+    }
+    if new_chunks:
+        texts = [chunk.page_content for chunk in new_chunks.values()]
+        store.add(list(new_chunks), texts, embed_texts(texts), [chunk.metadata for chunk in new_chunks.values()])
+    return locations
+
+
+class IndexBuild:
+    """
+    A vector index version being built next to the live one. Its checkpoint and the
+    locations of its chunks are kept in its directory until it is activated.
+    """
+
+    CHECKPOINT_FILE = "checkpoint.json"
+    LOCATIONS_FILE = "locations.jsonl"
+
+    def __init__(self, version, backend=None):
+        self.version = version
+        self.path = os.path.join(settings.CHROMA_PATH, version)
+        # Written directly, the retrieval service only serves the live version
+        self.store = open_vector_store(storage_backend(backend), self.path)
+        self.checkpoint = Checkpoint(os.path.join(self.path, self.CHECKPOINT_FILE))
+
+    @classmethod
+    def resumable(cls):
+        """Name of the most recent unfinished build, if any"""
+        live = os.path.basename(index_root())
+        for version in reversed(index_versions()):
+            if version != live and os.path.exists(os.path.join(settings.CHROMA_PATH, version, cls.CHECKPOINT_FILE)):
+                return version
+        return None
+
+    def save_locations(self, locations):
+        with open(os.path.join(self.path, self.LOCATIONS_FILE), "a") as f:
+            for location in locations:
+                f.write(json.dumps([location.content_hash, location.file_name, location.page, location.chunk_index]) + "\n")
+
+    def locations(self):
+        path = os.path.join(self.path, self.LOCATIONS_FILE)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            # A batch that was interrupted after writing its locations is written again on resume
+            rows = {tuple(json.loads(line)) for line in f if line.strip()}
+        return [
+            ChunkLocation(content_hash=content_hash, file_name=file_name, page=page, chunk_index=chunk_index)
+            for content_hash, file_name, page, chunk_index in sorted(rows, key=lambda row: row[1:])
+        ]
+
+    def remove_files(self, file_names):
+        """Takes files deleted from DATA_PATH during the build out of the new index"""
+        locations = self.locations()
+        kept = [location for location in locations if location.file_name not in file_names]
+        remaining = {}
+        for location in kept:
+            remaining.setdefault(location.content_hash, location)
+        orphaned = {location.content_hash for location in locations} - remaining.keys()
+        if orphaned:
+            self.store.delete(ids=list(orphaned))
+        for file_name in file_names:
+            reassign_chunks(self.store, file_name, remaining)
+            self.store.delete(where={"file_name": file_name})
+
+        path = os.path.join(self.path, self.LOCATIONS_FILE)
+        os.remove(path)
+        self.save_locations(kept)
+        self.checkpoint.done = {name: value for name, value in self.checkpoint.done.items() if name not in file_names}
+        self.checkpoint.add({})
+
+    def activate(self):
+        """Replaces the chunk locations and makes this version the live index"""
+        locations = self.locations()
+        with transaction.atomic():
+            ChunkLocation.objects.all().delete()
+            ChunkLocation.objects.bulk_create(locations, batch_size=1000, ignore_conflicts=True)
+        activate_index_version(self.version)
+        os.remove(self.checkpoint.path)
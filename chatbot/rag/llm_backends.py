@@ -0,0 +1,124 @@
+"""
+LLM backends. A backend turns a prompt string into the answer string, the gateway
+in rag/llm_gateway.py sits in front of it. Picked with settings.LLM_BACKEND["NAME"]:
+
+- "huggingface": the hosted model (or LLM_ENDPOINT_URL) through HuggingFaceEndpoint.
+- "llamacpp": a small quantized instruct model (GGUF file) running in the process on
+  the CPU with llama-cpp-python, no network hop. Needs `pip install llama-cpp-python`.
+"""
+import os
+import threading
+
+
+class LLMBackend:
+    def invoke(self, prompt):
+        raise NotImplementedError
+
+    def warm_up(self, prefix=None):
+        """Gets the backend ready to answer, `prefix` is prompt text every request starts with"""
+
+
+class HuggingFaceBackend(LLMBackend):
+    def __init__(self, repo_id=None, endpoint_url=None, api_token=None, timeout=120, temperature=0.5):
+        from langchain_huggingface import HuggingFaceEndpoint
+
+        # An endpoint URL (dedicated endpoint or local stub) replaces the hosted repo_id
+        endpoint = {"endpoint_url": endpoint_url} if endpoint_url else {"repo_id": repo_id}
+        self.model = HuggingFaceEndpoint(
+            **endpoint,
+            temperature=temperature,
+            model_kwargs={"max_length": 128},
+            huggingfacehub_api_token=api_token,
+            timeout=timeout,
+        )
+
+    def invoke(self, prompt):
+        return self.model.invoke(prompt)
+
+
+def default_thread_count():
+    # Half of the logical CPUs is usually the physical cores, hyper-threads do not help llama.cpp
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+class LlamaCppBackend(LLMBackend):
+    """
+    In-process model. The context keeps the tokens of the last prompt and llama.cpp only
+    evaluates the part of a new prompt that differs from them. The state after the fixed
+    start of the prompt is also saved at warm-up, and restored whenever the context holds
+    something else, so that start is never evaluated again.
+    """
+
+    # Where the chat formatted prompt of ChatPromptTemplate gives the turn back to the human
+    STOP = ["\nHuman:", "\nSystem:"]
+
+    def __init__(self, model_path, n_ctx=4096, n_threads=None, n_threads_batch=None,
+                 max_tokens=256, temperature=0.5):
+        try:
+            from llama_cpp import Llama
+        except ImportError:
+            raise ImportError("The llamacpp LLM backend needs llama-cpp-python: pip install llama-cpp-python")
+
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"No model file at {model_path}, set LLM_MODEL_PATH to a GGUF file")
+
+        n_threads = n_threads or default_thread_count()
+        self.model = Llama(
+            model_path=model_path,
+            n_ctx=n_ctx,
+            n_threads=n_threads,
+            # Prompt processing is a batched matrix product and can use every core
+            n_threads_batch=n_threads_batch or os.cpu_count(),
+            verbose=False,
+        )
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.prefix = None
+        self.prefix_tokens = None
+        self.prefix_state = None
+        # A llama.cpp context runs one evaluation at a time
+        self._lock = threading.Lock()
+
+    def invoke(self, prompt):
+        with self._lock:
+            if self.prefix_state is not None and prompt.startswith(self.prefix) and not self._holds_prefix():
+                self.model.load_state(self.prefix_state)
+            output = self.model(
+                prompt, max_tokens=self.max_tokens, temperature=self.temperature, stop=self.STOP
+            )
+        return output["choices"][0]["text"].strip()
+
+    def _holds_prefix(self):
+        n = len(self.prefix_tokens)
+        return self.model.n_tokens >= n and list(self.model.input_ids[:n]) == self.prefix_tokens
+
+    def warm_up(self, prefix=None):
+        with self._lock:
+            # First evaluation allocates the buffers and pages the weights in
+            self.model("Hello", max_tokens=1)
+            if prefix:
+                # Evaluate the shared prefix once and keep the resulting state
+                self.prefix = prefix
+                self.prefix_tokens = self.model.tokenize(prefix.encode("utf-8"))
+                self.model.reset()
+                self.model.eval(self.prefix_tokens)
+                self.prefix_state = self.model.save_state()
+
+
+def build_llm_backend(options, repo_id=None, api_token=None, endpoint_url=None, timeout=120):
+    name = options["NAME"]
+    if name == "huggingface":
+        return HuggingFaceBackend(
+            repo_id=repo_id, endpoint_url=endpoint_url, api_token=api_token,
+            timeout=timeout, temperature=options["TEMPERATURE"],
+        )
+    if name == "llamacpp":
+        return LlamaCppBackend(
+            options["MODEL_PATH"],
+            n_ctx=options["N_CTX"],
+            n_threads=options["N_THREADS"],
+            n_threads_batch=options["N_THREADS_BATCH"],
+            max_tokens=options["MAX_TOKENS"],
+            temperature=options["TEMPERATURE"],
+        )
+    raise ValueError(f"Unknown LLM backend: {name}")
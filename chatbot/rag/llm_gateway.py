@@ -0,0 +1,132 @@
+"""
+Gateway in front of the LLM: every call to the model goes through `LLMGateway.invoke`.
+
+- At most MAX_IN_FLIGHT calls run at the same time per process. A call that cannot get
+  a slot before its deadline fails instead of queueing a worker thread behind the others.
+- Every call has a deadline (TIMEOUT seconds) covering the wait for a slot, the call and
+  the retries.
+- Failed calls are retried with exponential backoff and full jitter, unless the error
+  is a client error that would fail again.
+- Identical prompts that are in flight at the same time are sent once, the callers
+  share the answer.
+"""
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class LLMError(Exception):
+    """The LLM could not answer"""
+
+
+class LLMTimeout(LLMError):
+    """The LLM did not answer before the deadline"""
+
+
+def is_retryable(error):
+    # HTTP errors carry the response, client errors other than rate limiting are not retried
+    response = getattr(error, "response", None)
+    status_code = getattr(response, "status_code", None)
+    if status_code is not None and 400 <= status_code < 500 and status_code != 429:
+        return False
+    return True
+
+
+class LLMGateway:
+    def __init__(self, llm_factory, max_in_flight=8, timeout=60, retries=2, backoff_base=0.5, backoff_max=8):
+        self.llm_factory = llm_factory
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._llm = None
+        self._llm_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        # Calls only get submitted with a slot, so the pool never queues
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="llm")
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+    @property
+    def llm(self):
+        # The model client is created on the first call
+        if self._llm is None:
+            with self._llm_lock:
+                if self._llm is None:
+                    self._llm = self.llm_factory()
+        return self._llm
+
+    def preload(self, llm):
+        """Uses a model client created beforehand, e.g. in the gunicorn master before it forks"""
+        with self._llm_lock:
+            self._llm = llm
+
+    def reset(self):
+        """Drops the model client, the next call creates it again (e.g. after the settings changed)"""
+        with self._llm_lock:
+            self._llm = None
+
+    def invoke(self, prompt, timeout=None):
+        deadline = time.monotonic() + (timeout or self.timeout)
+
+        with self._in_flight_lock:
+            shared = self._in_flight.get(prompt)
+            is_leader = shared is None
+            if is_leader:
+                shared = Future()
+                self._in_flight[prompt] = shared
+
+        if not is_leader:
+            # Same prompt already being answered, wait for that answer
+            try:
+                return shared.result(timeout=max(0, deadline - time.monotonic()))
+            except FutureTimeout:
+                raise LLMTimeout("The LLM did not answer in time")
+
+        try:
+            shared.set_result(self._invoke_with_retries(prompt, deadline))
+        except Exception as e:
+            shared.set_exception(e)
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.pop(prompt, None)
+        return shared.result()
+
+    def _invoke_with_retries(self, prompt, deadline):
+        attempt = 0
+        while True:
+            try:
+                return self._invoke_once(prompt, deadline)
+            except LLMTimeout:
+                raise
+            except Exception as e:
+                if attempt >= self.retries or not is_retryable(e):
+                    raise LLMError(f"The LLM call failed: {e}") from e
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                if time.monotonic() + delay >= deadline:
+                    raise LLMTimeout(f"No time left to retry the LLM call: {e}") from e
+                logger.warning("LLM call failed, retrying in %.2fs: %s", delay, e)
+                time.sleep(delay)
+                attempt += 1
+
+    def _invoke_once(self, prompt, deadline):
+        if not self._slots.acquire(timeout=max(0, deadline - time.monotonic())):
+            raise LLMTimeout("Too many LLM calls in flight")
+        try:
+            llm = self.llm
+            future = self._executor.submit(llm.invoke, prompt)
+        except Exception:
+            self._slots.release()
+            raise
+        # The slot is freed when the call really ends, even if the caller gave up on it,
+        # so calls that hang still count against the limit.
+        future.add_done_callback(lambda _future: self._slots.release())
+        try:
+            return future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeout:
+            raise LLMTimeout("The LLM did not answer in time")
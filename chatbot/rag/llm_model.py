@@ -1,17 +1,23 @@
-from .vectordb import get_embedding_function
-from langchain_huggingface import HuggingFaceEndpoint
+from .vectordb import file_filter, get_vector_store
+from .models import ChunkLocation
+from .context_compression import compress_context, record_context_tokens
+from .llm_gateway import LLMGateway
+from .llm_backends import build_llm_backend
+from .tracing import stage
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_chroma import Chroma
-
-from langchain.chains.history_aware_retriever import create_history_aware_retriever
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains import create_retrieval_chain
 from langchain_core.prompts import MessagesPlaceholder
+from langchain_core.messages import SystemMessage, HumanMessage
 
 from django.conf import settings
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeout
+import contextvars
+import logging
+import time
 import os
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 
@@ -23,92 +29,254 @@ repo_id = "mistralai/Mistral-7B-Instruct-v0.3"
 #repo_id ="Qwen/Qwen2.5-72B-Instruct"
 # TODO: Needs to be set in the admin panel
 # closer to 0 -> more relevant yet lesser results
-#SIMILARITY_THRESHOLD = 0.4
+SIMILARITY_THRESHOLD = 0.5
 
 # TODO: Needs to be set in the admin panel
-#CLOSEST_K_CHUNK = 5
+CLOSEST_K_CHUNK = 5
 
-model = HuggingFaceEndpoint(
+def build_model(warm_up=None):
+    backend = build_llm_backend(
+        settings.LLM_BACKEND,
         repo_id=repo_id,
-        temperature=0.5,
-        model_kwargs={"max_length": 128},
-        huggingfacehub_api_token=hf_key,
+        api_token=hf_key,
+        endpoint_url=settings.LLM_ENDPOINT_URL,
+        timeout=settings.LLM_GATEWAY["TIMEOUT"],
     )
+    if settings.LLM_BACKEND["WARM_UP"] if warm_up is None else warm_up:
+        backend.warm_up(prefix=static_prompt_prefix())
+    return backend
+
+# The prompt is the same for every user apart from the context, the history and the question.
+# The fixed messages come first and are rendered once, so every prompt starts with the same
+# text and backends with a prefix cache (llamacpp) never evaluate it again.
+STATIC_PROMPT_PREFIX = ChatPromptTemplate.from_messages([
+    ("system","The following is a friendly conversation between a human and an AI. If the AI does not know the answer to a question, it truthfully says it does not know."),
+]).format()
+PROMPT_TEMPLATE = ChatPromptTemplate.from_messages([
+    ("system","The following is the context fetched from the database. Mention your sources if possible in your answer.: \n{context}\n"),
+    MessagesPlaceholder(variable_name="chat_history"),
+    ("system","AI is instructed only to answer the below question using the conversation history and the context.\n"),
+    ("human", "{input}"),
+    ("ai","")
+])
+
+# Turns a follow-up question into a question that can be searched without the conversation
+REWRITE_TEMPLATE = ChatPromptTemplate.from_messages([
+    ("system", """Given a chat history and the latest user question \
+        which might reference context in the chat history, formulate a standalone question \
+        which can be understood without the chat history. Do NOT answer the question, \
+        just reformulate it if needed and otherwise return it as is."""),
+    MessagesPlaceholder(variable_name="chat_history"),
+    ("human", "{input}"),
+    ("ai", "")
+])
+
+# All calls to the model go through the gateway, the model itself is created on the first call
+llm_gateway = LLMGateway(
+    build_model,
+    max_in_flight=settings.LLM_GATEWAY["MAX_IN_FLIGHT"],
+    timeout=settings.LLM_GATEWAY["TIMEOUT"],
+    retries=settings.LLM_GATEWAY["RETRIES"],
+    backoff_base=settings.LLM_GATEWAY["BACKOFF_BASE"],
+    backoff_max=settings.LLM_GATEWAY["BACKOFF_MAX"],
+)
+
+# The query rewrites have their own, smaller, limit of calls in flight and share the model client.
+# A rewrite given up after its budget still holds its slot until the model answers, a burst of
+# follow-up questions only fills these slots and the answers keep theirs.
+rewrite_gateway = LLMGateway(
+    lambda: llm_gateway.llm,
+    max_in_flight=settings.HISTORY_AWARE_RETRIEVAL["MAX_IN_FLIGHT"],
+    timeout=settings.LLM_GATEWAY["TIMEOUT"],
+    # Past its budget the rewrite is not used, there is no time for a retry
+    retries=0,
+)
+
+# Runs the query rewrites alongside the retrieval of the raw query
+_rewrite_executor = ThreadPoolExecutor(max_workers=settings.HISTORY_AWARE_RETRIEVAL["MAX_IN_FLIGHT"], thread_name_prefix="rewrite")
 
 '''
 # To run on local machine with Ollama (ollama needs to be installed)
 from langchain_ollama import OllamaLLM
 llm_ollama = OllamaLLM(model="llama3.1")
 '''
-def get_context(vector_db, query_text, CLOSEST_K_CHUNK: int = 5, SIMILARITY_THRESHOLD: float = 0.5):
-    # Search the DB.
-    results = vector_db.similarity_search_with_score(query_text, k=CLOSEST_K_CHUNK)
+def get_context(vector_db, query_text, CLOSEST_K_CHUNK: int = CLOSEST_K_CHUNK, SIMILARITY_THRESHOLD: float = SIMILARITY_THRESHOLD, file_names=None):
+    # The vector of the question is kept for the context compression
+    with stage("query_embedding"):
+        embedding = vector_db.embedding_function.embed_query(query_text)
+    # Search the DB, only the chunks of `file_names` when given
+    where = file_filter(file_names) if file_names is not None else None
+    results = vector_db.similarity_search_by_vector_with_score(embedding, k=CLOSEST_K_CHUNK, filter=where)
+    return build_context(results, SIMILARITY_THRESHOLD, embedding, vector_db.embedding_function, file_names)
+
+
+def join_context(results):
+    return "\n\n---\n\n".join([ doc.page_content for doc,_score in results])
 
+
+def build_context(results, SIMILARITY_THRESHOLD: float = SIMILARITY_THRESHOLD, query_embedding=None, embedding_function=None, file_names=None):
     filtered_results = [
         (doc, score) for doc, score in results if score-1 <= SIMILARITY_THRESHOLD
     ]
+    # Only the sentences closest to the question are put in the prompt, see context_compression.py
+    compress = bool(filtered_results) and query_embedding is not None and settings.CONTEXT_COMPRESSION["ENABLED"]
+    context_results = (
+        compress_context(filtered_results, query_embedding, embedding_function) if compress else filtered_results
+    )
 
-    sources = [doc.metadata.get("id", None) for doc, _score in filtered_results]
+    # A stored chunk can appear in several files and pages, all of them (in the files searched) are cited
+    citations = ChunkLocation.citations_for(
+        (doc.metadata.get("content_hash") for doc, _score in context_results), file_names=file_names
+    )
+    sources = []
+    for doc, _score in context_results:
+        for source in citations.get(doc.metadata.get("content_hash")) or [doc.metadata.get("id", None)]:
+            if source not in sources:
+                sources.append(source)
 
-    if filtered_results:
-        context_text = "\n\n---\n\n".join([ doc.page_content for doc,_score in filtered_results])
+    if context_results:
+        context_text = join_context(context_results)
+        if compress:
+            record_context_tokens(join_context(filtered_results), context_text)
     else:
         context_text = "There is nothing found in the database as a context."
     # retriever = vector_db.as_retriever(search_kwargs={"k": CLOSEST_K_CHUNK})
     return {"context":context_text, "sources":sources}
 
-    # system_instruction = """Given a chat history and the latest user question \
-    #     which might reference context in the chat history, formulate a standalone question \
-    #     which can be understood without the chat history. Do NOT answer the question, \
-    #     just reformulate it if needed and otherwise return it as is."""
-    # # We are navigating retriever to do the relevant searches based on the conversation history
-    # retriever_prompt = ChatPromptTemplate.from_messages([
-    #     ("system", system_instruction),
-    #     MessagesPlaceholder(variable_name="chat_history"),
-    #     ("human", "{input}")]
-    # )
-
-    # history_aware_retriever = create_history_aware_retriever(
-    #     llm=model,
-    #     retriever=retriever,
-    #     prompt=retriever_prompt
-    # )
-
-    # retrieval_results = history_aware_retriever.invoke({
-    #     "input": query_text,
-    #     "chat_history": chat_history
-    # })
-    # context_list = []
-    # for i, doc in enumerate(retrieval_results):
-    #     print(doc)
-    # context = "\n\n".join(context_list)
-    # print(context)
-    # return context
-
-def query_llm(query_text: str, chat_history):
-    embedding_function = get_embedding_function()
-    db = Chroma(
-        persist_directory = settings.CHROMA_PATH,
-        embedding_function = embedding_function
-    )
-    
-    context_obj = get_context(db, query_text)
-    prompt_template = ChatPromptTemplate.from_messages([
-        ("system","The following is the context fetched from the database. Mention your sources if possible in your answer.: \n{context}\n"),
-        ("system","The following is a friendly conversation between a human and an AI. If the AI does not know the answer to a question, it truthfully says it does not know."),
-        MessagesPlaceholder(variable_name="chat_history"),
-        ("system","AI is instructed only to answer the below question using the conversation history and the context.\n"),
-        ("human", "{input}"),
-        ("ai","")
-    ])
-    prompt= prompt_template.format(context=context_obj["context"], input=query_text, chat_history=chat_history)
-    # Directing the prompt to the model
-    print(prompt)
 
+def has_history(chat_history):
+    # A new conversation only holds the "no history" system message
+    return any(isinstance(message, HumanMessage) for message in chat_history)
+
+
+def rewrite_query(query_text, chat_history, timeout=None):
+    prompt = REWRITE_TEMPLATE.format(input=query_text, chat_history=chat_history)
+    return rewrite_gateway.invoke(prompt, timeout=timeout).strip()
+
+
+def get_history_aware_context(vector_db, query_text, chat_history, CLOSEST_K_CHUNK: int = CLOSEST_K_CHUNK, SIMILARITY_THRESHOLD: float = SIMILARITY_THRESHOLD, file_names=None):
+    """
+    Retrieval for a follow-up question. The question is searched as is and, at the same time,
+    rewritten by the LLM into a standalone question that is searched too. The results of the
+    rewritten question are used if they arrive within the latency budget, otherwise the
+    results of the raw question are, so the rewrite never delays the answer by more than the budget.
+    """
+    budget = settings.HISTORY_AWARE_RETRIEVAL["BUDGET_MS"] / 1000
+    deadline = time.monotonic() + budget
+    where = file_filter(file_names) if file_names is not None else None
+
+    def search(query):
+        # The vector of the question searched is kept for the context compression
+        with stage("query_embedding"):
+            embedding = vector_db.embedding_function.embed_query(query)
+        return embedding, vector_db.similarity_search_by_vector_with_score(embedding, k=CLOSEST_K_CHUNK, filter=where)
+
+    def search_rewritten():
+        # Waited for a free rewrite thread until the answer went ahead without it
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        with stage("query_rewrite"):
+            standalone_query = rewrite_query(query_text, chat_history, timeout=remaining)
+        if not standalone_query:
+            return None
+        return search(standalone_query)
+
+    speculative = _rewrite_executor.submit(contextvars.copy_context().run, search_rewritten)
+    embedding, results = search(query_text)
 
-    
     try:
-        response = model.invoke(prompt)
+        rewritten = speculative.result(timeout=max(0, deadline - time.monotonic()))
+        if rewritten is not None:
+            embedding, results = rewritten
+    except FutureTimeout:
+        logger.info("Query rewrite exceeded its latency budget, using the raw query")
     except Exception as e:
-        print("Error invoking chain:", e)
-    return {"response_text":response, "sources":context_obj["sources"]}
\ No newline at end of file
+        logger.warning("Query rewrite failed, using the raw query: %s", e)
+
+    return build_context(results, SIMILARITY_THRESHOLD, embedding, vector_db.embedding_function, file_names)
+
+
+def query_llm(query_text: str, chat_history, file_names=None):
+    """Answers the question from the whole index, or from the chunks of `file_names` only"""
+    db = get_vector_store()
+
+    if settings.HISTORY_AWARE_RETRIEVAL["ENABLED"] and has_history(chat_history):
+        context_obj = get_history_aware_context(db, query_text, chat_history, file_names=file_names)
+    else:
+        context_obj = get_context(db, query_text, file_names=file_names)
+    prompt = build_prompt(context_obj["context"], query_text, chat_history)
+    # Directing the prompt to the model
+    logger.debug("Prompt: %s", prompt)
+
+    # Raises LLMError when the model does not answer
+    with stage("llm_call"):
+        response = llm_gateway.invoke(prompt)
+    return {"response_text":response, "sources":context_obj["sources"]}
+
+
+def build_prompt(context, query_text, chat_history):
+    with stage("prompt_build"):
+        return STATIC_PROMPT_PREFIX + "\n" + PROMPT_TEMPLATE.format(
+            context=context, input=query_text, chat_history=chat_history
+        )
+
+
+def static_prompt_prefix():
+    # Text every prompt starts with, whatever the context, history and question are
+    marker = "\x00"
+    return build_prompt(marker, marker, []).split(marker)[0]
+
+
+def get_batch_contexts(vector_db, query_texts, CLOSEST_K_CHUNK: int = CLOSEST_K_CHUNK, SIMILARITY_THRESHOLD: float = SIMILARITY_THRESHOLD, file_names=None):
+    """Contexts of several questions, embedded in one forward pass and searched together like get_context"""
+    with stage("query_embedding"):
+        embeddings = vector_db.embedding_function.embed_queries(query_texts)
+    where = file_filter(file_names) if file_names is not None else None
+    results = vector_db.similarity_search_by_vectors_with_score(embeddings, k=CLOSEST_K_CHUNK, filter=where)
+    return [
+        build_context(chunks, SIMILARITY_THRESHOLD, embedding, vector_db.embedding_function, file_names)
+        for embedding, chunks in zip(embeddings, results)
+    ]
+
+
+def query_llm_batch(query_texts, max_concurrency=None, file_names=None):
+    """
+    Answers several independent questions, from the whole index or from the chunks of
+    `file_names` only. The contexts are computed before returning, so a failure of the
+    embedding or of the search is raised to the caller. Returns a generator of (index, result)
+    pairs in the order the answers complete, the LLM calls run when it is consumed, with at
+    most `max_concurrency` in flight.
+    """
+    max_concurrency = max_concurrency or settings.RAG_QUERY_BATCH["LLM_CONCURRENCY"]
+    contexts = get_batch_contexts(get_vector_store(), query_texts, file_names=file_names)
+    return answer_batch(query_texts, contexts, max_concurrency)
+
+
+def answer_batch(query_texts, contexts, max_concurrency):
+    chat_history = [SystemMessage(content="No conversation history is available.")]
+
+    def answer(index):
+        prompt = build_prompt(contexts[index]["context"], query_texts[index], chat_history)
+        with stage("llm_call"):
+            return llm_gateway.invoke(prompt)
+
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    try:
+        # The calls are timed in the trace of the request streaming the answers
+        futures = {
+            executor.submit(contextvars.copy_context().run, answer, index): index for index in range(len(query_texts))
+        }
+        for future in as_completed(futures):
+            index = futures[future]
+            result = {"query": query_texts[index], "sources": contexts[index]["sources"]}
+            try:
+                result["response_text"] = future.result()
+            except Exception as e:
+                logger.warning("Error invoking chain: %s", e)
+                result["error"] = str(e)
+            yield index, result
+    finally:
+        # Closed early when the client went away: the questions not sent yet are dropped instead of
+        # taking LLM slots for answers nobody reads, the calls in flight end on their own
+        executor.shutdown(wait=False, cancel_futures=True)
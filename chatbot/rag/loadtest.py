@@ -0,0 +1,349 @@
+"""
+Load test of the API, run with `manage.py benchmark_api`.
+
+The app is served by a threaded WSGI server in this process, against a throw-away
+database and data directory, the LLM and Elasticsearch stand-ins of rag/stubs.py and
+a synthetic PDF corpus. The corpus is uploaded first to measure ingestion, then
+/query/, /search/ and /upload/ are called concurrently in a seeded random mix.
+Only the LLM and Elasticsearch are stood in for: embeddings, the vector store, the
+database and the PDF parsing are the real ones.
+"""
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from .stubs import start_stub_elasticsearch, start_stub_llm
+
+WORDS = (
+    "account access agreement allowance annual approval asset audit balance benefit budget calendar "
+    "claim client compliance contract contractor cost coverage customer deadline department deposit "
+    "device document employee equipment expense facility feedback finance form guideline holiday "
+    "incident insurance invoice laptop leave license manager meeting network office onboarding order "
+    "overtime password payment payroll period permit policy procedure project purchase quarter receipt "
+    "record refund reimbursement renewal report request review salary schedule security server service "
+    "shift software supplier support system team tax training travel vacation vendor warranty workflow"
+).split()
+VERBS = (
+    "approves covers defines describes explains includes limits lists requires reviews sets submits "
+    "tracks updates validates"
+).split()
+FOOTER = "Internal use only. Generated for load testing."
+
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(3, 6))]
+    words.insert(rng.randint(1, len(words) - 1), rng.choice(VERBS))
+    return " ".join(["The"] + words) + "."
+
+
+def synthetic_pages(rng, title, pages, lines_per_page=40, width=90):
+    """Text lines of every page of a document"""
+    document = []
+    for page in range(1, pages + 1):
+        lines = [f"{title} - page {page}"]
+        line = ""
+        while len(lines) < lines_per_page - 1:
+            text = sentence(rng)
+            if len(line) + len(text) + 1 > width:
+                lines.append(line)
+                line = text
+            else:
+                line = f"{line} {text}".strip()
+        # Same footer on every page, exercises the deduplication of repeated chunks
+        lines.append(FOOTER)
+        document.append(lines)
+    return document
+
+
+def pdf_escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def pdf_bytes(pages):
+    """A minimal PDF with one text line per entry of every page, in Helvetica"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for lines in pages:
+        text = "".join(f"({pdf_escape(line)}) Tj T* " for line in lines)
+        stream = f"BT /F1 10 Tf 14 TL 50 780 Td {text}ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        contents = len(objects)
+        objects.append((
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {contents} 0 R >>"
+        ).encode())
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(pages)} >>".encode()
+
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        data += b"%010d 00000 n \n" % offset
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(data)
+
+
+class SyntheticCorpus:
+    """Seeded generator of PDF files, and of questions about their content"""
+
+    def __init__(self, seed=0, pages=5):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.pages = pages
+        self.count = 0
+        self.lines = []
+        self.lock = threading.Lock()
+
+    def new_file(self):
+        with self.lock:
+            self.count += 1
+            name = f"synthetic-{self.seed}-{self.count:04d}.pdf"
+            pages = synthetic_pages(self.rng, f"Synthetic handbook {self.seed}-{self.count}", self.pages)
+            self.lines.extend(line for lines in pages for line in lines[1:-1])
+        return name, pdf_bytes(pages), len(pages)
+
+    def question(self):
+        with self.lock:
+            words = self.rng.choice(self.lines).rstrip(".").split()
+            start = self.rng.randrange(max(1, len(words) - 5))
+            return " ".join(words[start:start + self.rng.randint(3, 6)])
+
+
+def percentile(values, q):
+    # Nearest rank on the sorted values
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def parse_server_timing(header):
+    timings = {}
+    for entry in (header or "").split(","):
+        name, _, duration = entry.strip().partition(";dur=")
+        if name and duration:
+            timings[name] = float(duration)
+    return timings
+
+
+def summarize(samples, seconds):
+    """Latency percentiles, throughput and mean stage timings of (latency ms, status, timings) samples"""
+    latencies = [latency for latency, _status, _timings in samples]
+    stages = {}
+    for _latency, _status, timings in samples:
+        for name, duration in timings.items():
+            stages.setdefault(name, []).append(duration)
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for _latency, status, _timings in samples if status is None or status >= 400),
+        "throughput_rps": round(len(samples) / seconds, 2) if seconds else None,
+        "mean_ms": round(sum(latencies) / len(latencies), 2) if latencies else None,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies) if latencies else None,
+        "stages_mean_ms": {name: round(sum(values) / len(values), 2) for name, values in sorted(stages.items())},
+    }
+
+
+class ApiClient:
+    def __init__(self, base_url, token, timeout=300):
+        self.base_url = base_url
+        self.token = token
+        self.timeout = timeout
+
+    def post_json(self, path, payload):
+        return self.send(path, json.dumps(payload).encode(), "application/json")
+
+    def post_files(self, path, files):
+        boundary = uuid.uuid4().hex
+        body = bytearray()
+        for name, data in files:
+            body += (
+                f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{name}\"\r\n"
+                f"Content-Type: application/pdf\r\n\r\n"
+            ).encode() + data + b"\r\n"
+        body += f"--{boundary}--\r\n".encode()
+        return self.send(path, bytes(body), f"multipart/form-data; boundary={boundary}")
+
+    def send(self, path, body, content_type):
+        """Returns (latency ms, status, Server-Timing stages), status is None when the request failed"""
+        request = urllib.request.Request(
+            self.base_url + path, data=body, method="POST",
+            headers={"Content-Type": content_type, "Authorization": f"Bearer {self.token}"},
+        )
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                status, header = response.status, response.headers.get("Server-Timing")
+        except urllib.error.HTTPError as e:
+            e.read()
+            status, header = e.code, e.headers.get("Server-Timing")
+        except OSError:
+            status, header = None, None
+        return round((time.perf_counter() - started) * 1000, 2), status, parse_server_timing(header)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_app(host="127.0.0.1", port=0):
+    """Serves the Django app from a background thread, one thread per request like runserver"""
+    server = ThreadedWSGIServer((host, port), QuietRequestHandler)
+    server.set_app(WSGIHandler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextmanager
+def isolated_app(work_dir, llm_latency=0.2, llm_error_rate=0.0):
+    """Points the app to the stand-ins, a test database and directories under `work_dir`, and serves it"""
+    from matching import elastic_search
+    from .llm_model import llm_gateway, rewrite_gateway
+    from .vectordb import reset_vector_stores
+
+    llm = start_stub_llm(latency=llm_latency, error_rate=llm_error_rate)
+    es = start_stub_elasticsearch()
+    overrides = override_settings(
+        DATA_PATH=os.path.join(work_dir, "media", "rag_database"),
+        MEDIA_ROOT=os.path.join(work_dir, "media"),
+        CHROMA_PATH=os.path.join(work_dir, "chroma"),
+        LLM_ENDPOINT_URL="http://%s:%d" % llm.server_address,
+        ELASTICSEARCH_URL="http://%s:%d" % es.server_address,
+        ALLOWED_HOSTS=["*"],
+        DEBUG=False,
+    )
+    overrides.enable()
+    if connection.vendor == "sqlite":
+        # A file, the in-memory test database cannot take writes from several threads
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(work_dir, "db.sqlite3")
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    elastic_search.reset()
+    reset_vector_stores()
+    llm_gateway.reset()
+    rewrite_gateway.reset()
+    server = serve_app()
+    try:
+        yield "http://%s:%d/chatbot" % server.server_address
+    finally:
+        server.shutdown()
+        server.server_close()
+        llm.shutdown()
+        es.shutdown()
+        reset_vector_stores()
+        llm_gateway.reset()
+        rewrite_gateway.reset()
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        overrides.disable()
+        elastic_search.reset()
+
+
+def create_clients(base_url):
+    User = get_user_model()
+    admin = User.objects.create_user(username="benchmark-admin", password=uuid.uuid4().hex, role="admin")
+    user = User.objects.create_user(username="benchmark-user", password=uuid.uuid4().hex, role="user")
+    return (
+        ApiClient(base_url, str(RefreshToken.for_user(admin).access_token)),
+        ApiClient(base_url, str(RefreshToken.for_user(user).access_token)),
+    )
+
+
+def run_concurrently(operations, concurrency):
+    """Runs the (name, callable) operations with `concurrency` in flight, returns the samples per name and the wall time"""
+    samples = {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [(name, executor.submit(operation)) for name, operation in operations]
+        for name, future in futures:
+            samples.setdefault(name, []).append(future.result())
+    return samples, time.perf_counter() - started
+
+
+def run_benchmark(files=20, pages=5, requests=200, concurrency=8, mix=None, upload_concurrency=1,
+                  llm_latency=0.2, llm_error_rate=0.0, seed=0, log=print):
+    mix = mix or {"query": 5, "search": 4, "upload": 1}
+    rng = random.Random(seed)
+    corpus = SyntheticCorpus(seed=seed, pages=pages)
+
+    with tempfile.TemporaryDirectory(prefix="rag-benchmark-") as work_dir, \
+            isolated_app(work_dir, llm_latency=llm_latency, llm_error_rate=llm_error_rate) as base_url:
+        admin, user = create_clients(base_url)
+
+        # The embedding model is loaded outside of the measurements
+        from .vectordb import get_vector_store
+        get_vector_store().embedding_function.embed_query("warm up")
+
+        def upload():
+            name, data, _pages = corpus.new_file()
+            return admin.post_files("/upload/", [(name, data)])
+
+        log(f"Uploading {files} files of {pages} pages, {upload_concurrency} at a time")
+        samples, seconds = run_concurrently([("upload", upload) for _ in range(files)], upload_concurrency)
+        ingestion = summarize(samples["upload"], seconds)
+        ingestion.update(files=files, pages=files * pages, seconds=round(seconds, 2),
+                         pages_per_second=round(files * pages / seconds, 2))
+
+        operations = {
+            "query": lambda: user.post_json("/query/", {"query": corpus.question()}),
+            "search": lambda: user.post_json("/search/", {"search": corpus.question()}),
+            "upload": upload,
+        }
+        names = rng.choices(list(mix), weights=list(mix.values()), k=requests)
+        log(f"Sending {requests} requests ({', '.join(f'{name}={weight}' for name, weight in mix.items())}), "
+            f"{concurrency} at a time")
+        samples, seconds = run_concurrently([(name, operations[name]) for name in names], concurrency)
+        load = {
+            "seconds": round(seconds, 2),
+            "requests": requests,
+            "throughput_rps": round(requests / seconds, 2),
+            "endpoints": {name: summarize(endpoint_samples, seconds) for name, endpoint_samples in samples.items()},
+        }
+        if "upload" in samples:
+            load["pages_per_second"] = round(len(samples["upload"]) * pages / seconds, 2)
+
+    return {
+        "commit": git_commit(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "files": files, "pages": pages, "requests": requests, "concurrency": concurrency, "mix": mix,
+            "upload_concurrency": upload_concurrency, "llm_latency_ms": llm_latency * 1000,
+            "llm_error_rate": llm_error_rate, "seed": seed,
+            "retrieval_backend": settings.RAG_RETRIEVAL["BACKEND"], "llm_backend": settings.LLM_BACKEND["NAME"],
+        },
+        "ingestion": ingestion,
+        "load": load,
+    }
@@ -0,0 +1,95 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.loadtest import run_benchmark
+
+
+def weights(value):
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name not in ("query", "search", "upload"):
+            raise ValueError(name)
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def change(old, new):
+    if not old or new is None:
+        return ""
+    return f" ({(new - old) / old:+.0%})"
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test of /query/, /search/ and /upload/ on a synthetic PDF corpus, with local stand-ins "
+        "for the LLM and Elasticsearch and a throw-away database. Reports latency percentiles, "
+        "throughput and ingestion pages/sec."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--files", type=int, default=20, help="Files uploaded before the load")
+        parser.add_argument("--pages", type=int, default=5, help="Pages per file")
+        parser.add_argument("--requests", type=int, default=200, help="Requests sent during the load")
+        parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight during the load")
+        parser.add_argument("--upload-concurrency", type=int, default=1, help="Uploads in flight before the load")
+        parser.add_argument("--mix", type=weights, default="query=5,search=4,upload=1",
+                            help="Share of each endpoint in the load, e.g. query=5,search=4,upload=1")
+        parser.add_argument("--llm-latency-ms", type=float, default=200)
+        parser.add_argument("--llm-error-rate", type=float, default=0.0)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results as JSON to this file")
+        parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+
+    def handle(self, *args, **options):
+        if options["files"] < 1 or options["requests"] < 1:
+            raise CommandError("--files and --requests must be at least 1")
+        mix = options["mix"] if isinstance(options["mix"], dict) else weights(options["mix"])
+
+        results = run_benchmark(
+            files=options["files"],
+            pages=options["pages"],
+            requests=options["requests"],
+            concurrency=options["concurrency"],
+            mix=mix,
+            upload_concurrency=options["upload_concurrency"],
+            llm_latency=options["llm_latency_ms"] / 1000,
+            llm_error_rate=options["llm_error_rate"],
+            seed=options["seed"],
+            log=self.stdout.write,
+        )
+
+        previous = {}
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                previous = json.load(f)
+
+        ingestion = results["ingestion"]
+        old_ingestion = previous.get("ingestion", {})
+        self.stdout.write(
+            f"Ingestion: {ingestion['pages']} pages in {ingestion['seconds']} s, "
+            f"{ingestion['pages_per_second']} pages/s{change(old_ingestion.get('pages_per_second'), ingestion['pages_per_second'])}"
+        )
+        load = results["load"]
+        old_endpoints = previous.get("load", {}).get("endpoints", {})
+        self.stdout.write(
+            f"Load: {load['requests']} requests in {load['seconds']} s, {load['throughput_rps']} req/s"
+            f"{change(previous.get('load', {}).get('throughput_rps'), load['throughput_rps'])}"
+        )
+        self.stdout.write(f"{'endpoint':<10} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>18} {'p95 ms':>18} {'p99 ms':>18}")
+        for name, summary in load["endpoints"].items():
+            old = old_endpoints.get(name, {})
+            percentiles = " ".join(
+                f"{str(summary[key]) + change(old.get(key), summary[key]):>18}" for key in ("p50_ms", "p95_ms", "p99_ms")
+            )
+            self.stdout.write(
+                f"{name:<10} {summary['requests']:>9} {summary['errors']:>7} {summary['throughput_rps']:>8} {percentiles}"
+            )
+            if summary["stages_mean_ms"]:
+                stages = ", ".join(f"{stage} {duration}" for stage, duration in summary["stages_mean_ms"].items())
+                self.stdout.write(f"{'':<10} mean stage ms: {stages}")
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,124 @@
+import json
+import os
+import re
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from rag.loadtest import git_commit, percentile
+from rag.vectordb import CHUNK_OVERLAP, CHUNK_SIZE, load_documents, split_documents
+from rag.vectordb.chunking import EMBEDDING_MAX_TOKENS, load_tokenizer
+
+# A chunk ending otherwise was cut inside a sentence
+SENTENCE_END = re.compile(r"[.!?:;][\"')\]]*$")
+
+
+def recursive_token_splitter(tokenizer, chunk_size, chunk_overlap):
+    """RecursiveCharacterTextSplitter measuring its pieces in tokens, the usual way to size chunks in tokens"""
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids),
+    )
+
+
+def chunk_stats(chunks, tokenizer):
+    """Tokens the model gets for each chunk ([CLS] and [SEP] included) and how many are truncated"""
+    texts = [chunk.page_content for chunk in chunks]
+    tokens = [len(encoding.ids) for encoding in tokenizer.encode_batch(texts)]
+    return {
+        "chunks": len(chunks),
+        "mean_tokens": float(np.mean(tokens)) if tokens else 0.0,
+        "p95_tokens": percentile(tokens, 95) or 0,
+        "max_tokens": max(tokens, default=0),
+        "truncated": sum(count > EMBEDDING_MAX_TOKENS for count in tokens),
+        "tokens_lost": sum(max(0, count - EMBEDDING_MAX_TOKENS) for count in tokens),
+        "mid_sentence": sum(not SENTENCE_END.search(text) for text in texts),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the chunkers (settings.CHUNKING['SPLITTER']) on the pages of a directory of PDFs, with "
+        "RecursiveCharacterTextSplitter measuring in tokens (recursive-tokens) as a baseline: pages split "
+        "per second, and the size of the chunks in tokens of the embedding model, with the ones longer than the "
+        f"{EMBEDDING_MAX_TOKENS} tokens it embeds (truncated) and the ones cut inside a sentence."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", nargs="?", help="Directory of PDF files, DATA_PATH by default")
+        parser.add_argument("--limit", type=int, help="Only use the first N files")
+        parser.add_argument("--workers", type=int, default=1, help="Processes parsing the PDFs")
+        parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Characters, for the characters splitter")
+        parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP)
+        parser.add_argument("--chunk-tokens", type=int, default=settings.CHUNKING["CHUNK_TOKENS"],
+                            help="Tokens, for the tokens splitter")
+        parser.add_argument("--overlap-tokens", type=int, default=settings.CHUNKING["OVERLAP_TOKENS"])
+        parser.add_argument("--repeat", type=int, default=3, help="Runs of each splitter, the fastest is kept")
+        parser.add_argument("--output", help="Write the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        directory = options["directory"] or settings.DATA_PATH
+        if not os.path.isdir(directory):
+            raise CommandError(f"{directory} is not a directory")
+        paths = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(".pdf")
+        )[:options["limit"]]
+        if not paths:
+            raise CommandError(f"No PDF file in {directory}")
+        try:
+            tokenizer = load_tokenizer()
+        except (ImportError, OSError) as e:
+            raise CommandError(f"The tokenizer of the embedding model cannot be loaded: {e}")
+
+        documents = load_documents(paths, workers=options["workers"])
+        characters = sum(len(document.page_content) for document in documents)
+        self.stdout.write(f"{len(paths)} files, {len(documents)} pages, {characters / 2 ** 20:.1f} MB of text")
+
+        tokens = (options["chunk_tokens"], options["overlap_tokens"])
+        characters_sizes = (options["chunk_size"], options["chunk_overlap"])
+        recursive = recursive_token_splitter(tokenizer, *tokens)
+        # Name -> (chunk size, overlap, split)
+        splitters = {
+            "tokens": (*tokens, lambda: split_documents(documents, *tokens, splitter="tokens")),
+            "characters": (*characters_sizes, lambda: split_documents(documents, *characters_sizes, splitter="characters")),
+            "recursive-tokens": (*tokens, lambda: recursive.split_documents(documents)),
+        }
+        results = []
+        for splitter, (chunk_size, chunk_overlap, split) in splitters.items():
+            elapsed = []
+            for _run in range(max(1, options["repeat"])):
+                started = time.perf_counter()
+                chunks = split()
+                elapsed.append(time.perf_counter() - started)
+            wall = min(elapsed)
+            results.append({
+                "splitter": splitter,
+                "chunk_size": chunk_size,
+                "chunk_overlap": chunk_overlap,
+                "wall_s": wall,
+                "pages_per_s": len(documents) / wall if wall else None,
+                "mb_per_s": characters / 2 ** 20 / wall if wall else None,
+                **chunk_stats(chunks, tokenizer),
+            })
+
+        self.stdout.write(
+            f"{'splitter':<16} {'size':>5} {'wall s':>8} {'pages/s':>9} {'MB/s':>7} {'chunks':>7} "
+            f"{'mean tok':>9} {'p95 tok':>8} {'max tok':>8} {'truncated':>10} {'mid-sent.':>10}"
+        )
+        for result in results:
+            self.stdout.write(
+                f"{result['splitter']:<16} {result['chunk_size']:>5} {result['wall_s']:>8.3f} "
+                f"{result['pages_per_s'] or 0:>9.0f} {result['mb_per_s'] or 0:>7.2f} {result['chunks']:>7} "
+                f"{result['mean_tokens']:>9.1f} {result['p95_tokens']:>8} {result['max_tokens']:>8} "
+                f"{result['truncated']:>10} {result['mid_sentence']:>10}"
+            )
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump({
+                    "commit": git_commit(), "files": len(paths), "pages": len(documents), "results": results,
+                }, f, indent=2)
@@ -0,0 +1,133 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.loadtest import SyntheticCorpus, git_commit
+from rag.vectordb import get_vector_store
+from rag.vectordb.backends import normalize, storage_backend
+from rag.vectordb.embeddings import EMBEDDING_MODEL_NAME, EmbeddingWrapper, OnnxEmbeddingWrapper
+
+# Runtime name -> how it is loaded, the first one is the reference of the parity check
+RUNTIMES = {
+    "torch": lambda model_name: EmbeddingWrapper(model_name),
+    "onnx": lambda model_name: OnnxEmbeddingWrapper(model_name, quantized=False),
+    "onnx-int8": lambda model_name: OnnxEmbeddingWrapper(model_name, quantized=True),
+}
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def runtime_list(value):
+    runtimes = [item for item in value.split(",") if item]
+    unknown = set(runtimes) - RUNTIMES.keys()
+    if unknown:
+        raise ValueError(f"Unknown runtimes: {', '.join(sorted(unknown))}")
+    return runtimes
+
+
+def sample_texts(count, seed):
+    """Chunks of the current corpus, or synthetic paragraphs when it is empty"""
+    texts = []
+    for _ids, documents, _metadatas, _embeddings in get_vector_store(storage_backend()).export():
+        texts.extend(documents)
+        if len(texts) >= count:
+            break
+    if texts:
+        return texts[:count]
+    corpus = SyntheticCorpus(seed=seed)
+    while len(corpus.lines) < count * 3:
+        corpus.new_file()
+    return [" ".join(corpus.lines[row:row + 3]) for row in range(0, count * 3, 3)]
+
+
+def throughput(embedding_function, texts, batch_size):
+    started = time.perf_counter()
+    for start in range(0, len(texts), batch_size):
+        embedding_function.encode(texts[start:start + batch_size])
+    elapsed = time.perf_counter() - started
+    batches = -(-len(texts) // batch_size)
+    return {"texts_per_s": len(texts) / elapsed, "ms_per_batch": elapsed * 1000 / batches}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the embedding runtimes (torch, onnx, onnx-int8) on chunks of the current corpus: "
+        "cosine agreement of their vectors with the torch ones, and texts embedded per second by batch size. "
+        "Export the ONNX models first with `manage.py export_onnx_embeddings`."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model-name", default=EMBEDDING_MODEL_NAME)
+        parser.add_argument("--runtimes", type=runtime_list, default=list(RUNTIMES),
+                            help="Comma separated, the first one is the reference")
+        parser.add_argument("--texts", type=int, default=256, help="Number of texts embedded")
+        parser.add_argument("--batch-sizes", type=int_list, default=[1, 32],
+                            help="1 is a query, 32 the ingestion, comma separated")
+        parser.add_argument("--min-cosine", type=float,
+                            help="Fail if a vector of a runtime is further than this from the reference one")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        texts = sample_texts(options["texts"], options["seed"])
+        self.stdout.write(f"{len(texts)} texts, {np.mean([len(text) for text in texts]):.0f} characters on average")
+
+        runtimes = {}
+        for name in options["runtimes"]:
+            try:
+                runtimes[name] = RUNTIMES[name](options["model_name"])
+            except (ImportError, FileNotFoundError) as e:
+                self.stderr.write(f"Skipping {name}: {e}")
+        if not runtimes:
+            raise CommandError("No runtime could be loaded")
+
+        reference_name = next(iter(runtimes))
+        results = []
+        vectors = {}
+        for name, embedding_function in runtimes.items():
+            # First call outside the measures, it allocates the buffers of the runtime
+            embedding_function.encode(texts[:1])
+            vectors[name] = normalize(np.asarray(embedding_function.encode(texts), dtype=np.float32))
+            if vectors[name].shape != vectors[reference_name].shape:
+                raise CommandError(
+                    f"{name} returns vectors of {vectors[name].shape[1]} dimensions and {reference_name} of "
+                    f"{vectors[reference_name].shape[1]}, they do not run the same model"
+                )
+            cosines = np.sum(vectors[name] * vectors[reference_name], axis=1)
+            result = {
+                "runtime": name,
+                "mean_cosine": float(cosines.mean()),
+                "min_cosine": float(cosines.min()),
+                "throughput": {
+                    batch_size: throughput(embedding_function, texts, batch_size) for batch_size in options["batch_sizes"]
+                },
+            }
+            results.append(result)
+
+        header = f"{'runtime':<12} {'mean cos':>9} {'min cos':>9}"
+        for batch_size in options["batch_sizes"]:
+            header += f" {f'texts/s @{batch_size}':>15} {f'ms/batch @{batch_size}':>15}"
+        self.stdout.write(header)
+        for result in results:
+            line = f"{result['runtime']:<12} {result['mean_cosine']:>9.5f} {result['min_cosine']:>9.5f}"
+            for batch_size in options["batch_sizes"]:
+                measure = result["throughput"][batch_size]
+                line += f" {measure['texts_per_s']:>15.1f} {measure['ms_per_batch']:>15.2f}"
+            self.stdout.write(line)
+        self.stdout.write(f"Cosines against {reference_name}")
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump({
+                    "commit": git_commit(), "model_name": options["model_name"], "texts": len(texts),
+                    "reference": reference_name, "results": results,
+                }, f, indent=2)
+
+        if options["min_cosine"] is not None:
+            failed = [result["runtime"] for result in results if result["min_cosine"] < options["min_cosine"]]
+            if failed:
+                raise CommandError(f"Vectors further than {options['min_cosine']} from {reference_name}: {', '.join(failed)}")
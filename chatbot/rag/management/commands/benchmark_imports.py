@@ -0,0 +1,110 @@
+import json
+import os
+import re
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.loadtest import git_commit
+
+# Printed to stderr by the child between its phases, next to the `-X importtime` lines
+PHASE_MARKER = "benchmark-imports-phase"
+
+CHILD_CODE = f"""
+import importlib, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+print("{PHASE_MARKER}", "django.setup", time.perf_counter() - started, file=sys.stderr, flush=True)
+for module in sys.argv[1:]:
+    started = time.perf_counter()
+    importlib.import_module(module)
+    print("{PHASE_MARKER}", module, time.perf_counter() - started, file=sys.stderr, flush=True)
+"""
+
+IMPORT_TIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|\s+(\S+)")
+
+
+def csv_list(value):
+    return [item for item in value.split(",") if item]
+
+
+def profile_imports(modules):
+    """
+    Imports `modules` after django.setup() in a fresh interpreter. Returns, per phase, the
+    wall time and the self import time (microseconds) of every module imported.
+    """
+    command = [sys.executable, "-X", "importtime", "-c", CHILD_CODE, *modules]
+    result = subprocess.run(
+        command, cwd=settings.BASE_DIR, capture_output=True, text=True,
+        env={**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "chatbot.settings")},
+    )
+    if result.returncode:
+        raise CommandError(f"The imports failed:\n{result.stderr[-2000:]}")
+
+    phases = []
+    imported = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            imported[match[3]] = int(match[1])
+        elif line.startswith(PHASE_MARKER):
+            _marker, name, seconds = line.split()
+            phases.append({"phase": name, "wall_s": float(seconds), "modules": imported})
+            imported = {}
+    return phases
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures what loading the app costs: runs django.setup() then imports the URL configuration "
+        "(what a worker and the system checks of every management command do) in fresh interpreters "
+        "with `python -X importtime`, and reports the wall time of each phase and the packages that "
+        "take the most time to import."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--modules", type=csv_list, default=[settings.ROOT_URLCONF],
+                            help="Modules imported after django.setup(), comma separated")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs, the fastest one is reported")
+        parser.add_argument("--top", type=int, default=15, help="Packages listed")
+        parser.add_argument("--fail-on", type=csv_list, default=[],
+                            help="Fail if one of these packages is imported (e.g. torch,sentence_transformers)")
+        parser.add_argument("--output", help="Write the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        runs = [profile_imports(options["modules"]) for _ in range(options["repeat"])]
+        # The fastest run is the least disturbed by the rest of the machine
+        phases = min(runs, key=lambda run: sum(phase["wall_s"] for phase in run))
+
+        packages = {}
+        for phase in phases:
+            for module, self_us in phase["modules"].items():
+                package = module.split(".")[0]
+                packages[package] = packages.get(package, 0) + self_us
+        ranking = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+
+        self.stdout.write(f"{'phase':<24} {'wall ms':>9} {'modules':>8}")
+        for phase in phases:
+            self.stdout.write(f"{phase['phase']:<24} {phase['wall_s'] * 1000:>9.1f} {len(phase['modules']):>8}")
+        self.stdout.write(f"\n{'package':<24} {'import ms':>9}")
+        for package, self_us in ranking[:options["top"]]:
+            self.stdout.write(f"{package:<24} {self_us / 1000:>9.1f}")
+
+        results = {
+            "commit": git_commit(),
+            "phases": [
+                {"phase": phase["phase"], "wall_ms": round(phase["wall_s"] * 1000, 1), "modules": len(phase["modules"])}
+                for phase in phases
+            ],
+            "packages_ms": {package: round(self_us / 1000, 1) for package, self_us in ranking},
+        }
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
+
+        forbidden = sorted(set(options["fail_on"]) & packages.keys())
+        if forbidden:
+            raise CommandError(f"Imported while loading the app: {', '.join(forbidden)}")
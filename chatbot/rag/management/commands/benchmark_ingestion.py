@@ -0,0 +1,166 @@
+import json
+import os
+import resource
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from rag.vectordb import (
+    CHUNK_OVERLAP, CHUNK_SIZE, EMBEDDING_BATCH_SIZE, add_file_metadata, calculate_chunk_ids, deduplicate_chunks,
+    embed_texts, get_embedding_function, get_vector_store, load_documents, reset_vector_stores, split_documents,
+)
+from rag.vectordb.backends import BACKENDS, storage_backend
+from rag.vectordb.chunking import SPLITTERS
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+def rss_bytes():
+    # Current resident set size, only available on Linux
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+
+class StageMeter:
+    """Wall time, CPU time (of this process and its finished children) and peak RSS of a block"""
+
+    SAMPLING_INTERVAL = 0.01
+
+    def __enter__(self):
+        self.peak_rss = rss_bytes() or 0
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        self._times = os.times()
+        self._started = time.perf_counter()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.SAMPLING_INTERVAL):
+            self.peak_rss = max(self.peak_rss, rss_bytes() or 0)
+
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self._started
+        times = os.times()
+        # User and system time of the process, then of the child processes that were waited for
+        self.cpu = sum(times[:4]) - sum(self._times[:4])
+        self._stop.set()
+        self._sampler.join()
+        self.peak_rss = max(self.peak_rss, rss_bytes() or 0)
+        if not self.peak_rss:
+            # Peak of the whole process so far, in KiB on Linux
+            self.peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the ingestion pipeline (load, split, ids, embed, store) over a directory of PDFs and reports "
+        "the wall time, CPU time, peak RSS and throughput of every stage. Several chunk sizes and worker "
+        "counts can be compared. Chunks are stored in a temporary vector store, the live one is not touched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="Directory of PDF files")
+        parser.add_argument("--limit", type=int, help="Only use the first N files")
+        parser.add_argument("--splitter", choices=SPLITTERS, help="Chunker, the configured one by default")
+        parser.add_argument("--chunk-sizes", type=int_list,
+                            help="Comma separated, tokens or characters depending on the splitter")
+        parser.add_argument("--overlap", type=float, help="Chunk overlap as a share of the chunk size")
+        parser.add_argument("--workers", type=int_list, default=[1],
+                            help="Parsing processes and embedding threads, comma separated (1 is serial)")
+        parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE,
+                            help="Texts per forward pass of the parallel embedding")
+        parser.add_argument("--backend", choices=sorted(BACKENDS), help="Vector store, the configured one by default")
+        parser.add_argument("--output", help="Write the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        directory = options["directory"]
+        if not os.path.isdir(directory):
+            raise CommandError(f"{directory} is not a directory")
+        paths = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(".pdf")
+        )[:options["limit"]]
+        if not paths:
+            raise CommandError(f"No PDF file in {directory}")
+
+        splitter = options["splitter"] or settings.CHUNKING["SPLITTER"]
+        if splitter == "tokens":
+            chunk_size, chunk_overlap = settings.CHUNKING["CHUNK_TOKENS"], settings.CHUNKING["OVERLAP_TOKENS"]
+        else:
+            chunk_size, chunk_overlap = CHUNK_SIZE, CHUNK_OVERLAP
+        chunk_sizes = options["chunk_sizes"] or [chunk_size]
+        overlap = chunk_overlap / chunk_size if options["overlap"] is None else options["overlap"]
+
+        with StageMeter() as meter:
+            get_embedding_function().embed_documents(["warm up"])
+        self.stdout.write(f"{len(paths)} files, embedding model loaded in {meter.wall:.1f} s")
+
+        results = []
+
+        def record(stage, workers, chunk_size, meter, count, unit):
+            results.append({
+                "stage": stage,
+                "workers": workers,
+                "chunk_size": chunk_size,
+                "wall_s": round(meter.wall, 3),
+                "cpu_s": round(meter.cpu, 3),
+                "peak_rss_mb": round(meter.peak_rss / 2 ** 20, 1),
+                "count": count,
+                "unit": unit,
+                "per_second": round(count / meter.wall, 1) if meter.wall else None,
+            })
+
+        for workers in options["workers"]:
+            with StageMeter() as meter:
+                documents = load_documents(paths, workers=workers)
+            record("load", workers, None, meter, len(documents), "pages")
+
+            for chunk_size in chunk_sizes:
+                chunk_overlap = round(chunk_size * overlap)
+                with StageMeter() as meter:
+                    chunks = split_documents(documents, chunk_size, chunk_overlap, splitter=splitter)
+                record("split", workers, chunk_size, meter, len(chunks), "chunks")
+
+                with StageMeter() as meter:
+                    add_file_metadata(chunks, directory=directory)
+                    calculate_chunk_ids(chunks)
+                    unique_chunks, _locations = deduplicate_chunks(chunks)
+                record("ids", workers, chunk_size, meter, len(chunks), "chunks")
+
+                texts = [chunk.page_content for chunk in unique_chunks.values()]
+                with StageMeter() as meter:
+                    embeddings = embed_texts(texts, workers=workers, batch_size=options["batch_size"])
+                record("embed", workers, chunk_size, meter, len(texts), "embeddings")
+
+                with tempfile.TemporaryDirectory() as tmp_dir, override_settings(CHROMA_PATH=tmp_dir):
+                    reset_vector_stores()
+                    store = get_vector_store(storage_backend(options["backend"]))
+                    with StageMeter() as meter:
+                        store.add(
+                            list(unique_chunks), texts, embeddings, [chunk.metadata for chunk in unique_chunks.values()]
+                        )
+                    reset_vector_stores()
+                record("store", workers, chunk_size, meter, len(texts), "chunks")
+
+        self.stdout.write(
+            f"{'stage':<7} {'workers':>7} {'chunk':>6} {'wall s':>8} {'cpu s':>8} {'peak MB':>8} {'count':>8} {'per second':>18}"
+        )
+        for result in results:
+            self.stdout.write(
+                f"{result['stage']:<7} {result['workers']:>7} {result['chunk_size'] or '':>6} {result['wall_s']:>8.2f} "
+                f"{result['cpu_s']:>8.2f} {result['peak_rss_mb']:>8.1f} {result['count']:>8} "
+                f"{result['per_second'] or 0:>8} {result['unit']:<9}"
+            )
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump({"files": len(paths), "splitter": splitter, "overlap": overlap, "results": results}, f, indent=2)
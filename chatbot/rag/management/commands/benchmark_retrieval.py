@@ -0,0 +1,132 @@
+import json
+import tempfile
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.vectordb import get_vector_store
+from rag.vectordb.backends import ChromaVectorStore, QuantizedVectorStore, FlatVectorStore, normalize, storage_backend, top_k
+from rag.vectordb.projection import Projection
+
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures recall@k against exact search and query latency of the retrieval backends, "
+        "using the vectors of the current corpus. Held-out chunks are used as queries."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queries", type=int, default=200, help="Number of held-out chunks used as queries")
+        parser.add_argument("--k", type=int, default=5)
+        parser.add_argument("--m", type=int_list, default=[16], help="HNSW M values, comma separated")
+        parser.add_argument("--ef-construction", type=int_list, default=[100])
+        parser.add_argument("--ef-search", type=int_list, default=[10, 50, 100])
+        parser.add_argument("--pq-subspaces", type=int_list, default=[48, 96])
+        parser.add_argument("--dimensions", type=int_list, default=[],
+                            help="Reduced dimensions compared (PCA and Matryoshka), comma separated")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        ids, vectors = self.load_corpus()
+        if len(ids) <= options["queries"]:
+            raise CommandError(f"The corpus only has {len(ids)} chunks, use fewer --queries")
+
+        # Queries are taken out of the indexed vectors so they do not find themselves
+        rng = np.random.default_rng(options["seed"])
+        query_rows = rng.choice(len(ids), size=options["queries"], replace=False)
+        corpus_rows = np.setdiff1d(np.arange(len(ids)), query_rows)
+        queries = vectors[query_rows]
+        corpus_ids = [ids[row] for row in corpus_rows]
+        corpus = vectors[corpus_rows]
+        k = options["k"]
+
+        self.stdout.write(f"Corpus: {len(corpus_ids)} vectors of {vectors.shape[1]} dimensions, {len(queries)} queries, k={k}")
+        truth = [set(corpus_ids[row] for row in top_k(corpus @ query, k)) for query in queries]
+
+        results = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for M in options["m"]:
+                for ef_construction in options["ef_construction"]:
+                    for ef_search in options["ef_search"]:
+                        store = ChromaVectorStore(
+                            path=f"{tmp_dir}/hnsw-{M}-{ef_construction}-{ef_search}",
+                            M=M, ef_construction=ef_construction, ef_search=ef_search,
+                        )
+                        results.append(self.run(
+                            f"chroma M={M} ef_construction={ef_construction} ef_search={ef_search}",
+                            store, corpus_ids, corpus, queries, truth, k, memory=corpus.nbytes,
+                        ))
+
+        store = FlatVectorStore()
+        results.append(self.run("flat (exact)", store, corpus_ids, corpus, queries, truth, k))
+        store = QuantizedVectorStore(mode="float16")
+        results.append(self.run("float16", store, corpus_ids, corpus, queries, truth, k))
+        store = QuantizedVectorStore(mode="int8")
+        results.append(self.run("int8", store, corpus_ids, corpus, queries, truth, k))
+        for subspaces in options["pq_subspaces"]:
+            store = QuantizedVectorStore(mode="pq", subspaces=subspaces)
+            results.append(self.run(f"pq subspaces={subspaces}", store, corpus_ids, corpus, queries, truth, k))
+        for dimensions in options["dimensions"]:
+            if dimensions >= corpus.shape[1]:
+                self.stderr.write(f"Skipping {dimensions} dimensions, the vectors have {corpus.shape[1]}")
+                continue
+            # Fitted on the corpus only, like reduce_vectors does on the stored vectors
+            pca = Projection.fit("pca", corpus, dimensions)
+            for name, store, projection in [
+                (f"pca {dimensions}", FlatVectorStore(), pca),
+                (f"pca {dimensions} float16", QuantizedVectorStore(mode="float16"), pca),
+                (f"matryoshka {dimensions}", FlatVectorStore(), Projection.fit("matryoshka", corpus, dimensions)),
+            ]:
+                store.projection = projection
+                results.append(self.run(name, store, corpus_ids, corpus, queries, truth, k))
+
+        self.stdout.write(f"{'backend':<55} {'recall@k':>9} {'mean ms':>9} {'p95 ms':>9} {'build s':>9} {'vectors MB':>11}")
+        for result in results:
+            self.stdout.write(
+                f"{result['backend']:<55} {result['recall']:>9.3f} {result['mean_ms']:>9.2f} "
+                f"{result['p95_ms']:>9.2f} {result['build_s']:>9.1f} {result['memory_mb']:>11.1f}"
+            )
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump({"corpus": len(corpus_ids), "queries": len(queries), "k": k, "results": results}, f, indent=2)
+
+    def load_corpus(self):
+        ids = []
+        batches = []
+        for batch_ids, _documents, _metadatas, embeddings in get_vector_store(storage_backend()).export():
+            ids.extend(batch_ids)
+            batches.append(embeddings)
+        if not ids:
+            raise CommandError("The vector database is empty, upload some files first")
+        return ids, normalize(np.concatenate(batches))
+
+    def run(self, name, store, ids, vectors, queries, truth, k, memory=None):
+        started = time.perf_counter()
+        store.add(ids, [""] * len(ids), vectors)
+        build_seconds = time.perf_counter() - started
+
+        latencies = []
+        recalls = []
+        for query, expected in zip(queries, truth):
+            started = time.perf_counter()
+            hits = store.query(query, k=k)
+            latencies.append((time.perf_counter() - started) * 1000)
+            recalls.append(len(expected & {hit.id for hit in hits}) / k)
+
+        if memory is None:
+            memory = store.nbytes()
+        return {
+            "backend": name,
+            "recall": float(np.mean(recalls)),
+            "mean_ms": float(np.mean(latencies)),
+            "p95_ms": float(np.percentile(latencies, 95)),
+            "build_s": build_seconds,
+            "memory_mb": memory / 1024 / 1024,
+        }
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.vectordb.backends import BACKENDS, get_vector_store, copy_vector_store
+
+
+class Command(BaseCommand):
+    help = "Copies the stored chunks and their vectors from one retrieval backend to another, e.g. before switching to it."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--from", dest="source", default="chroma", choices=sorted(BACKENDS))
+        parser.add_argument("--to", dest="target", required=True, choices=sorted(BACKENDS))
+
+    def handle(self, *args, **options):
+        if options["source"] == options["target"]:
+            raise CommandError("The source and the target backends are the same")
+
+        copied = copy_vector_store(get_vector_store(options["source"]), get_vector_store(options["target"]))
+        self.stdout.write(self.style.SUCCESS(f"Copied {copied} chunks from {options['source']} to {options['target']}"))
@@ -0,0 +1,107 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.vectordb.embeddings import (
+    EMBEDDING_MODEL_NAME, ONNX_CONFIG, ONNX_INT8_MODEL, ONNX_MODEL, onnx_model_path,
+)
+
+
+def export_model(model_name, path, opset=17):
+    """
+    Writes the transformer of a sentence-transformers model as an ONNX graph (inputs
+    input_ids and attention_mask, output last_hidden_state), its tokenizer, and the
+    pooling and normalization the runtime has to apply on top of it.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Normalize, Pooling
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0]
+    pooling = next((module for module in model if isinstance(module, Pooling)), None)
+    pooling_mode = pooling.get_pooling_mode_str() if pooling is not None else "mean"
+    if pooling_mode not in ("mean", "cls"):
+        raise CommandError(f"{model_name} uses {pooling_mode} pooling, only mean and cls are supported")
+
+    class HiddenStates(torch.nn.Module):
+        # The ONNX graph returns the token embeddings only, not the pooled output of the model
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, input_ids, attention_mask):
+            return self.auto_model(input_ids=input_ids, attention_mask=attention_mask)[0]
+
+    tokenizer = transformer.tokenizer
+    os.makedirs(path, exist_ok=True)
+    # Writes tokenizer.json, the file the `tokenizers` library loads
+    tokenizer.save_pretrained(path)
+    sample = tokenizer(["An example sentence", "Another one"], padding=True, return_tensors="pt")
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in ("input_ids", "attention_mask", "last_hidden_state")}
+    with torch.no_grad():
+        torch.onnx.export(
+            HiddenStates(transformer.auto_model.eval()),
+            (sample["input_ids"], sample["attention_mask"]),
+            os.path.join(path, ONNX_MODEL),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+        )
+
+    config = {
+        "model_name": model_name,
+        "max_seq_length": model.max_seq_length,
+        "dimension": model.get_sentence_embedding_dimension(),
+        "pooling": pooling_mode,
+        "normalize": any(isinstance(module, Normalize) for module in model),
+        "pad_token": tokenizer.pad_token,
+        "pad_token_id": tokenizer.pad_token_id,
+    }
+    with open(os.path.join(path, ONNX_CONFIG), "w") as f:
+        json.dump(config, f, indent=2)
+    return config
+
+
+def quantize_model(path):
+    """int8 weights for the matrix products, the activations are quantized on the fly"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(
+        os.path.join(path, ONNX_MODEL), os.path.join(path, ONNX_INT8_MODEL), weight_type=QuantType.QInt8,
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Exports the embedding model to ONNX (and a dynamically int8 quantized copy) for the onnx embedding "
+        "backend (EMBEDDING['BACKEND'] = 'onnx'). Needs torch and sentence-transformers, the backend itself "
+        "only needs onnxruntime and tokenizers. Check the vectors with `manage.py benchmark_embeddings`."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("model_name", nargs="?", default=EMBEDDING_MODEL_NAME)
+        parser.add_argument("--output", help="Directory written, defaults to the one the backend loads from")
+        parser.add_argument("--opset", type=int, default=17)
+        parser.add_argument("--no-quantize", action="store_true", help="Only export the float32 model")
+
+    def handle(self, *args, **options):
+        try:
+            import onnxruntime  # noqa: F401
+        except ImportError:
+            raise CommandError("onnxruntime is not installed: pip install onnxruntime onnx")
+
+        path = options["output"] or onnx_model_path(options["model_name"])
+        config = export_model(options["model_name"], path, opset=options["opset"])
+        self.stdout.write(
+            f"Exported {options['model_name']} to {path} ({config['dimension']} dimensions, "
+            f"{config['pooling']} pooling, max {config['max_seq_length']} tokens)"
+        )
+        if not options["no_quantize"]:
+            quantize_model(path)
+            self.stdout.write(f"Quantized to {os.path.join(path, ONNX_INT8_MODEL)}")
+        for name in (ONNX_MODEL, ONNX_INT8_MODEL):
+            if os.path.exists(os.path.join(path, name)):
+                self.stdout.write(f"  {name}: {os.path.getsize(os.path.join(path, name)) / 2 ** 20:.0f} MB")
@@ -0,0 +1,100 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from matching.elastic_search import setup_elasticsearch
+from rag.ingestion import DEFAULT_BATCH_SIZE, Checkpoint, ingest_files, pdf_paths
+from rag.models import RagFile
+from rag.vectordb import file_hash
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk loads the PDF files of a directory into the vector store, Elasticsearch and the RagFile table, "
+        "like uploading them, without going through the web server. Files already known (same name or "
+        "same content) are skipped. An interrupted run continues from its checkpoint when started again."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="Directory of PDF files")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Parsing processes")
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Files stored at a time")
+        parser.add_argument("--checkpoint", help="Checkpoint file, CHROMA_PATH/ingest-checkpoint.json by default")
+        parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint of an earlier run")
+        parser.add_argument("--user", help="Username recorded as the uploader of the files")
+        parser.add_argument("--no-search", action="store_true", help="Do not index the pages in Elasticsearch")
+
+    def handle(self, *args, **options):
+        directory = options["directory"]
+        if not os.path.isdir(directory):
+            raise CommandError(f"{directory} is not a directory")
+        user = None
+        if options["user"]:
+            try:
+                user = get_user_model().objects.get(username=options["user"])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"No user named {options['user']}")
+        index_search = not options["no_search"]
+        if index_search and not setup_elasticsearch():
+            raise CommandError("Elasticsearch is not available, use --no-search to only load the vectors")
+
+        os.makedirs(settings.CHROMA_PATH, exist_ok=True)
+        checkpoint_path = options["checkpoint"] or os.path.join(settings.CHROMA_PATH, "ingest-checkpoint.json")
+        if options["restart"] and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        checkpoint = Checkpoint(checkpoint_path)
+
+        paths = [path for path in pdf_paths(directory) if os.path.basename(path) not in checkpoint]
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            file_hashes = dict(zip((os.path.basename(path) for path in paths), executor.map(file_hash, paths)))
+
+        # Same rules as the upload: skip known names and contents, and repeats within the directory
+        known = {name for name, _hash in RagFile.find_existing(file_hashes.items())}
+        seen = set()
+        new_paths = []
+        for path in paths:
+            name = os.path.basename(path)
+            if name in known or file_hashes[name] in seen:
+                continue
+            seen.add(file_hashes[name])
+            new_paths.append(path)
+        self.stdout.write(
+            f"{len(new_paths)} new files, {len(paths) - len(new_paths)} already known, "
+            f"{len(checkpoint.done)} done in an earlier run"
+        )
+
+        # The files are served from DATA_PATH and the chunks point to them there
+        os.makedirs(settings.DATA_PATH, exist_ok=True)
+        targets = []
+        copied = set()
+        for path in new_paths:
+            target = os.path.join(settings.DATA_PATH, os.path.basename(path))
+            if os.path.realpath(path) != os.path.realpath(target):
+                shutil.copy2(path, target)
+                copied.add(os.path.basename(path))
+            targets.append(target)
+
+        ingested, failed = ingest_files(
+            targets,
+            file_hashes,
+            checkpoint=checkpoint,
+            workers=options["workers"],
+            batch_size=options["batch_size"],
+            index_search=index_search,
+            user=user,
+            register_files=True,
+            # Every batch waits for the uploads, deletions and index switches in progress
+            live=True,
+        )
+        self.stdout.write(f"Ingested {len(ingested)} files")
+        if failed:
+            # Unreadable files are not left in DATA_PATH, where every later upload would parse them again
+            for name in copied.intersection(failed):
+                os.remove(os.path.join(settings.DATA_PATH, name))
+            self.stderr.write(f"Could not parse {len(failed)} files: {', '.join(failed)}")
+        elif os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
@@ -0,0 +1,142 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from matching.elastic_search import (
+    create_search_index, delete_files_except, finish_search_index, prune_search_indexes, resumable_search_index,
+    setup_elasticsearch, switch_aliases,
+)
+from rag.ingestion import DEFAULT_BATCH_SIZE, Checkpoint, IndexBuild, ingest_files, ingestion_lock, pdf_paths
+from rag.models import RagFile
+from rag.vectordb import file_hash
+from rag.vectordb.backends import BACKENDS, index_root, new_index_version, prune_index_versions
+from rag.vectordb.projection import copy_projection
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuilds the indexes from the files in DATA_PATH without downtime. The vector index and the "
+        "Elasticsearch index are built as new versions next to the live ones, which keep answering, "
+        "then swapped in atomically. --resume continues an interrupted rebuild."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--only", choices=["vectors", "search"], help="Only rebuild one of the indexes")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Parsing processes")
+        parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Files stored at a time")
+        parser.add_argument("--backend", choices=sorted(BACKENDS), help="Vector store, the configured one by default")
+        parser.add_argument("--resume", action="store_true", help="Continue the last interrupted rebuild")
+        parser.add_argument("--keep", type=int, default=1, help="Previous index versions kept for rollback")
+        parser.add_argument("--no-projection", action="store_true",
+                            help="Store full vectors instead of reducing them with the projection of the live index")
+
+    def handle(self, *args, **options):
+        vectors = options["only"] != "search"
+        index_search = options["only"] != "vectors"
+        if index_search and not setup_elasticsearch():
+            raise CommandError("Elasticsearch is not available, use --only vectors to only rebuild the vectors")
+        os.makedirs(settings.CHROMA_PATH, exist_ok=True)
+
+        build = None
+        if vectors:
+            version = IndexBuild.resumable() if options["resume"] else new_index_version()
+            if version is None:
+                raise CommandError("There is no interrupted rebuild to resume")
+            # Before the store of the version is opened, it applies the projection it finds
+            if not options["resume"] and not options["no_projection"]:
+                if copy_projection(index_root(), os.path.join(settings.CHROMA_PATH, version)):
+                    self.stdout.write("The vectors are reduced with the projection of the live index")
+            build = IndexBuild(version, options["backend"])
+            checkpoint = build.checkpoint
+            self.stdout.write(f"Building index version {version}")
+        else:
+            checkpoint_path = os.path.join(settings.CHROMA_PATH, "search-rebuild-checkpoint.json")
+            if not options["resume"] and os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+            checkpoint = Checkpoint(checkpoint_path)
+
+        search_index = None
+        if index_search:
+            if options["resume"]:
+                search_index = resumable_search_index()
+                if search_index is None:
+                    raise CommandError("There is no interrupted Elasticsearch rebuild to resume")
+            else:
+                # Loaded without replica nor refreshes, both are restored before the swap
+                search_index = create_search_index(build.version if build else None, bulk=True)
+            self.stdout.write(f"Building Elasticsearch index {search_index}")
+
+        file_hashes = dict(RagFile.objects.exclude(file_hash=None).values_list("file_name", "file_hash"))
+        # Files uploaded or deleted while the rebuild runs are caught up before the swap
+        self.catch_up(build, checkpoint, file_hashes, search_index, options)
+        # Then once more while uploads and deletions wait, until the new versions are live
+        with ingestion_lock():
+            self.catch_up(build, checkpoint, file_hashes, search_index, options)
+            self.switch(build, checkpoint, search_index, options)
+            RagFile.sync_rag_files(None, file_hashes)
+
+    def catch_up(self, build, checkpoint, file_hashes, search_index, options):
+        """Indexes the files of DATA_PATH not in the checkpoint, and removes the ones deleted"""
+        index_search = search_index is not None
+        while True:
+            on_disk = {os.path.basename(path): path for path in pdf_paths(settings.DATA_PATH)}
+            pending = [path for name, path in on_disk.items() if name not in checkpoint]
+            removed = [name for name in checkpoint.done if name not in on_disk]
+            if not pending and not removed:
+                break
+            if removed:
+                self.stdout.write(f"{len(removed)} files were deleted during the rebuild, removing them")
+                if build:
+                    build.remove_files(set(removed))
+                else:
+                    checkpoint.done = {name: value for name, value in checkpoint.done.items() if name not in removed}
+                    checkpoint.add({})
+            missing = [path for path in pending if os.path.basename(path) not in file_hashes]
+            with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+                file_hashes.update(zip((os.path.basename(path) for path in missing), executor.map(file_hash, missing)))
+
+            self.stdout.write(f"Indexing {len(pending)} files")
+            _ingested, failed = ingest_files(
+                pending,
+                file_hashes,
+                store=build.store if build else None,
+                checkpoint=checkpoint,
+                workers=options["workers"],
+                batch_size=options["batch_size"],
+                index_search=index_search,
+                search_index=search_index,
+                save_locations=build.save_locations if build else None,
+            )
+            if failed:
+                raise CommandError(
+                    f"Could not parse {len(failed)} files: {', '.join(failed)}. "
+                    "Remove or replace them, then run again with --resume"
+                )
+
+    def switch(self, build, checkpoint, search_index, options):
+        """Makes the new versions live and removes the older ones"""
+        index_search = search_index is not None
+        if index_search:
+            delete_files_except(set(checkpoint.done), index=search_index)
+            finish_search_index(search_index)
+            switch_aliases(search_index)
+            self.stdout.write(f"Elasticsearch index {search_index} is live")
+            removed = prune_search_indexes(options["keep"])
+            if removed:
+                self.stdout.write(f"Removed the old Elasticsearch indexes {', '.join(removed)}")
+        if build:
+            legacy = index_root() == settings.CHROMA_PATH
+            build.activate()
+            self.stdout.write(f"Index version {build.version} is live")
+            removed = prune_index_versions(options["keep"])
+            if removed:
+                self.stdout.write(f"Removed the old versions {', '.join(removed)}")
+            if legacy:
+                self.stdout.write(
+                    f"The index built before versioning is still in {settings.CHROMA_PATH}, "
+                    "its files can be removed (keep the version directories and CURRENT)"
+                )
+        elif os.path.exists(checkpoint.path):
+            os.remove(checkpoint.path)
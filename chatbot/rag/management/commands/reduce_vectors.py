@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from rag.ingestion import ingestion_lock
+from rag.vectordb.backends import (
+    BACKENDS, activate_index_version, copy_vector_store, get_vector_store, new_index_version, open_vector_store,
+    prune_index_versions, storage_backend,
+)
+from rag.vectordb.projection import METHODS, Projection
+
+
+def sample_vectors(store, size, seed=0):
+    """Uniform sample of at most `size` stored vectors (reservoir sampling), in one pass over the store"""
+    rng = np.random.default_rng(seed)
+    sample = None
+    seen = 0
+    for _ids, _documents, _metadatas, embeddings in store.export():
+        if sample is None:
+            sample = np.empty((size, embeddings.shape[1]), dtype=np.float32)
+        for vector in embeddings:
+            if seen < size:
+                sample[seen] = vector
+            else:
+                row = rng.integers(seen + 1)
+                if row < size:
+                    sample[row] = vector
+            seen += 1
+    return sample[:min(seen, size)] if sample is not None else np.empty((0, 0), dtype=np.float32)
+
+
+def directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(directory, name)) for directory, _dirs, names in os.walk(path) for name in names
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Builds a new version of the vector index with vectors of fewer dimensions: fits a PCA on a sample of "
+        "the stored vectors (or keeps their Matryoshka prefix), projects every vector without embedding again, "
+        "and makes the version live. The queries are projected the same way. Compare the recall of the "
+        "settings first with `benchmark_retrieval --dimensions`. Uploads and deletions wait until the new "
+        "version is live."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--method", choices=METHODS, default="pca")
+        parser.add_argument("--dimensions", type=int, required=True, help="Dimensions kept")
+        parser.add_argument("--sample", type=int, default=20000, help="Vectors the PCA is fitted on")
+        parser.add_argument("--backend", choices=sorted(set(BACKENDS) - {"remote"}),
+                            help="Vector store, the configured one by default")
+        parser.add_argument("--keep", type=int, default=1, help="Previous index versions kept for rollback")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        backend = storage_backend(options["backend"])
+        # A file uploaded or deleted after the copy started would be missing from the new version
+        with ingestion_lock():
+            version, projection, copied = self.reduce(backend, options)
+        root = os.path.join(settings.CHROMA_PATH, version)
+
+        before = copied * projection.input_dimension * 4
+        after = copied * projection.dimensions * 4
+        self.stdout.write(self.style.SUCCESS(
+            f"Index version {version} is live: {copied} vectors, {before / 2 ** 20:.1f} MB of float32 vectors "
+            f"reduced to {after / 2 ** 20:.1f} MB, {directory_size(root) / 2 ** 20:.1f} MB on disk"
+        ))
+        removed = prune_index_versions(options["keep"])
+        if removed:
+            self.stdout.write(f"Removed the old versions {', '.join(removed)}")
+
+    def reduce(self, backend, options):
+        """Fits the projection, copies the live index into a new version through it and activates it"""
+        source = get_vector_store(backend)
+        if source.projection is not None:
+            raise CommandError(
+                f"The live index is already reduced to {source.projection.dimensions} dimensions "
+                f"({source.projection.method}), rebuild it first with `rebuild_indexes --no-projection`"
+            )
+
+        sample = sample_vectors(source, options["sample"], options["seed"])
+        if not len(sample):
+            raise CommandError("The vector database is empty, upload some files first")
+        try:
+            projection = Projection.fit(options["method"], sample, options["dimensions"])
+        except ValueError as e:
+            raise CommandError(str(e))
+        kept = projection.kept_energy(sample)
+        self.stdout.write(
+            f"Fitted {projection.method} from {projection.input_dimension} to {projection.dimensions} dimensions "
+            f"on {len(sample)} vectors" + (f", {kept:.1%} of their squared norm kept" if kept is not None else "")
+        )
+
+        version = new_index_version()
+        root = os.path.join(settings.CHROMA_PATH, version)
+        projection.save(root)
+        # The stored vectors have the dimension of the model, the new store projects them when added
+        copied = copy_vector_store(source, open_vector_store(backend, root))
+        if copied != source.count():
+            raise CommandError(f"The index changed during the copy, version {version} was not activated, run again")
+        activate_index_version(version)
+        return version, projection, copied
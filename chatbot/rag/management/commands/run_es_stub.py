@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from rag.stubs import start_stub_elasticsearch
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs an in-memory stand-in for Elasticsearch. "
+        "Point ELASTICSEARCH_URL to it to exercise the search without an Elasticsearch node."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=9201)
+
+    def handle(self, *args, **options):
+        server = start_stub_elasticsearch(options["host"], options["port"])
+        host, port = server.server_address
+        self.stdout.write(f"Elasticsearch stub listening, use ELASTICSEARCH_URL=http://{host}:{port}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
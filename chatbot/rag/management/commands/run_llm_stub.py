@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from rag.stubs import start_stub_llm
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs a local stand-in for the LLM inference endpoint. "
+        "Point LLM_ENDPOINT_URL to it to exercise the app without the hosted model."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8089)
+        parser.add_argument("--latency-ms", type=float, default=200, help="Time taken by every answer")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of calls answered with a 503")
+
+    def handle(self, *args, **options):
+        server = start_stub_llm(
+            options["host"], options["port"], options["latency_ms"] / 1000, options["error_rate"]
+        )
+        host, port = server.server_address
+        self.stdout.write(f"LLM stub listening, use LLM_ENDPOINT_URL=http://{host}:{port}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,48 @@
+import os
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from rag.vectordb.backends import BACKENDS
+from rag.vectordb.service import RetrievalServer, RetrievalService
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs the retrieval service: loads the embedding model and the vector index once and serves "
+        "embedding, search and writes to every web worker over a Unix socket. Set "
+        "RAG_RETRIEVAL_BACKEND=remote for the web workers to use it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--socket", default=settings.RAG_RETRIEVAL["SERVICE_SOCKET"], help="Unix socket path")
+        parser.add_argument(
+            "--backend", choices=sorted(set(BACKENDS) - {"remote"}),
+            default=settings.RAG_RETRIEVAL["SERVICE_BACKEND"], help="Vector store served",
+        )
+        parser.add_argument("--max-batch", type=int, default=settings.RAG_RETRIEVAL["SERVICE_MAX_BATCH"],
+                            help="Largest number of texts embedded in one pass")
+        parser.add_argument("--max-wait-ms", type=float, default=settings.EMBEDDING_BATCHING["MAX_WAIT_MS"],
+                            help="Longest a batch of queued texts waits for others to join it")
+
+    def handle(self, *args, **options):
+        service = RetrievalService(options["backend"], options["max_batch"], options["max_wait_ms"])
+        # Opened before accepting connections, the first request does not pay for it
+        service.store.count()
+        server = RetrievalServer(options["socket"], service)
+        # Stop on SIGTERM (process managers) like on Ctrl+C
+        signal.signal(signal.SIGTERM, stop)
+        self.stdout.write(f"Retrieval service ({service.backend}) listening on {options['socket']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if os.path.exists(options["socket"]):
+                os.remove(options["socket"])
@@ -1,5 +1,12 @@
+import logging
+import time
+
 from django.conf import settings
 
+from .tracing import REQUEST_LATENCY, end_trace, get_trace_fields, resumed_trace, server_timing, start_trace
+
+request_logger = logging.getLogger("rag.requests")
+
 class MediaCorsMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -21,4 +28,66 @@ class MediaCorsMiddleware:
             response["Access-Control-Allow-Methods"] = "GET, POST, PUT, PATCH, DELETE, OPTIONS"
             response["Access-Control-Allow-Headers"] = "accept, accept-encoding, authorization, content-type, dnt, origin, user-agent, x-csrftoken, x-requested-with"
         
-        return response 
\ No newline at end of file
+        return response 
+
+class TracingMiddleware:
+    """
+    Times every request: the stages measured while handling it are sent back in the
+    Server-Timing header, logged as one structured line and added to the /metrics histograms.
+    A streamed response is logged and measured when its stream closes, with the stages run
+    while producing it, its header can only have the stages run before the first byte.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.path.startswith(settings.MEDIA_URL):
+            return self.get_response(request)
+
+        trace = start_trace()
+        fields = get_trace_fields()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            end_trace()
+        elapsed = time.perf_counter() - started
+
+        response["Server-Timing"] = server_timing(trace, total_ms=elapsed * 1000)
+        # Lets the frontend read the timings from JavaScript too
+        response["Timing-Allow-Origin"] = ", ".join(settings.CORS_ALLOWED_ORIGINS)
+        if response.streaming:
+            content = iter(response.streaming_content)
+            response.streaming_content = self.traced_stream(content, request, response, trace, fields, started)
+        else:
+            self.log_request(request, response, trace, fields, elapsed)
+        return response
+
+    def traced_stream(self, content, request, response, trace, fields, started):
+        try:
+            while True:
+                with resumed_trace(trace, fields):
+                    chunk = next(content, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            self.log_request(request, response, trace, fields, time.perf_counter() - started)
+
+    def log_request(self, request, response, trace, fields, elapsed):
+        match = getattr(request, "resolver_match", None)
+        endpoint = match.view_name if match else "unmatched"
+        REQUEST_LATENCY.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+        request_logger.info(
+            "%s %s %s %.1f ms", request.method, request.path, response.status_code, elapsed * 1000,
+            extra={
+                "method": request.method,
+                "path": request.path,
+                "endpoint": endpoint,
+                "status": response.status_code,
+                "duration_ms": round(elapsed * 1000, 2),
+                "stages_ms": {name: round(duration, 2) for name, duration in trace.items()},
+                **fields,
+            },
+        )
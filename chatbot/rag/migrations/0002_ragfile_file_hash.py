@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rag", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ragfile",
+            name="file_hash",
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
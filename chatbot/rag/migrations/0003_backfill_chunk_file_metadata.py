@@ -0,0 +1,72 @@
+import hashlib
+import os
+
+from django.conf import settings
+from django.db import migrations
+
+# Collection name langchain_chroma used, the only layout that existed before this migration
+COLLECTION_NAME = "langchain"
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def backfill_chunk_file_metadata(apps, schema_editor, batch_size=1000):
+    """
+    Add the file_name and file_hash metadata to chunks stored before they were recorded.
+    A frozen copy of the code of the time: later changes to rag.vectordb must not change
+    what an old database is migrated with.
+    """
+    # Nothing to backfill on a fresh install
+    if not os.path.exists(settings.CHROMA_PATH):
+        return
+
+    import chromadb
+
+    client = chromadb.PersistentClient(path=settings.CHROMA_PATH)
+    try:
+        collection = client.get_collection(COLLECTION_NAME)
+    except Exception:
+        return
+
+    hashes = {}
+    offset = 0
+    while True:
+        batch = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+        if not batch["ids"]:
+            break
+        offset += len(batch["ids"])
+
+        ids = []
+        metadatas = []
+        for chunk_id, metadata in zip(batch["ids"], batch["metadatas"]):
+            metadata = metadata or {}
+            if metadata.get("file_name"):
+                continue
+            # Old IDs look like "<url of the file>:<page>:<index>", the source is the URL itself
+            source = metadata.get("source") or chunk_id.rsplit(":", 2)[0]
+            file_name = os.path.basename(source)
+            if file_name not in hashes:
+                path = os.path.join(settings.DATA_PATH, file_name)
+                hashes[file_name] = file_hash(path) if os.path.exists(path) else ""
+            ids.append(chunk_id)
+            metadatas.append({**metadata, "file_name": file_name, "file_hash": hashes[file_name]})
+
+        if ids:
+            collection.update(ids=ids, metadatas=metadatas)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rag", "0002_ragfile_file_hash"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_chunk_file_metadata, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rag", "0003_backfill_chunk_file_metadata"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ChunkLocation",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("content_hash", models.CharField(db_index=True, max_length=64)),
+                ("file_name", models.CharField(db_index=True, max_length=255)),
+                ("page", models.IntegerField()),
+                ("chunk_index", models.IntegerField()),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("file_name", "page", "chunk_index"),
+                        name="unique_chunk_location",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+import hashlib
+import os
+
+from django.conf import settings
+from django.db import migrations
+
+
+def backfill_file_hashes(apps, schema_editor):
+    # Files registered before 0002 have no hash, the upload only finds their re-uploads by name
+    RagFile = apps.get_model("rag", "RagFile")
+    updated = []
+    for rag_file in RagFile.objects.filter(file_hash=None):
+        path = os.path.join(settings.DATA_PATH, rag_file.file_name)
+        if not os.path.exists(path):
+            continue
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        rag_file.file_hash = digest.hexdigest()
+        updated.append(rag_file)
+    RagFile.objects.bulk_update(updated, ["file_hash"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rag", "0005_ragfilegroup"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_file_hashes, migrations.RunPython.noop),
+    ]
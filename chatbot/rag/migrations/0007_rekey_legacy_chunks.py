@@ -0,0 +1,101 @@
+import hashlib
+import os
+import re
+
+from django.conf import settings
+from django.db import migrations
+
+# Collection name langchain_chroma used, the only layout that existed before content hash IDs
+COLLECTION_NAME = "langchain"
+CONTENT_HASH = re.compile(r"[0-9a-f]{64}")
+
+
+def content_hash(text):
+    # Same normalization as rag.vectordb.content_hash at the time
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+
+def rekey_legacy_chunks(apps, schema_editor, batch_size=1000):
+    """
+    Chunks stored before deduplication are keyed by their position ("<file url>:<page>:<index>").
+    They are stored again under the hash of their text, with their vector (nothing is embedded
+    again), and their locations are recorded, so the next upload does not add a second copy of
+    every chunk. A frozen copy of the logic of the time, like 0003.
+    """
+    if not os.path.exists(settings.CHROMA_PATH):
+        return
+
+    import chromadb
+
+    ChunkLocation = apps.get_model("rag", "ChunkLocation")
+    client = chromadb.PersistentClient(path=settings.CHROMA_PATH)
+    try:
+        collection = client.get_collection(COLLECTION_NAME)
+    except Exception:
+        return
+
+    legacy_ids = []
+    offset = 0
+    while True:
+        batch = collection.get(include=[], limit=batch_size, offset=offset)
+        if not batch["ids"]:
+            break
+        offset += len(batch["ids"])
+        legacy_ids.extend(chunk_id for chunk_id in batch["ids"] if not CONTENT_HASH.fullmatch(chunk_id))
+    if not legacy_ids:
+        return
+
+    locations = {}
+    for start in range(0, len(legacy_ids), batch_size):
+        ids = legacy_ids[start:start + batch_size]
+        batch = collection.get(ids=ids, include=["documents", "metadatas", "embeddings"])
+        stored = set(collection.get(
+            ids=list({content_hash(document or "") for document in batch["documents"]}), include=[]
+        )["ids"])
+
+        new_ids, documents, embeddings, metadatas = [], [], [], []
+        for chunk_id, document, metadata, embedding in zip(
+            batch["ids"], batch["documents"], batch["metadatas"], batch["embeddings"]
+        ):
+            document = document or ""
+            metadata = metadata or {}
+            chunk_hash = content_hash(document)
+            source, page, chunk_index = chunk_id.rsplit(":", 2)
+            file_name = metadata.get("file_name") or os.path.basename(metadata.get("source") or source)
+            locations[(file_name, int(page), int(chunk_index))] = chunk_hash
+            # The first copy of a text is kept, with the metadata of where it was found
+            if chunk_hash in stored:
+                continue
+            stored.add(chunk_hash)
+            new_ids.append(chunk_hash)
+            documents.append(document)
+            embeddings.append(embedding)
+            metadatas.append({
+                **metadata, "file_name": file_name, "content_hash": chunk_hash, "chunk_index": int(chunk_index),
+                "id": chunk_id,
+            })
+        if new_ids:
+            collection.add(ids=new_ids, documents=documents, embeddings=embeddings, metadatas=metadatas)
+        collection.delete(ids=ids)
+
+    # The files migrated have no other locations, replaced rather than merged
+    file_names = {file_name for file_name, _page, _index in locations}
+    ChunkLocation.objects.filter(file_name__in=file_names).delete()
+    ChunkLocation.objects.bulk_create(
+        [
+            ChunkLocation(content_hash=chunk_hash, file_name=file_name, page=page, chunk_index=chunk_index)
+            for (file_name, page, chunk_index), chunk_hash in sorted(locations.items())
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("rag", "0006_backfill_ragfile_hash"),
+    ]
+
+    operations = [
+        migrations.RunPython(rekey_legacy_chunks, migrations.RunPython.noop),
+    ]
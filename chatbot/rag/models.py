@@ -1,9 +1,10 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 
 from django.conf import settings
 
 import os
+import hashlib
 
 class RagUser(AbstractUser):
     USER_ROLE_CHOICES = [
@@ -65,18 +66,80 @@ class RagFile(models.Model):
     id = models.AutoField(primary_key=True)
     user = models.ForeignKey(RagUser, related_name='files_uploaded', on_delete=models.SET_NULL, null=True)
     file_name = models.CharField(max_length=255, unique=True)
+    # sha256 of the file content, used to detect re-uploads under another name
+    file_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
 
+    ## Hashing the content of a file given as an iterable of byte blocks
+    @staticmethod
+    def compute_hash(blocks):
+        digest = hashlib.sha256()
+        for block in blocks:
+            digest.update(block)
+        return digest.hexdigest()
+
+    ## Hashing a file of the folder
+    @classmethod
+    def hash_file(cls, path):
+        with open(path, 'rb') as f:
+            return cls.compute_hash(iter(lambda: f.read(1024 * 1024), b''))
+
+    ## Finding which of the given files are already known, in a single query
+    @classmethod
+    def find_existing(cls, files):
+        """
+        `files` is a list of (file name, content hash) pairs, a name may appear more than once.
+        Returns the set of pairs that are already tracked, either by name or by content.
+        """
+        files = list(files)
+        known = cls.objects.filter(
+            models.Q(file_name__in={file_name for file_name, _ in files})
+            | models.Q(file_hash__in={file_hash for _, file_hash in files})
+        ).values_list('file_name', 'file_hash')
+
+        known_names = set()
+        known_hashes = set()
+        for file_name, file_hash in known:
+            known_names.add(file_name)
+            known_hashes.add(file_hash)
+
+        return {
+            (file_name, file_hash) for file_name, file_hash in files
+            if file_name in known_names or file_hash in known_hashes
+        }
+
+    ## Resolving the files a query or a search is scoped to, in a single query
+    @classmethod
+    def names_in_scope(cls, file_ids=(), group_ids=()):
+        """Names of the files with the given IDs and of the files of the given groups"""
+        return set(
+            cls.objects.filter(models.Q(id__in=file_ids) | models.Q(groups__id__in=group_ids))
+            .values_list('file_name', flat=True)
+        )
+
     ## Syncing model file whenever there is an update in the rag_database folder
     @classmethod
-    def sync_rag_files(cls,user):
-        # Get the list of all files in the folder
-        for filename in os.listdir(settings.DATA_PATH):
-            # Check if the file already exists in the database
-            if not cls.objects.filter(file_name=filename).exists():
-                # Create a new RagFile object
-                cls.objects.create(file_name=filename, user=user)
+    def sync_rag_files(cls, user, file_hashes=None):
+        file_hashes = file_hashes or {}
+        # Files that are in the folder but not in the table yet
+        on_disk = set(os.listdir(settings.DATA_PATH))
+        tracked = set(cls.objects.values_list('file_name', flat=True))
+        new_files = sorted(on_disk - tracked)
+
+        # A single insert for all of them, concurrent uploads of the same name are ignored.
+        # Files copied to the folder by hand are hashed here, content dedup needs every hash
+        cls.objects.bulk_create(
+            [
+                cls(
+                    file_name=filename, user=user,
+                    file_hash=file_hashes.get(filename) or cls.hash_file(os.path.join(settings.DATA_PATH, filename)),
+                )
+                for filename in new_files
+            ],
+            ignore_conflicts=True,
+        )
+        return new_files
 
     ## Deleting the file from folder
     @classmethod
@@ -87,4 +150,96 @@ class RagFile(models.Model):
             # Delete the file from the folder
             os.remove(file_path)
         
-        return f"File '{file_name}' deleted successfully."
\ No newline at end of file
+        return f"File '{file_name}' deleted successfully."
+
+class RagFileGroup(models.Model):
+    """A named collection of files, /query/ and /search/ can be restricted to it"""
+    name = models.CharField(max_length=255, unique=True)
+    user = models.ForeignKey(RagUser, related_name='file_groups', on_delete=models.SET_NULL, null=True)
+    files = models.ManyToManyField(RagFile, related_name='groups', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+class ChunkLocation(models.Model):
+    """
+    Where a stored chunk appears. Chunks are stored once per distinct text,
+    identified by `content_hash`, and can appear in several files and pages.
+    """
+    content_hash = models.CharField(max_length=64, db_index=True)
+    file_name = models.CharField(max_length=255, db_index=True)
+    page = models.IntegerField()  # Starts from 1
+    chunk_index = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['file_name', 'page', 'chunk_index'], name='unique_chunk_location'),
+        ]
+
+    @property
+    def citation(self):
+        # Same "<file url>:<page>:<index>" format as the chunk IDs
+        return f"{settings.RAG_MEDIA_URL}{self.file_name}:{self.page}:{self.chunk_index}"
+
+    ## Expanding stored chunks into every place they appear (in the given files only), in a single query
+    @classmethod
+    def citations_for(cls, content_hashes, file_names=None):
+        citations = {}
+        locations = cls.objects.filter(content_hash__in=set(content_hashes))
+        if file_names is not None:
+            locations = locations.filter(file_name__in=file_names)
+        locations = locations.order_by('file_name', 'page', 'chunk_index')
+        for location in locations:
+            citations.setdefault(location.content_hash, []).append(location.citation)
+        return citations
+
+    ## Finding the texts of the files that are also in other files, in a single query
+    @classmethod
+    def shared_hashes(cls, file_names):
+        """
+        Hashes of the chunks of `file_names` that also appear in other files. They are stored
+        once, with the metadata of only one of the files.
+        """
+        in_files = cls.objects.filter(file_name__in=file_names).values('content_hash')
+        return set(
+            cls.objects.filter(content_hash__in=in_files).exclude(file_name__in=file_names)
+            .values_list('content_hash', flat=True).distinct()
+        )
+
+    ## Replacing the locations of the files of `locations` with them
+    @classmethod
+    def replace_files(cls, locations, batch_size=500):
+        """
+        The files are split again from scratch, their previous locations are dropped instead of
+        kept next to the new ones. Returns the hashes that no longer appear anywhere.
+        """
+        file_names = {location.file_name for location in locations}
+        with transaction.atomic():
+            previous = set(cls.objects.filter(file_name__in=file_names).values_list('content_hash', flat=True))
+            cls.objects.filter(file_name__in=file_names).delete()
+            cls.objects.bulk_create(locations, batch_size=batch_size)
+            previous -= {location.content_hash for location in locations}
+            still_used = set()
+            hashes = sorted(previous)
+            for start in range(0, len(hashes), batch_size):
+                still_used.update(
+                    cls.objects.filter(content_hash__in=hashes[start:start + batch_size])
+                    .values_list('content_hash', flat=True)
+                )
+        return previous - still_used
+
+    ## Removing a file from the mapping
+    @classmethod
+    def release_file(cls, file_name):
+        """
+        Returns the hashes that no longer appear in any file, and for the ones that are
+        still shared with other files, one of their remaining locations.
+        """
+        file_locations = cls.objects.filter(file_name=file_name)
+        content_hashes = set(file_locations.values_list('content_hash', flat=True))
+        file_locations.delete()
+
+        remaining = {}
+        for location in cls.objects.filter(content_hash__in=content_hashes).order_by('file_name', 'page', 'chunk_index'):
+            remaining.setdefault(location.content_hash, location)
+
+        orphaned = content_hashes - remaining.keys()
+        return orphaned, remaining
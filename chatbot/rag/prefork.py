@@ -0,0 +1,63 @@
+"""
+Loading of the models around the fork of the gunicorn workers (see gunicorn.conf.py).
+
+The workers are forked from the master with the views and the embedding model already in
+memory. Pages they only read stay shared with the master (copy-on-write), so the weights of
+the embedding model are in memory once instead of once per worker. The master loads the model
+but never runs it: the thread pools of torch and the tokenizers do not survive a fork, every
+worker starts its own on its first call.
+
+The local LLM is not loaded in the master: a llama.cpp context holds threads and buffers that
+are not fork-safe. Every worker loads it once forked. Its weights are mapped from the GGUF file,
+so the workers still share them through the page cache.
+"""
+import logging
+import os
+
+from django.conf import settings
+from django.urls import get_resolver
+
+from .tracing import process_memory
+
+logger = logging.getLogger("rag.memory")
+
+
+def load_local_llm():
+    return settings.PREFORK["LOCAL_LLM"] and settings.LLM_BACKEND["NAME"] == "llamacpp"
+
+
+def warm_up():
+    """Runs in the master once the app is loaded, before the workers are forked"""
+    # The views and the libraries they use, each worker would import them on its first request
+    get_resolver().url_patterns
+    loaded = []
+    # With the "remote" backend the model is in the retrieval service
+    if settings.PREFORK["EMBEDDING_MODEL"] and settings.RAG_RETRIEVAL["BACKEND"] != "remote":
+        from .vectordb import get_embedding_function
+
+        # The tokenizer is loaded with the model (the onnx runtime only opens its session in the workers)
+        get_embedding_function()
+        loaded.append("embedding model")
+    log_memory(f"Master loaded {', '.join(loaded) or 'no model'}")
+
+
+def worker_started():
+    """Runs in every worker once forked"""
+    if load_local_llm():
+        from .llm_model import build_model, llm_gateway
+
+        # Warmed up here (LLM_BACKEND["WARM_UP"]) rather than by the first request
+        llm_gateway.preload(build_model())
+        log_memory("Worker loaded the local LLM")
+
+
+def log_memory(event):
+    memory = process_memory()
+    if not memory:
+        logger.info("%s (pid %d)", event, os.getpid())
+        return
+    logger.info(
+        "%s (pid %d): rss %.0f MB, pss %.0f MB, uss %.0f MB", event, os.getpid(),
+        memory["rss"] / 2 ** 20, memory["pss"] / 2 ** 20, memory["uss"] / 2 ** 20,
+        extra={"pid": os.getpid(), **{f"{kind}_bytes": value for kind, value in memory.items()}},
+    )
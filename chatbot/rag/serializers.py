@@ -2,6 +2,7 @@
 from rest_framework import serializers
 from .models import Query
 from .models import RagFile
+from .models import RagFileGroup
 from .models import RagUser
 from .models import Conversation
 from .models import Search
@@ -57,3 +58,49 @@ class RagFileSerializer(serializers.ModelSerializer):
         model = RagFile
         fields = ['id', 'file_name', 'created_at','username']
 
+
+class RagFileGroupSerializer(serializers.ModelSerializer):
+    username = serializers.CharField(source='user.username', read_only=True)
+    files = serializers.PrimaryKeyRelatedField(many=True, queryset=RagFile.objects.all(), required=False)
+
+    class Meta:
+        model = RagFileGroup
+        fields = ['id', 'name', 'files', 'created_at', 'username']
+
+
+class ScopeSerializer(serializers.Serializer):
+    """
+    The optional `files` (RagFile IDs) and `collections` (RagFileGroup IDs) a query or a search
+    is restricted to. `file_names` is None when neither is given, the whole index is searched.
+    """
+    files = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+    collections = serializers.ListField(child=serializers.IntegerField(), required=False, default=list)
+
+    def validate(self, data):
+        files, collections = set(data['files']), set(data['collections'])
+        unknown_files = files - set(RagFile.objects.filter(id__in=files).values_list('id', flat=True))
+        if unknown_files:
+            raise serializers.ValidationError(f"Unknown files: {sorted(unknown_files)}")
+        unknown_collections = collections - set(
+            RagFileGroup.objects.filter(id__in=collections).values_list('id', flat=True)
+        )
+        if unknown_collections:
+            raise serializers.ValidationError(f"Unknown collections: {sorted(unknown_collections)}")
+        if not files and not collections:
+            data['file_names'] = None
+            return data
+        data['file_names'] = RagFile.names_in_scope(files, collections)
+        if not data['file_names']:
+            raise serializers.ValidationError("The selected collections have no files")
+        return data
+
+    @property
+    def error_message(self):
+        # Errors as the single message the other endpoints return
+        def messages(errors):
+            if isinstance(errors, dict):
+                errors = list(errors.values())
+            if isinstance(errors, list):
+                return [message for error in errors for message in messages(error)]
+            return [str(errors)]
+        return " ".join(messages(self.errors))
@@ -0,0 +1,443 @@
+"""
+Local stand-ins for the external services, used to exercise the app without them.
+
+The LLM stub answers like a text-generation inference endpoint (the format
+HuggingFaceEndpoint expects when LLM_ENDPOINT_URL is set), after a configurable
+latency and with a configurable share of failures.
+
+The Elasticsearch stub keeps the documents in memory and implements the part of
+the REST API the matching app uses (indices, aliases, documents, _search with
+match_phrase, multi_match, term and bool queries, highlighting, _delete_by_query
+and _bulk).
+Its scores are simple term counts, good enough for load tests, not for relevance.
+"""
+import fnmatch
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            body = {}
+        prompt = body.get("inputs") or ""
+
+        time.sleep(self.server.latency)
+        if random.random() < self.server.error_rate:
+            self.send_json(503, {"error": "Stub endpoint overloaded"})
+            return
+
+        self.server.calls += 1
+        answer = f"Stub answer to a prompt of {len(prompt)} characters."
+        self.send_json(200, [{"generated_text": answer}])
+
+    def send_json(self, status_code, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # Keep the output of benchmarks readable
+        pass
+
+
+def start_stub_llm(host="127.0.0.1", port=0, latency=0.2, error_rate=0.0):
+    """Starts the LLM stub in a background thread, `server.server_address` holds the port used"""
+    server = ThreadingHTTPServer((host, port), StubLLMHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.calls = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+def field_value(source, field):
+    # "filename.raw" is the keyword sub-field of "filename", both hold the same text here
+    return source.get(field.split(".")[0], "")
+
+
+def query_terms(query):
+    """Every word searched for by a query, to highlight them"""
+    terms = set()
+    for kind, clause in query.items():
+        if kind in ("match_phrase", "match"):
+            for value in clause.values():
+                terms.update(tokenize(value["query"] if isinstance(value, dict) else value))
+        elif kind == "multi_match":
+            terms.update(tokenize(clause["query"]))
+        elif kind == "bool":
+            for key in ("must", "should", "filter"):
+                for sub_query in clause.get(key, []):
+                    terms |= query_terms(sub_query)
+    return terms
+
+
+def score(query, source, doc_id=None):
+    """Score of a document for a query, None when it does not match"""
+    (kind, clause), = query.items()
+    if kind == "match_all":
+        return 1.0
+    if kind == "ids":
+        return 1.0 if doc_id in clause["values"] else None
+    if kind == "term":
+        (field, value), = clause.items()
+        value = value["value"] if isinstance(value, dict) else value
+        return 1.0 if field_value(source, field) == value else None
+    if kind == "terms":
+        (field, values), = clause.items()
+        return 1.0 if field_value(source, field) in values else None
+    if kind in ("match_phrase", "match"):
+        (field, value), = clause.items()
+        text = value["query"] if isinstance(value, dict) else value
+        boost = value.get("boost", 1) if isinstance(value, dict) else 1
+        words, tokens = tokenize(text), tokenize(field_value(source, field))
+        if kind == "match_phrase":
+            phrase = " ".join(words)
+            count = f" {' '.join(tokens)} ".count(f" {phrase} ") if phrase else 0
+            return count * len(words) * boost if count else None
+        count = sum(tokens.count(word) for word in words)
+        return count * boost if count else None
+    if kind == "multi_match":
+        words = set(tokenize(clause["query"]))
+        tokens = list(itertools.chain.from_iterable(
+            tokenize(field_value(source, field.split("^")[0])) for field in clause.get("fields", ["content"])
+        ))
+        found = [word for word in words if word in tokens]
+        minimum = clause.get("minimum_should_match", 1)
+        if isinstance(minimum, str) and minimum.endswith("%"):
+            minimum = int(len(words) * int(minimum[:-1]) / 100)
+        if not found or len(found) < minimum:
+            return None
+        return sum(tokens.count(word) for word in found) * clause.get("boost", 1)
+    if kind == "bool":
+        total = 0.0
+        for sub_query in clause.get("must", []) + clause.get("filter", []):
+            sub_score = score(sub_query, source, doc_id)
+            if sub_score is None:
+                return None
+            total += sub_score
+        if any(score(sub_query, source, doc_id) is not None for sub_query in clause.get("must_not", [])):
+            return None
+        should = [score(sub_query, source, doc_id) for sub_query in clause.get("should", [])]
+        matched = [sub_score for sub_score in should if sub_score is not None]
+        minimum = clause.get("minimum_should_match", 0 if clause.get("must") or clause.get("filter") else 1)
+        if should and len(matched) < minimum:
+            return None
+        return total + sum(matched)
+    raise ValueError(f"Query not supported by the stub: {kind}")
+
+
+def highlight(text, terms, options):
+    pre, post = options.get("pre_tags", ["<em>"])[0], options.get("post_tags", ["</em>"])[0]
+    size = options.get("fragment_size", 100)
+    fragments = []
+    covered = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        if match.start() >= covered and match.group().lower() in terms:
+            start = max(0, match.start() - size // 2)
+            covered = start + size
+            fragment = text[start:covered]
+            fragments.append(TOKEN_PATTERN.sub(
+                lambda word: f"{pre}{word.group()}{post}" if word.group().lower() in terms else word.group(), fragment
+            ))
+            if len(fragments) >= options.get("number_of_fragments", 5):
+                break
+    return fragments
+
+
+class StubElasticsearchHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.route("HEAD")
+
+    def do_GET(self):
+        self.route("GET")
+
+    def do_PUT(self):
+        self.route("PUT")
+
+    def do_POST(self):
+        self.route("POST")
+
+    def do_DELETE(self):
+        self.route("DELETE")
+
+    def route(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length) if length else b""
+        parts = [part for part in urlparse(self.path).path.split("/") if part]
+        indices = self.server.indices
+        with self.server.lock:
+            if not parts:
+                return self.send_json(200, {"version": {"number": "8.11.1"}, "tagline": "You Know, for Search"})
+            if parts[0] == "_bulk":
+                return self.bulk(None)
+            if parts[0] == "_aliases":
+                return self.update_aliases()
+            if parts[0] == "_alias":
+                return self.get_alias(self.resolve(parts[1]), parts[1], method)
+            if parts[:3] == ["_cluster", "state", "metadata"]:
+                return self.send_json(200, {"metadata": {"indices": {
+                    name: {"state": "open"} for name in parts[3].split(",") if name in indices
+                }}})
+            name = parts[0]
+            if len(parts) == 1:
+                if method == "HEAD":
+                    return self.send_json(200 if self.resolve(name) else 404, None)
+                if method == "PUT":
+                    if name in indices:
+                        return self.send_error_json(400, "resource_already_exists_exception")
+                    body = self.json_body()
+                    indices[name] = {
+                        "settings": body.get("settings", {}), "mappings": body.get("mappings", {}),
+                        "aliases": set(body.get("aliases", {})), "docs": {},
+                    }
+                    return self.send_json(200, {"acknowledged": True, "shards_acknowledged": True, "index": name})
+                if method == "DELETE":
+                    if indices.pop(name, None) is None:
+                        return self.send_error_json(404, "index_not_found_exception")
+                    return self.send_json(200, {"acknowledged": True})
+            targets = self.resolve(name)
+            if not targets:
+                return self.send_error_json(404, "index_not_found_exception")
+            action = parts[1]
+            if action == "_alias":
+                return self.get_alias(targets, None, method)
+            if action == "_settings":
+                if method == "GET":
+                    return self.send_json(200, {
+                        target: {"settings": {"index": self.string_settings(indices[target]["settings"])}}
+                        for target in targets
+                    })
+                for target in targets:
+                    self.update_settings(indices[target]["settings"], self.json_body())
+                return self.send_json(200, {"acknowledged": True})
+            if action == "_mapping":
+                if method == "GET":
+                    return self.send_json(200, {target: {"mappings": indices[target]["mappings"]} for target in targets})
+                for target in targets:
+                    indices[target]["mappings"].setdefault("properties", {}).update(self.json_body().get("properties", {}))
+                return self.send_json(200, {"acknowledged": True})
+            if action in ("_refresh", "_flush"):
+                return self.send_json(200, {"_shards": {"total": 1, "successful": 1, "failed": 0}})
+            if action == "_count":
+                return self.send_json(200, {"count": len(self.matching(targets, self.json_body().get("query")))})
+            if action == "_search":
+                return self.search(targets)
+            if action == "_delete_by_query":
+                matched = self.matching(targets, self.json_body().get("query"))
+                for target, doc_id, _score in matched:
+                    del indices[target]["docs"][doc_id]
+                return self.send_json(200, {"deleted": len(matched), "failures": []})
+            # Writes through an alias need it to point to a single index
+            if len(targets) > 1:
+                return self.send_error_json(400, "illegal_argument_exception")
+            if action == "_doc":
+                return self.document(targets[0], indices[targets[0]], method, parts[2] if len(parts) > 2 else None)
+            if action == "_bulk":
+                return self.bulk(targets[0])
+        self.send_error_json(400, f"Not supported by the stub: {method} {self.path}")
+
+    def resolve(self, expression):
+        """Names of the indexes an index name, alias or wildcard pattern (comma separated) refers to"""
+        names = []
+        for pattern in expression.split(","):
+            for name, index in self.server.indices.items():
+                if name not in names and (
+                    fnmatch.fnmatchcase(name, pattern) or any(fnmatch.fnmatchcase(alias, pattern) for alias in index["aliases"])
+                ):
+                    names.append(name)
+        return names
+
+    def get_alias(self, targets, alias, method):
+        indices = self.server.indices
+        if alias is not None:
+            targets = [target for target in targets if alias in indices[target]["aliases"]]
+            if not targets:
+                return self.send_json(404, {"error": f"alias [{alias}] missing", "status": 404})
+        if method == "HEAD":
+            return self.send_json(200, None)
+        self.send_json(200, {
+            target: {"aliases": {
+                name: {} for name in sorted(indices[target]["aliases"]) if alias is None or name == alias
+            }}
+            for target in targets
+        })
+
+    def update_aliases(self):
+        indices = self.server.indices
+        actions = self.json_body().get("actions", [])
+        # All the actions are applied or none, like in Elasticsearch
+        for action in actions:
+            (kind, params), = action.items()
+            if params["index"] not in indices:
+                return self.send_error_json(404, "index_not_found_exception")
+            if kind == "remove" and params["alias"] not in indices[params["index"]]["aliases"]:
+                return self.send_error_json(404, "aliases_not_found_exception")
+        for action in actions:
+            (kind, params), = action.items()
+            if kind == "add":
+                indices[params["index"]]["aliases"].add(params["alias"])
+            elif kind == "remove":
+                indices[params["index"]]["aliases"].discard(params["alias"])
+            elif kind == "remove_index":
+                del indices[params["index"]]
+        self.send_json(200, {"acknowledged": True})
+
+    @staticmethod
+    def update_settings(settings, changes):
+        for key, value in changes.items():
+            if isinstance(value, dict) and key == "index":
+                StubElasticsearchHandler.update_settings(settings, value)
+            elif value is None:
+                # null resets a setting to its default
+                settings.pop(key, None)
+            else:
+                settings[key] = value
+
+    def document(self, name, index, method, doc_id):
+        if method == "GET":
+            source = index["docs"].get(doc_id)
+            found = {"_index": name, "_id": doc_id, "found": source is not None}
+            return self.send_json(200 if source else 404, {**found, "_source": source} if source else found)
+        if method == "DELETE":
+            result = "deleted" if index["docs"].pop(doc_id, None) is not None else "not_found"
+            return self.send_json(200, {"_index": name, "_id": doc_id, "result": result})
+        doc_id = doc_id or self.new_id()
+        result = "updated" if doc_id in index["docs"] else "created"
+        index["docs"][doc_id] = self.json_body()
+        self.send_json(201 if result == "created" else 200, {
+            "_index": name, "_id": doc_id, "_version": 1, "result": result,
+            "_seq_no": self.server.seq_no, "_primary_term": 1,
+            "_shards": {"total": 1, "successful": 1, "failed": 0},
+        })
+
+    def search(self, targets):
+        body = self.json_body()
+        size = body.get("size", 10)
+        start = body.get("from", 0)
+        matched = self.matching(targets, body.get("query"))
+        matched.sort(key=lambda item: item[2], reverse=True)
+        terms = query_terms(body.get("query") or {})
+        hits = []
+        for name, doc_id, doc_score in matched[start:start + size]:
+            source = self.server.indices[name]["docs"][doc_id]
+            hit = {"_index": name, "_id": doc_id, "_score": doc_score, "_source": source}
+            fields = (body.get("highlight") or {}).get("fields", {})
+            highlights = {
+                field: highlight(str(source.get(field, "")), terms, {**body["highlight"], **options})
+                for field, options in fields.items()
+            }
+            highlights = {field: fragments for field, fragments in highlights.items() if fragments}
+            if highlights:
+                hit["highlight"] = highlights
+            hits.append(hit)
+        self.send_json(200, {
+            "took": 1, "timed_out": False,
+            "_shards": {"total": len(targets), "successful": len(targets), "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": len(matched), "relation": "eq"},
+                "max_score": matched[0][2] if matched else None,
+                "hits": hits,
+            },
+        })
+
+    def bulk(self, default_index):
+        lines = [json.loads(line) for line in self.body.splitlines() if line.strip()]
+        items = []
+        position = 0
+        while position < len(lines):
+            (action, meta), = lines[position].items()
+            position += 1
+            name = meta.get("_index", default_index)
+            targets = self.resolve(name)
+            if len(targets) == 1:
+                name = targets[0]
+            index = self.server.indices.setdefault(
+                name, {"settings": {}, "mappings": {}, "aliases": set(), "docs": {}}
+            )
+            doc_id = meta.get("_id") or self.new_id()
+            if action == "delete":
+                index["docs"].pop(doc_id, None)
+                items.append({action: {"_index": name, "_id": doc_id, "status": 200}})
+                continue
+            source = lines[position]
+            position += 1
+            if action == "update":
+                source = {**index["docs"].get(doc_id, {}), **source.get("doc", {})}
+            index["docs"][doc_id] = source
+            items.append({action: {"_index": name, "_id": doc_id, "status": 201, "result": "created"}})
+        self.send_json(200, {"took": 1, "errors": False, "items": items})
+
+    def matching(self, targets, query):
+        query = query or {"match_all": {}}
+        matched = []
+        for name in targets:
+            for doc_id, source in self.server.indices[name]["docs"].items():
+                doc_score = score(query, source, doc_id)
+                if doc_score is not None:
+                    matched.append((name, doc_id, float(doc_score)))
+        return matched
+
+    def new_id(self):
+        self.server.seq_no += 1
+        return f"stub-{self.server.seq_no}"
+
+    @staticmethod
+    def string_settings(settings):
+        # Elasticsearch returns the setting values as strings, "index." prefixes removed
+        flat = {}
+        for key, value in settings.items():
+            key = key[len("index."):] if key.startswith("index.") else key
+            flat[key] = value if isinstance(value, dict) else str(value)
+        return flat
+
+    def json_body(self):
+        return json.loads(self.body) if self.body else {}
+
+    def send_error_json(self, status_code, error_type):
+        self.send_json(status_code, {"error": {"type": error_type, "reason": error_type}, "status": status_code})
+
+    def send_json(self, status_code, payload):
+        data = json.dumps(payload).encode() if payload is not None else b""
+        self.send_response(status_code)
+        # The official client refuses servers that do not say they are Elasticsearch
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_elasticsearch(host="127.0.0.1", port=0):
+    """Starts the Elasticsearch stub in a background thread, `server.server_address` holds the port used"""
+    server = ThreadingHTTPServer((host, port), StubElasticsearchHandler)
+    server.daemon_threads = True
+    server.indices = {}
+    server.seq_no = 0
+    server.lock = threading.RLock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
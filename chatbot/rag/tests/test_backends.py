@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from ..vectordb.backends import ChromaVectorStore, FlatVectorStore, QuantizedVectorStore, normalize
+
+DIMENSION = 8
+
+
+def unit(index, other=None):
+    vector = np.zeros(DIMENSION, dtype=np.float32)
+    vector[index] = 1
+    if other is not None:
+        vector[other] = 0.5
+    return normalize(vector)
+
+
+class BackendRoundTripMixin:
+    """What the ingestion and the retrieval expect of every backend, and of its files once reopened"""
+
+    def open(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path, ignore_errors=True)
+        self.store = self.open()
+        self.store.add(
+            ["a", "b", "c"],
+            ["text a", "text b", "text c"],
+            np.stack([unit(0), unit(1), unit(2, 1)]),
+            [{"file_name": "a.pdf"}, {"file_name": "b.pdf"}, {"file_name": "c.pdf"}],
+        )
+
+    def assertHits(self, hits, ids):
+        self.assertEqual([hit.id for hit in hits], ids)
+
+    def test_query(self):
+        hits = self.store.query(unit(1), k=2)
+        self.assertHits(hits, ["b", "c"])
+        self.assertEqual((hits[0].document, hits[0].metadata), ("text b", {"file_name": "b.pdf"}))
+        self.assertAlmostEqual(hits[0].score, 0, places=2)
+        self.assertHits(self.store.query(unit(1), k=3, where={"file_name": {"$in": ["a.pdf", "c.pdf"]}}), ["c", "a"])
+        self.assertEqual([[hit.id for hit in hits] for hits in self.store.query_many([unit(0), unit(2)], k=1)], [["a"], ["c"]])
+
+    def test_update_and_delete(self):
+        self.assertEqual(self.store.get_existing_ids(["a", "z"]), {"a"})
+        self.store.update_metadatas(["a"], [{"file_name": "z.pdf"}])
+        self.assertEqual(self.store.get_metadatas(["a"]), {"a": {"file_name": "z.pdf"}})
+        self.store.delete(where={"file_name": "z.pdf"})
+        self.store.delete(ids=["b"])
+        self.assertEqual(self.store.count(), 1)
+        self.assertHits(self.store.query(unit(0), k=3), ["c"])
+
+    def test_reopened(self):
+        self.store.update_metadatas(["a"], [{"file_name": "z.pdf"}])
+        # The same vector as b, the PQ codebooks were trained on the first ones
+        self.store.add(["d"], ["text d"], [unit(1)], [{"file_name": "d.pdf"}])
+        reopened = self.open()
+        self.assertEqual(reopened.count(), 4)
+        self.assertEqual({hit.id for hit in reopened.query(unit(1), k=2)}, {"b", "d"})
+        self.assertEqual(reopened.get_metadatas(["a"]), {"a": {"file_name": "z.pdf"}})
+        exported = [chunk_id for ids, _documents, _metadatas, _embeddings in reopened.export(batch_size=3) for chunk_id in ids]
+        self.assertEqual(sorted(exported), ["a", "b", "c", "d"])
+
+
+class ChromaBackendTests(BackendRoundTripMixin, SimpleTestCase):
+    def open(self):
+        return ChromaVectorStore(path=self.path)
+
+
+class Float16BackendTests(BackendRoundTripMixin, SimpleTestCase):
+    def open(self):
+        return QuantizedVectorStore(path=self.path, mode="float16")
+
+
+class Int8BackendTests(BackendRoundTripMixin, SimpleTestCase):
+    def open(self):
+        return QuantizedVectorStore(path=self.path, mode="int8")
+
+
+class ProductQuantizationBackendTests(BackendRoundTripMixin, SimpleTestCase):
+    def open(self):
+        return QuantizedVectorStore(path=self.path, mode="pq", subspaces=4, centroids=4)
+
+
+class FlatBackendTests(BackendRoundTripMixin, SimpleTestCase):
+    def open(self):
+        return FlatVectorStore(path=self.path)
+
+    def manifest(self):
+        with open(os.path.join(self.path, "manifest.json")) as f:
+            return json.load(f)
+
+    def test_adds_append_to_the_generation(self):
+        generation = self.manifest()["generation"]
+        self.store.add(["d"], ["text d"], [unit(3)], [{"file_name": "d.pdf"}])
+        self.store.update_metadatas(["d"], [{"file_name": "e.pdf"}])
+        self.assertEqual((self.manifest()["generation"], self.manifest()["rows"]), (generation, 4))
+
+        # A delete writes the next generation, the previous one is kept for the readers loading it
+        self.store.delete(ids=["a"])
+        self.assertEqual(self.manifest()["generation"], generation + 1)
+        self.store.delete(ids=["b"])
+        self.assertEqual(
+            sorted(name for name in os.listdir(self.path) if name.startswith("vectors")),
+            [f"vectors-{generation + 1}.bin", f"vectors-{generation + 2}.bin"],
+        )
+
+    def test_other_stores_on_the_files_follow_the_changes(self):
+        other = self.open()
+        self.store.add(["d"], ["text d"], [unit(3)], [{"file_name": "d.pdf"}])
+        other.update_metadatas(["a"], [{"file_name": "z.pdf"}])
+        self.assertHits(other.query(unit(3), k=1), ["d"])
+        self.assertEqual(self.store.get_metadatas(["a"]), {"a": {"file_name": "z.pdf"}})
+        other.delete(ids=["d"])
+        self.assertEqual(self.store.count(), 3)
+
+    def test_uncommitted_rows_are_ignored(self):
+        generation = self.manifest()["generation"]
+        # A writer interrupted before its commit
+        with open(os.path.join(self.path, f"vectors-{generation}.bin"), "ab") as f:
+            f.write(np.ones(DIMENSION, dtype=np.float32).tobytes())
+        with open(os.path.join(self.path, f"records-{generation}.jsonl"), "a") as f:
+            f.write('{"id": "x", "document": "lost", "metadata": {}}\n')
+
+        self.assertEqual(self.open().count(), 3)
+        self.store.add(["d"], ["text d"], [unit(3)], [{"file_name": "d.pdf"}])
+        reopened = self.open()
+        self.assertEqual(reopened.get_existing_ids(["x", "d"]), {"d"})
+        self.assertHits(reopened.query(unit(3), k=1), ["d"])
+
+    def test_search_runs_outside_the_lock(self):
+        held = []
+        score = FlatVectorStore._inner_products_many
+
+        def scored(store, queries):
+            held.append(store._lock._is_owned())
+            return score(store, queries)
+
+        with mock.patch.object(FlatVectorStore, "_inner_products_many", scored):
+            self.assertHits(self.store.query(unit(0), k=1), ["a"])
+        self.assertEqual(held, [False])
+
+
+class QuantizationRecallTests(SimpleTestCase):
+    """The quantized stores find most of the 10 closest chunks the exact search finds"""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.vectors = normalize(rng.standard_normal((2000, 64)))
+        self.queries = normalize(self.vectors[:50] + 0.5 * normalize(rng.standard_normal((50, 64))))
+        self.ids = [str(row) for row in range(len(self.vectors))]
+        self.exact = self.top_ids(FlatVectorStore())
+
+    def top_ids(self, store):
+        store.add(self.ids, self.ids, self.vectors)
+        return [{hit.id for hit in hits} for hits in store.query_many(self.queries, k=10)]
+
+    def recall(self, store):
+        found = self.top_ids(store)
+        return np.mean([len(exact & approximate) / 10 for exact, approximate in zip(self.exact, found)])
+
+    def test_float16(self):
+        self.assertGreaterEqual(self.recall(QuantizedVectorStore(mode="float16")), 0.99)
+
+    def test_int8(self):
+        self.assertGreaterEqual(self.recall(QuantizedVectorStore(mode="int8")), 0.95)
+
+    def test_pq(self):
+        self.assertGreaterEqual(self.recall(QuantizedVectorStore(mode="pq", subspaces=16, centroids=64)), 0.4)
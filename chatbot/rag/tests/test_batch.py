@@ -0,0 +1,107 @@
+import json
+import threading
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from ..llm_model import answer_batch
+from ..models import RagFile, RagUser
+from ..vectordb import add_to_chroma
+from .utils import TemporaryIndexMixin, page
+
+
+def echo(prompt, timeout=None):
+    # The answer tells which context the prompt was built with
+    return "travel" if "budget" in prompt else "holidays" if "August" in prompt else "nothing"
+
+
+@override_settings(CONTEXT_COMPRESSION={**settings.CONTEXT_COMPRESSION, "ENABLED": False})
+class QueryBatchTests(TemporaryIndexMixin, TestCase):
+    def setUp(self):
+        self.use_temporary_index()
+        add_to_chroma([page("a.pdf", 0, "The budget for travel is approved.")])
+        add_to_chroma([page("b.pdf", 0, "Holidays are planned in August.")])
+        RagFile.objects.create(file_name="a.pdf")
+        self.b = RagFile.objects.create(file_name="b.pdf")
+        self.client = APIClient()
+        self.client.force_authenticate(RagUser.objects.create_user("alice", password="secret"))
+        patcher = mock.patch("rag.llm_model.llm_gateway.invoke", side_effect=echo)
+        self.invoke = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, data):
+        return self.client.post(reverse("rag:query_batch"), data, format="json")
+
+    def answers(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        return sorted((json.loads(line) for line in lines), key=lambda answer: answer["index"])
+
+    def test_invalid_requests(self):
+        for data, error in [
+            ({}, "A non-empty list of queries is required!"),
+            ({"queries": "travel?"}, "A non-empty list of queries is required!"),
+            ({"queries": ["travel?", " "]}, "Queries must be non-empty strings!"),
+            ({"queries": ["travel?"], "files": [999]}, "Unknown files: [999]"),
+        ]:
+            response = self.post(data)
+            self.assertEqual(response.status_code, 400, data)
+            self.assertEqual(response.json(), {"error": error})
+        with override_settings(RAG_QUERY_BATCH={**settings.RAG_QUERY_BATCH, "MAX_QUERIES": 1}):
+            response = self.post({"queries": ["travel?", "holidays?"]})
+        self.assertEqual(response.json(), {"error": "At most 1 queries can be sent at once!"})
+        self.invoke.assert_not_called()
+
+    def test_answers_are_streamed_one_per_line(self):
+        answers = self.answers(self.post({"queries": ["Is travel approved?", "When are holidays planned?"]}))
+        self.assertEqual(
+            [(answer["index"], answer["query"], answer["response_text"]) for answer in answers],
+            [(0, "Is travel approved?", "travel"), (1, "When are holidays planned?", "holidays")],
+        )
+        self.assertEqual(answers[0]["sources"][0], f"{settings.RAG_MEDIA_URL}a.pdf:1:0")
+
+    def test_answers_are_scoped_to_the_files(self):
+        answers = self.answers(self.post({"queries": ["Is travel approved?"], "files": [self.b.id]}))
+        self.assertEqual(answers[0]["response_text"], "nothing")
+        self.assertEqual(answers[0]["sources"], [])
+
+    def test_failed_answer_is_reported_on_its_line(self):
+        self.invoke.side_effect = lambda prompt, timeout=None: 1 / 0 if "budget" in prompt else echo(prompt)
+        with self.assertLogs("rag.llm_model", "WARNING"):
+            answers = self.answers(self.post({"queries": ["Is travel approved?", "When are holidays planned?"]}))
+        self.assertEqual(answers[0]["error"], "division by zero")
+        self.assertEqual(answers[1]["response_text"], "holidays")
+
+    def test_search_failure_is_an_error_status(self):
+        with mock.patch("rag.llm_model.get_batch_contexts", side_effect=OSError("index unavailable")), \
+                self.assertLogs("rag.views.llm", "ERROR"):
+            response = self.post({"queries": ["Is travel approved?"]})
+        self.assertEqual(response.status_code, 500)
+
+    def test_closing_the_stream_drops_the_questions_not_sent(self):
+        started = []
+        release = threading.Event()
+
+        def slow(prompt, timeout=None):
+            started.append(prompt)
+            if len(started) > 1:
+                release.wait(5)
+            return "answer"
+
+        self.invoke.side_effect = slow
+        contexts = [{"context": "", "sources": []}] * 5
+        answers = answer_batch(["question"] * 5, contexts, max_concurrency=1)
+        next(answers)
+        # The second question is in flight, the other three wait for the thread
+        deadline = time.monotonic() + 5
+        while len(started) < 2 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        answers.close()
+        release.set()
+        time.sleep(0.05)
+        self.assertEqual(len(started), 2)
@@ -0,0 +1,78 @@
+import string
+
+from django.test import SimpleTestCase
+from langchain_core.documents import Document
+from tokenizers import Tokenizer
+from tokenizers.models import WordPiece
+from tokenizers.pre_tokenizers import BertPreTokenizer
+
+from ..vectordb.chunking import TokenChunker, segment_bounds
+
+
+def letter_tokenizer():
+    """One token per letter or punctuation mark, the letters after the first of a word are "##" pieces"""
+    vocab = ["[UNK]"] + list(string.ascii_lowercase + string.punctuation) + [f"##{c}" for c in string.ascii_lowercase]
+    tokenizer = Tokenizer(WordPiece({token: index for index, token in enumerate(vocab)}, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = BertPreTokenizer()
+    return tokenizer
+
+
+class TokenChunkerTests(SimpleTestCase):
+    def pack(self, segments, chunk_tokens=100, overlap_tokens=16):
+        return list(TokenChunker(None, chunk_tokens, overlap_tokens)._pack(segments))
+
+    def split(self, text, chunk_tokens=12, overlap_tokens=4):
+        chunker = TokenChunker(letter_tokenizer(), chunk_tokens, overlap_tokens)
+        return [chunk.page_content for chunk in chunker.split_documents([Document(page_content=text)])]
+
+    def test_whole_segments_fill_the_chunks(self):
+        segments = [(0, 10, 40), (10, 20, 40), (20, 30, 20), (30, 40, 50)]
+        self.assertEqual(self.pack(segments, overlap_tokens=10), [(0, 30), (30, 40)])
+
+    def test_last_segments_start_the_next_chunk(self):
+        segments = [(0, 10, 40), (10, 20, 40), (20, 30, 40), (30, 40, 40)]
+        self.assertEqual(self.pack(segments, overlap_tokens=45), [(0, 20), (10, 30), (20, 40)])
+
+    def test_overlap_leaves_room_for_the_next_segment(self):
+        # Keeping the 40 tokens segment would make the next chunk longer than 100 tokens
+        segments = [(0, 10, 40), (10, 20, 40), (20, 30, 70)]
+        self.assertEqual(self.pack(segments, overlap_tokens=50), [(0, 20), (20, 30)])
+
+    def test_no_segments(self):
+        self.assertEqual(self.pack([]), [])
+
+    def test_sentences_and_paragraphs_are_segments(self):
+        text = 'He said "stop." Then left!\n\nNew paragraph\n\nend'
+        self.assertEqual(
+            [text[start:end] for start, end in segment_bounds(text)],
+            ['He said "stop." ', "Then left!\n\n", "New paragraph\n\n", "end"],
+        )
+
+    def test_chunks_are_cut_at_sentences(self):
+        # 4 tokens per sentence: 2 letters, 1 letter, 1 dot
+        text = "ab c. de f. gh i. jk l. mn o."
+        self.assertEqual(
+            self.split(text, chunk_tokens=12, overlap_tokens=4), ["ab c. de f. gh i.", "gh i. jk l. mn o."]
+        )
+        self.assertEqual(self.split(text, chunk_tokens=8, overlap_tokens=0), ["ab c. de f.", "gh i. jk l.", "mn o."])
+        # The same text always gives the same chunks
+        self.assertEqual(self.split(text), self.split(text))
+
+    def test_long_sentences_are_cut_between_words(self):
+        self.assertEqual(self.split("abc def ghi jkl", chunk_tokens=7, overlap_tokens=0), ["abc def", "ghi jkl"])
+
+    def test_words_longer_than_a_chunk_are_cut(self):
+        self.assertEqual(self.split("abcdefghij", chunk_tokens=4, overlap_tokens=0), ["abcd", "efgh", "ij"])
+
+    def test_metadata_is_copied_to_every_chunk(self):
+        chunker = TokenChunker(letter_tokenizer(), 4, 0)
+        chunks = chunker.split_documents([Document(page_content="ab c. de f.", metadata={"page": 3})])
+        self.assertEqual([chunk.metadata for chunk in chunks], [{"page": 3}, {"page": 3}])
+        chunks[0].metadata["chunk_index"] = 0
+        self.assertEqual(chunks[1].metadata, {"page": 3})
+
+    def test_invalid_sizes(self):
+        with self.assertRaisesMessage(ValueError, "longer than the 384 the model embeds"):
+            TokenChunker(None, chunk_tokens=383)
+        with self.assertRaisesMessage(ValueError, "must be smaller than the chunks"):
+            TokenChunker(None, chunk_tokens=16, overlap_tokens=16)
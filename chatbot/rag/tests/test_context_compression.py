@@ -0,0 +1,66 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+from langchain_core.documents import Document
+
+from ..context_compression import compress_context, count_tokens, record_context_tokens
+from ..tracing import end_trace, get_trace_fields, render_metrics, start_trace
+from .utils import WordEmbeddings
+
+
+class ContextCompressionTests(SimpleTestCase):
+    embeddings = WordEmbeddings()
+
+    def setUp(self):
+        # Tokens counted from the length of the texts, without looking for the tokenizer
+        patcher = mock.patch("rag.context_compression.get_tokenizer", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_closest_sentences_are_kept(self):
+        results = [
+            (Document(page_content="Invoices are paid within thirty days. The office closes at six."), 0.6),
+            (Document(page_content="Parking is free for visitors. Late invoices are paid with interest."), 0.7),
+        ]
+        query = self.embeddings.embed("When are invoices paid?")
+        budget = sum(count_tokens(["Invoices are paid within thirty days.", "Late invoices are paid with interest."]))
+
+        compressed = compress_context(results, query, self.embeddings, token_budget=budget)
+
+        self.assertEqual(
+            [(doc.page_content, score) for doc, score in compressed],
+            [("Invoices are paid within thirty days.", 0.6), ("Late invoices are paid with interest.", 0.7)],
+        )
+
+    def test_single_sentence_chunks_are_scored_by_their_text(self):
+        # The search score of the chunk (a perfect match here) does not decide for its sentence
+        results = [
+            (Document(page_content="Parking is free for visitors."), 0.0),
+            (Document(page_content="Invoices are paid within thirty days. The office closes at six."), 0.6),
+        ]
+        query = self.embeddings.embed("When are invoices paid?")
+        budget = count_tokens(["Invoices are paid within thirty days."])[0]
+
+        compressed = compress_context(results, query, self.embeddings, token_budget=budget)
+
+        self.assertEqual([doc.page_content for doc, _score in compressed], ["Invoices are paid within thirty days."])
+
+    def test_context_within_the_budget_is_kept(self):
+        results = [(Document(page_content="Invoices are paid within thirty days. The office closes at six."), 0.6)]
+        query = self.embeddings.embed("When are invoices paid?")
+        self.assertIs(compress_context(results, query, self.embeddings, token_budget=1000), results)
+
+    def test_saved_tokens_are_named_after_the_embedding_tokenizer(self):
+        start_trace()
+        try:
+            saved = record_context_tokens("x" * 400, "x" * 100)
+            fields = get_trace_fields()
+        finally:
+            end_trace()
+        self.assertEqual(saved, 75)
+        self.assertEqual(fields, {
+            "context_embedding_tokens_retrieved": 100,
+            "context_embedding_tokens_kept": 25,
+            "context_embedding_tokens_saved": 75,
+        })
+        self.assertIn('rag_context_embedding_tokens_count{pid=', render_metrics())
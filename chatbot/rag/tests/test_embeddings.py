@@ -0,0 +1,118 @@
+import threading
+import time
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from ..vectordb.embeddings import EmbeddingScheduler
+
+
+class RecordingEncoder:
+    """Encodes "1.5" as [1.5], records the batches and blocks until `release` is set"""
+
+    def __init__(self):
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        self.started.set()
+        self.release.wait(5)
+        if "fail" in texts:
+            raise ValueError("cannot encode")
+        return np.array([[float(text)] for text in texts], dtype=np.float32)
+
+
+class EmbeddingSchedulerTests(SimpleTestCase):
+    def embed_in_threads(self, scheduler, submissions):
+        results = [None] * len(submissions)
+
+        def embed(index, texts):
+            try:
+                results[index] = scheduler.embed(texts)
+            except Exception as e:
+                results[index] = e
+
+        threads = [threading.Thread(target=embed, args=item) for item in enumerate(submissions)]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def wait_for_queue(self, scheduler, size):
+        deadline = time.monotonic() + 5
+        while scheduler._queue.qsize() < size and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(scheduler._queue.qsize(), size)
+
+    def test_lone_text_does_not_wait(self):
+        encoder = RecordingEncoder()
+        scheduler = EmbeddingScheduler(encoder, max_batch=8, max_wait=5)
+        started = time.perf_counter()
+        np.testing.assert_array_equal(scheduler.embed(["1"]), [[1]])
+        self.assertLess(time.perf_counter() - started, 1)
+
+    def test_queued_texts_are_encoded_together(self):
+        encoder = RecordingEncoder()
+        encoder.release.clear()
+        scheduler = EmbeddingScheduler(encoder, max_batch=8, max_wait=0.05)
+        first, _ = self.embed_in_threads(scheduler, [["0"]])
+        encoder.started.wait(5)
+        # Submitted while the first batch is encoded
+        threads, results = self.embed_in_threads(scheduler, [["1", "2"], ["3"], ["4", "5", "6"]])
+        self.wait_for_queue(scheduler, 3)
+        encoder.release.set()
+        for thread in first + threads:
+            thread.join()
+
+        self.assertEqual(len(encoder.batches), 2)
+        self.assertEqual(sorted(encoder.batches[1]), ["1", "2", "3", "4", "5", "6"])
+        for texts, vectors in zip([["1", "2"], ["3"], ["4", "5", "6"]], results):
+            np.testing.assert_array_equal(vectors, [[float(text)] for text in texts])
+
+    def test_batches_stop_at_max_batch(self):
+        encoder = RecordingEncoder()
+        encoder.release.clear()
+        scheduler = EmbeddingScheduler(encoder, max_batch=3, max_wait=0.05)
+        first, _ = self.embed_in_threads(scheduler, [["0"]])
+        encoder.started.wait(5)
+        threads, results = self.embed_in_threads(scheduler, [["1", "2"], ["3", "4"], ["5", "6", "7", "8"]])
+        self.wait_for_queue(scheduler, 3)
+        encoder.release.set()
+        for thread in first + threads:
+            thread.join()
+
+        # A submission larger than max_batch is encoded on its own
+        self.assertEqual(sorted(map(len, encoder.batches[1:])), [2, 2, 4])
+        self.assertEqual(sorted(text for batch in encoder.batches for text in batch), [str(n) for n in range(9)])
+        np.testing.assert_array_equal(results[2], [[5], [6], [7], [8]])
+
+    def test_errors_reach_every_caller_of_the_batch(self):
+        encoder = RecordingEncoder()
+        encoder.release.clear()
+        scheduler = EmbeddingScheduler(encoder, max_batch=8, max_wait=0.05)
+        first, _ = self.embed_in_threads(scheduler, [["0"]])
+        encoder.started.wait(5)
+        threads, results = self.embed_in_threads(scheduler, [["fail"], ["1"]])
+        self.wait_for_queue(scheduler, 2)
+        encoder.release.set()
+        for thread in first + threads:
+            thread.join()
+
+        self.assertIsInstance(results[0], ValueError)
+        self.assertIsInstance(results[1], ValueError)
+        # The scheduler keeps running
+        np.testing.assert_array_equal(scheduler.embed(["2"]), [[2]])
+
+    def test_initializer_runs_on_the_encoding_thread(self):
+        threads = []
+        encoder = RecordingEncoder()
+        scheduler = EmbeddingScheduler(
+            lambda texts: threads.append(threading.current_thread()) or encoder(texts),
+            initializer=lambda: threads.append(threading.current_thread()),
+        )
+        scheduler.embed(["1"])
+        self.assertEqual(len(threads), 2)
+        self.assertIs(threads[0], threads[1])
+        self.assertIsNot(threads[0], threading.current_thread())
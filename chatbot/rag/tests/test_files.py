@@ -0,0 +1,60 @@
+import hashlib
+import os
+from importlib import import_module
+
+from django.apps import apps
+from django.conf import settings
+from django.test import TestCase
+
+from ..models import RagFile
+from .utils import TemporaryIndexMixin
+
+
+def sha256(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+class RagFileTests(TemporaryIndexMixin, TestCase):
+    def setUp(self):
+        self.use_temporary_index()
+        RagFile.objects.create(file_name="report.pdf", file_hash=sha256(b"report"))
+
+    def write(self, file_name, content):
+        with open(os.path.join(settings.DATA_PATH, file_name), "wb") as f:
+            f.write(content)
+
+    def test_find_existing_by_name_or_content(self):
+        uploads = [
+            ("report.pdf", sha256(b"new report")),
+            ("copy.pdf", sha256(b"report")),
+            ("notes.pdf", sha256(b"notes")),
+        ]
+        self.assertEqual(RagFile.find_existing(uploads), set(uploads[:2]))
+
+    def test_find_existing_keeps_uploads_of_the_same_name_apart(self):
+        # Two uploads named alike in one request, only the one with a known content is a duplicate
+        uploads = [("notes.pdf", sha256(b"notes")), ("notes.pdf", sha256(b"report"))]
+        self.assertEqual(RagFile.find_existing(uploads), {("notes.pdf", sha256(b"report"))})
+
+    def test_sync_hashes_files_copied_by_hand(self):
+        self.write("report.pdf", b"report")
+        self.write("manual.pdf", b"manual")
+        self.write("uploaded.pdf", b"uploaded")
+
+        new_files = RagFile.sync_rag_files(None, {"uploaded.pdf": "known hash"})
+
+        self.assertEqual(new_files, ["manual.pdf", "uploaded.pdf"])
+        self.assertEqual(
+            dict(RagFile.objects.values_list("file_name", "file_hash")),
+            {"report.pdf": sha256(b"report"), "manual.pdf": sha256(b"manual"), "uploaded.pdf": "known hash"},
+        )
+
+    def test_backfill_migration_hashes_files_without_hash(self):
+        RagFile.objects.create(file_name="old.pdf")
+        RagFile.objects.create(file_name="missing.pdf")
+        self.write("old.pdf", b"old")
+
+        import_module("rag.migrations.0006_backfill_ragfile_hash").backfill_file_hashes(apps, None)
+
+        self.assertEqual(RagFile.objects.get(file_name="old.pdf").file_hash, sha256(b"old"))
+        self.assertIsNone(RagFile.objects.get(file_name="missing.pdf").file_hash)
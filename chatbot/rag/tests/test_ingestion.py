@@ -0,0 +1,132 @@
+import os
+from contextlib import contextmanager
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase
+
+from matching.elastic_search import live_search_index, search_content, setup_elasticsearch
+from ..ingestion import ingest_files, ingestion_lock
+from ..models import ChunkLocation, RagFile
+from ..vectordb import get_vector_store
+from ..vectordb.backends import activate_index_version, index_root, new_index_version
+from .utils import StubElasticsearchMixin, TemporaryIndexMixin, write_pdf
+
+FILES = {
+    "a.pdf": ["The budget for travel is approved."],
+    "b.pdf": ["Holidays are planned in August.", "The office is closed in August."],
+}
+
+
+def stored_files(store):
+    return {metadata["file_name"] for _ids, _documents, metadatas, _embeddings in store.export() for metadata in metadatas}
+
+
+class IngestCommandTests(TemporaryIndexMixin, TestCase):
+    def setUp(self):
+        self.use_temporary_index()
+        self.source = os.path.join(self.root, "source")
+        os.makedirs(self.source)
+        for name, pages in FILES.items():
+            write_pdf(os.path.join(self.source, name), pages)
+
+    def ingest(self, *args):
+        out = StringIO()
+        call_command("ingest", self.source, "--workers", "1", "--no-search", *args, stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_files_are_registered_and_stored(self):
+        self.assertIn("2 new files", self.ingest())
+        self.assertEqual(
+            dict(RagFile.objects.values_list("file_name", "file_hash")),
+            {name: mock.ANY for name in FILES},
+        )
+        self.assertTrue(all(RagFile.objects.values_list("file_hash", flat=True)))
+        self.assertEqual(sorted(os.listdir(settings.DATA_PATH)), sorted(FILES))
+        self.assertEqual(stored_files(get_vector_store()), set(FILES))
+        self.assertEqual(set(ChunkLocation.objects.values_list("file_name", flat=True)), set(FILES))
+        self.assertFalse(os.path.exists(os.path.join(settings.CHROMA_PATH, "ingest-checkpoint.json")))
+
+        self.assertIn("0 new files, 2 already known", self.ingest())
+
+    def test_every_batch_is_stored_in_the_live_version(self):
+        entered = []
+
+        @contextmanager
+        def switching_lock():
+            # A rebuild makes a new version live between the two batches
+            if entered:
+                activate_index_version(new_index_version())
+            entered.append(index_root())
+            with ingestion_lock():
+                yield
+
+        first_root = index_root()
+        with mock.patch("rag.ingestion.ingestion_lock", switching_lock):
+            self.ingest("--batch-size", "1")
+
+        self.assertEqual(len(entered), 2)
+        self.assertNotEqual(index_root(), first_root)
+        self.assertEqual(stored_files(get_vector_store()), {"b.pdf"})
+
+    def test_other_ingestions_only_lock_when_live(self):
+        write_pdf(os.path.join(settings.DATA_PATH, "a.pdf"), FILES["a.pdf"])
+        store = get_vector_store()
+        with mock.patch("rag.ingestion.ingestion_lock") as lock:
+            ingest_files([os.path.join(settings.DATA_PATH, "a.pdf")], {"a.pdf": "hash"}, store=store,
+                         index_search=False)
+        lock.assert_not_called()
+        self.assertEqual(stored_files(store), {"a.pdf"})
+
+
+class RebuildIndexesTests(StubElasticsearchMixin, TemporaryIndexMixin, TestCase):
+    def setUp(self):
+        self.use_temporary_index()
+        self.use_stub_elasticsearch()
+        self.assertTrue(setup_elasticsearch())
+        source = os.path.join(self.root, "source")
+        os.makedirs(source)
+        for name, pages in FILES.items():
+            write_pdf(os.path.join(source, name), pages)
+        call_command("ingest", source, "--workers", "1", stdout=StringIO())
+
+    def rebuild(self, *args):
+        call_command("rebuild_indexes", "--workers", "1", *args, stdout=StringIO())
+
+    def search(self, text):
+        return {result["filename"] for result in search_content(text, RequestFactory().get("/"))}
+
+    def test_rebuild_switches_to_the_new_versions(self):
+        root, search_index = index_root(), live_search_index()
+        self.assertEqual(self.search("August"), {"b.pdf"})
+
+        self.rebuild()
+
+        self.assertNotEqual(index_root(), root)
+        self.assertTrue(os.path.basename(index_root()).startswith("v"))
+        self.assertNotEqual(live_search_index(), search_index)
+        self.assertEqual(stored_files(get_vector_store()), set(FILES))
+        self.assertEqual(set(ChunkLocation.objects.values_list("file_name", flat=True)), set(FILES))
+        self.assertEqual(self.search("August"), {"b.pdf"})
+
+    def test_files_changed_during_the_rebuild_are_caught_up(self):
+        from rag.management.commands import rebuild_indexes
+
+        def upload_and_delete_after_first_pass(*args, **kwargs):
+            result = ingest_files(*args, **kwargs)
+            if not os.path.exists(os.path.join(settings.DATA_PATH, "c.pdf")):
+                write_pdf(os.path.join(settings.DATA_PATH, "c.pdf"), ["Parking is free in December."])
+                os.remove(os.path.join(settings.DATA_PATH, "a.pdf"))
+                RagFile.objects.filter(file_name="a.pdf").delete()
+            return result
+
+        with mock.patch.object(rebuild_indexes, "ingest_files", side_effect=upload_and_delete_after_first_pass):
+            self.rebuild()
+
+        self.assertEqual(stored_files(get_vector_store()), {"b.pdf", "c.pdf"})
+        self.assertEqual(set(ChunkLocation.objects.values_list("file_name", flat=True)), {"b.pdf", "c.pdf"})
+        self.assertEqual(set(RagFile.objects.values_list("file_name", flat=True)), {"b.pdf", "c.pdf"})
+        self.assertEqual(self.search("budget"), set())
+        self.assertEqual(self.search("December"), {"c.pdf"})
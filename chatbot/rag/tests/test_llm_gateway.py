@@ -0,0 +1,123 @@
+import threading
+import time
+
+from django.test import SimpleTestCase
+
+from ..llm_gateway import LLMError, LLMGateway, LLMTimeout
+
+
+class BlockingLLM:
+    """Answers once `release` is set, counting the calls"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def invoke(self, prompt):
+        with self.lock:
+            self.calls += 1
+        self.release.wait(5)
+        return f"answer to {prompt}"
+
+
+class LLMGatewayTests(SimpleTestCase):
+    def wait_for_calls(self, llm, calls):
+        deadline = time.monotonic() + 5
+        while llm.calls < calls and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(llm.calls, calls)
+
+    def test_calls_beyond_the_slots_time_out(self):
+        llm = BlockingLLM()
+        gateway = LLMGateway(lambda: llm, max_in_flight=1, timeout=5, retries=0)
+        first = threading.Thread(target=gateway.invoke, args=("first",))
+        first.start()
+        self.wait_for_calls(llm, 1)
+
+        with self.assertRaisesMessage(LLMTimeout, "Too many LLM calls in flight"):
+            gateway.invoke("second", timeout=0.05)
+
+        llm.release.set()
+        first.join()
+        # The slot is free again
+        self.assertEqual(gateway.invoke("third"), "answer to third")
+        self.assertEqual(llm.calls, 2)
+
+    def test_abandoned_call_keeps_its_slot_until_it_ends(self):
+        llm = BlockingLLM()
+        gateway = LLMGateway(lambda: llm, max_in_flight=1, timeout=5, retries=0)
+        with self.assertRaisesMessage(LLMTimeout, "The LLM did not answer in time"):
+            gateway.invoke("slow", timeout=0.05)
+        with self.assertRaisesMessage(LLMTimeout, "Too many LLM calls in flight"):
+            gateway.invoke("next", timeout=0.05)
+        llm.release.set()
+        self.assertEqual(gateway.invoke("next"), "answer to next")
+
+    def test_identical_prompts_are_sent_once(self):
+        class LookupCounter(dict):
+            lookups = 0
+
+            def get(self, key, default=None):
+                self.lookups += 1
+                return super().get(key, default)
+
+        llm = BlockingLLM()
+        gateway = LLMGateway(lambda: llm, max_in_flight=4, timeout=5, retries=0)
+        gateway._in_flight = LookupCounter()
+        answers = []
+
+        def ask():
+            answers.append(gateway.invoke("same prompt"))
+
+        threads = [threading.Thread(target=ask) for _ in range(3)]
+        threads[0].start()
+        self.wait_for_calls(llm, 1)
+        for thread in threads[1:]:
+            thread.start()
+        # The others found the call of the first one in flight
+        deadline = time.monotonic() + 5
+        while gateway._in_flight.lookups < 3 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        llm.release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(answers, ["answer to same prompt"] * 3)
+        self.assertEqual(llm.calls, 1)
+        # Once answered, the prompt is sent again
+        self.assertEqual(gateway.invoke("same prompt"), "answer to same prompt")
+        self.assertEqual(llm.calls, 2)
+
+    def test_failed_calls_are_retried(self):
+        class FlakyLLM:
+            calls = 0
+
+            def invoke(self, prompt):
+                self.calls += 1
+                if self.calls == 1:
+                    raise ConnectionError("reset by peer")
+                return "answer"
+
+        llm = FlakyLLM()
+        gateway = LLMGateway(lambda: llm, timeout=5, retries=1, backoff_base=0)
+        with self.assertLogs("rag.llm_gateway", "WARNING"):
+            self.assertEqual(gateway.invoke("prompt"), "answer")
+        self.assertEqual(llm.calls, 2)
+
+    def test_client_errors_are_not_retried(self):
+        class BadRequest(Exception):
+            response = type("Response", (), {"status_code": 400})()
+
+        class RejectingLLM:
+            calls = 0
+
+            def invoke(self, prompt):
+                self.calls += 1
+                raise BadRequest("prompt too long")
+
+        llm = RejectingLLM()
+        gateway = LLMGateway(lambda: llm, timeout=5, retries=3, backoff_base=0)
+        with self.assertRaisesMessage(LLMError, "prompt too long"):
+            gateway.invoke("prompt")
+        self.assertEqual(llm.calls, 1)
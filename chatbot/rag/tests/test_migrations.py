@@ -0,0 +1,73 @@
+import hashlib
+import os
+from importlib import import_module
+
+from django.apps import apps
+from django.conf import settings
+from django.test import TestCase
+
+from ..models import ChunkLocation
+from ..vectordb import content_hash
+from .utils import TemporaryIndexMixin
+
+URL = "http://127.0.0.1:8000/media/rag_database/"
+
+
+class ChromaMigrationTests(TemporaryIndexMixin, TestCase):
+    """The data migrations of the Chroma collection written before the file metadata and the hash IDs"""
+
+    def setUp(self):
+        self.use_temporary_index()
+        import chromadb
+
+        self.client = chromadb.PersistentClient(path=settings.CHROMA_PATH)
+        self.collection = self.client.create_collection("langchain")
+
+    def migrate(self, name, function):
+        getattr(import_module(f"rag.migrations.{name}"), function)(apps, None)
+
+    def test_file_metadata_backfill(self):
+        with open(os.path.join(settings.DATA_PATH, "a.pdf"), "wb") as f:
+            f.write(b"pdf")
+        self.collection.add(
+            ids=[f"{URL}a.pdf:1:0", f"{URL}b.pdf:1:0"],
+            documents=["first", "second"],
+            embeddings=[[1.0, 0.0], [0.0, 1.0]],
+            metadatas=[{"source": f"{URL}a.pdf", "page": 0}, {"source": f"{URL}b.pdf", "page": 0}],
+        )
+
+        self.migrate("0003_backfill_chunk_file_metadata", "backfill_chunk_file_metadata")
+
+        metadatas = self.collection.get(ids=[f"{URL}a.pdf:1:0", f"{URL}b.pdf:1:0"], include=["metadatas"])["metadatas"]
+        self.assertEqual([metadata["file_name"] for metadata in metadatas], ["a.pdf", "b.pdf"])
+        self.assertEqual([metadata["file_hash"] for metadata in metadatas], [hashlib.sha256(b"pdf").hexdigest(), ""])
+
+    def test_legacy_ids_are_keyed_by_content_hash(self):
+        shared = "Confidential,  do not\ndistribute."
+        self.collection.add(
+            ids=[f"{URL}a.pdf:1:0", f"{URL}a.pdf:2:0", f"{URL}b.pdf:1:3"],
+            documents=[shared, "Only in a.", shared],
+            embeddings=[[1.0, 0.0], [0.0, 1.0], [0.6, 0.8]],
+            metadatas=[{"source": f"{URL}a.pdf", "file_name": "a.pdf", "page": 0}, {"source": f"{URL}a.pdf", "page": 1},
+                       {"source": f"{URL}b.pdf", "page": 0}],
+        )
+        ChunkLocation.objects.create(content_hash="0" * 64, file_name="a.pdf", page=9, chunk_index=0)
+
+        self.migrate("0007_rekey_legacy_chunks", "rekey_legacy_chunks")
+
+        stored = self.collection.get(include=["metadatas", "embeddings"])
+        shared_hash, only_hash = content_hash(shared), content_hash("Only in a.")
+        self.assertEqual(sorted(stored["ids"]), sorted([shared_hash, only_hash]))
+        rows = dict(zip(stored["ids"], zip(stored["metadatas"], stored["embeddings"])))
+        # The first copy is kept with its vector, nothing is embedded again
+        metadata, embedding = rows[shared_hash]
+        self.assertEqual(list(embedding), [1.0, 0.0])
+        self.assertEqual((metadata["file_name"], metadata["content_hash"]), ("a.pdf", shared_hash))
+        self.assertEqual(
+            sorted(ChunkLocation.objects.values_list("file_name", "page", "chunk_index", "content_hash")),
+            [("a.pdf", 1, 0, shared_hash), ("a.pdf", 2, 0, only_hash), ("b.pdf", 1, 3, shared_hash)],
+        )
+
+        # Nothing left to migrate the second time
+        self.migrate("0007_rekey_legacy_chunks", "rekey_legacy_chunks")
+        self.assertEqual(ChunkLocation.objects.count(), 3)
@@ -0,0 +1,131 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from io import StringIO
+from unittest import mock
+
+import numpy as np
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase
+
+from ..ingestion import ingestion_lock
+from ..vectordb import add_to_chroma, get_vector_store
+from ..vectordb.backends import activate_index_version, copy_vector_store, index_root, open_vector_store
+from ..vectordb.projection import PROJECTION_FILE, Projection, copy_projection
+from .utils import TemporaryIndexMixin, page
+
+
+def normalized(vectors):
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def subspace_vectors(count, dimension=64, rank=8, seed=0):
+    """Unit vectors spanning a random `rank` dimensional subspace"""
+    rng = np.random.default_rng(seed)
+    basis = rng.standard_normal((rank, dimension))
+    return normalized(rng.standard_normal((count, rank)) @ basis).astype(np.float32)
+
+
+class ProjectionTests(SimpleTestCase):
+    def test_pca_keeps_the_subspace_of_the_sample(self):
+        vectors = subspace_vectors(300)
+        projection = Projection.fit("pca", vectors[:200], 8)
+        self.assertEqual(projection.components.shape, (8, 64))
+        self.assertGreater(projection.kept_energy(vectors[200:]), 0.999)
+
+        reduced = projection.apply(vectors)
+        self.assertEqual(reduced.shape, (300, 8))
+        np.testing.assert_allclose(np.linalg.norm(reduced, axis=1), 1, rtol=1e-5)
+        # The inner products, and so the neighbours, are those of the full vectors
+        np.testing.assert_allclose(reduced[200:] @ reduced[:200].T, vectors[200:] @ vectors[:200].T, atol=1e-4)
+
+    def test_matryoshka_keeps_the_prefix(self):
+        vectors = subspace_vectors(10)
+        projection = Projection.fit("matryoshka", vectors, 16)
+        self.assertIsNone(projection.kept_energy(vectors))
+        np.testing.assert_allclose(projection.apply(vectors), normalized(vectors[:, :16]), rtol=1e-5)
+        np.testing.assert_allclose(projection.apply(vectors[0]), normalized(vectors[0, :16]), rtol=1e-5)
+
+    def test_invalid_projections(self):
+        vectors = subspace_vectors(10)
+        with self.assertRaisesMessage(ValueError, "Unknown projection method: svd"):
+            Projection.fit("svd", vectors, 4)
+        with self.assertRaisesMessage(ValueError, "Cannot reduce 64 dimensions to 64"):
+            Projection.fit("matryoshka", vectors, 64)
+        with self.assertRaisesMessage(ValueError, "needs at least as many vectors, got 10"):
+            Projection.fit("pca", vectors, 16)
+
+    def test_saved_with_the_index(self):
+        vectors = subspace_vectors(100)
+        projection = Projection.fit("pca", vectors, 8)
+        root, copy = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.assertIsNone(Projection.load(root))
+        projection.save(root)
+        self.assertEqual(os.listdir(root), [PROJECTION_FILE])
+
+        self.assertTrue(copy_projection(root, copy))
+        loaded = Projection.load(copy)
+        self.assertEqual((loaded.method, loaded.input_dimension, loaded.dimensions), ("pca", 64, 8))
+        np.testing.assert_array_equal(loaded.apply(vectors), projection.apply(vectors))
+        self.assertFalse(copy_projection(tempfile.mkdtemp(), copy))
+
+    def test_stores_of_the_index_reduce_their_vectors(self):
+        vectors = subspace_vectors(20)
+        root = tempfile.mkdtemp()
+        Projection.fit("pca", vectors, 8).save(root)
+        store = open_vector_store("flat", root)
+        store.add([f"id{n}" for n in range(20)], ["text"] * 20, vectors)
+
+        (_ids, _documents, _metadatas, stored), = store.export()
+        self.assertEqual(stored.shape, (20, 8))
+        self.assertEqual([hit.id for hit in store.query(vectors[3], k=1)], ["id3"])
+        with self.assertRaisesMessage(ValueError, "Vectors of 32 dimensions"):
+            store.query(vectors[3, :32])
+
+
+class ReduceVectorsTests(TemporaryIndexMixin, TestCase):
+    def setUp(self):
+        self.use_temporary_index()
+        add_to_chroma([page("a.pdf", 0, "The budget for travel is approved."), page("a.pdf", 1, "Travel by train.")])
+        add_to_chroma([page("b.pdf", 0, "Holidays are planned in August."), page("b.pdf", 1, "The office is closed.")])
+        add_to_chroma([page("c.pdf", 0, "Parking is free in December."), page("c.pdf", 1, "Lunch is served at noon.")])
+
+    def reduce(self, *args):
+        call_command("reduce_vectors", "--dimensions", "4", *args, stdout=StringIO())
+
+    def search(self, text):
+        return get_vector_store().similarity_search_with_score(text, k=1)[0][0].metadata["file_name"]
+
+    def test_new_version_holds_the_reduced_vectors(self):
+        root = index_root()
+        count = get_vector_store().count()
+        self.reduce()
+
+        self.assertNotEqual(index_root(), root)
+        store = get_vector_store()
+        self.assertEqual(store.projection.dimensions, 4)
+        self.assertEqual(store.count(), count)
+        (_ids, _documents, _metadatas, stored), = store.export()
+        self.assertEqual(stored.shape, (count, 4))
+        self.assertEqual(self.search("holidays in August"), "b.pdf")
+
+        with self.assertRaisesMessage(CommandError, "already reduced to 4 dimensions (pca)"):
+            self.reduce()
+
+    def test_uploads_wait_until_the_new_version_is_live(self):
+        events = []
+
+        @contextmanager
+        def recording_lock():
+            with ingestion_lock():
+                events.append("locked")
+                yield
+                events.append("unlocked")
+
+        copy = mock.Mock(side_effect=lambda *args: events.append("copy") or copy_vector_store(*args))
+        activate = mock.Mock(side_effect=lambda version: events.append("activate") or activate_index_version(version))
+        with mock.patch("rag.management.commands.reduce_vectors.ingestion_lock", recording_lock), \
+                mock.patch("rag.management.commands.reduce_vectors.copy_vector_store", copy), \
+                mock.patch("rag.management.commands.reduce_vectors.activate_index_version", activate):
+            self.reduce()
+        self.assertEqual(events, ["locked", "copy", "activate", "unlocked"])
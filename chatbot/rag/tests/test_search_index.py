@@ -0,0 +1,74 @@
+from django.test import RequestFactory, SimpleTestCase
+
+from matching.elastic_search import (
+    INDEX_PREFIX, READ_ALIAS, WRITE_ALIAS, bulk_index_pages, create_search_index, finish_search_index,
+    get_elasticsearch_client, live_search_index, prune_search_indexes, resumable_search_index, search_content,
+    search_index_versions, setup_elasticsearch, switch_aliases,
+)
+from .utils import StubElasticsearchMixin
+
+
+class SearchIndexVersionTests(StubElasticsearchMixin, SimpleTestCase):
+    def setUp(self):
+        self.server = self.use_stub_elasticsearch()
+
+    def search(self, text):
+        return {result["filename"] for result in search_content(text, RequestFactory().get("/"))}
+
+    def index_settings(self, name):
+        return get_elasticsearch_client().indices.get_settings(index=name)[name]["settings"]["index"]
+
+    def test_setup_creates_the_first_version_behind_both_aliases(self):
+        self.assertTrue(setup_elasticsearch())
+        (name, aliases), = search_index_versions().items()
+        self.assertTrue(name.startswith(f"{INDEX_PREFIX}-v"))
+        self.assertEqual(aliases, {READ_ALIAS, WRITE_ALIAS})
+        # Run again, it keeps the live version
+        self.assertTrue(setup_elasticsearch())
+        self.assertEqual(list(search_index_versions()), [name])
+
+    def test_setup_adopts_the_index_made_before_the_aliases(self):
+        get_elasticsearch_client().indices.create(index=INDEX_PREFIX)
+        self.assertTrue(setup_elasticsearch())
+        self.assertEqual(search_index_versions(), {INDEX_PREFIX: {READ_ALIAS, WRITE_ALIAS}})
+
+    def test_new_version_is_loaded_aside_then_swapped_in(self):
+        setup_elasticsearch()
+        live = live_search_index()
+        bulk_index_pages([("a.pdf", 1, "The budget for travel is approved.")])
+
+        new = create_search_index(bulk=True)
+        self.assertEqual(self.index_settings(new)["number_of_replicas"], "0")
+        self.assertEqual(self.index_settings(new)["refresh_interval"], "-1")
+        bulk_index_pages([("b.pdf", 1, "Holidays are planned in August.")], index=new, replace=False)
+        self.assertEqual(resumable_search_index(), new)
+        # Searches and uploads still go to the live version
+        self.assertEqual(self.search("August"), set())
+        self.assertEqual(self.search("budget"), {"a.pdf"})
+
+        finish_search_index(new)
+        self.assertNotIn("refresh_interval", self.index_settings(new))
+        switch_aliases(new)
+
+        self.assertEqual(search_index_versions(), {live: set(), new: {READ_ALIAS, WRITE_ALIAS}})
+        self.assertEqual(live_search_index(), new)
+        self.assertIsNone(resumable_search_index())
+        self.assertEqual(self.search("August"), {"b.pdf"})
+        self.assertEqual(self.search("budget"), set())
+        bulk_index_pages([("c.pdf", 1, "Parking is free in December.")])
+        self.assertEqual(self.search("December"), {"c.pdf"})
+
+    def test_old_versions_are_kept_for_rollback(self):
+        setup_elasticsearch()
+        first = live_search_index()
+        second = create_search_index()
+        switch_aliases(second)
+        third = create_search_index()
+        switch_aliases(third)
+
+        self.assertEqual(prune_search_indexes(keep=1), [first])
+        self.assertEqual(list(search_index_versions()), [second, third])
+        # Rolling back is switching the aliases again
+        switch_aliases(second)
+        self.assertEqual(live_search_index(), second)
+        self.assertEqual(prune_search_indexes(keep=0), [])
@@ -0,0 +1,97 @@
+import os
+import threading
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from ..vectordb.service import RemoteVectorStore, RetrievalServer, RetrievalService, RetrievalServiceError
+from .utils import TemporaryIndexMixin
+
+
+class RetrievalServiceTests(TemporaryIndexMixin, SimpleTestCase):
+    def setUp(self):
+        self.use_temporary_index()
+        service = RetrievalService("flat", max_wait_ms=0)
+        self.socket_path = os.path.join(self.root, "retrieval.sock")
+        self.start_server(service)
+        self.remote = RemoteVectorStore(self.socket_path, timeout=5)
+
+    def start_server(self, service):
+        server = RetrievalServer(self.socket_path, service)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def add(self, texts):
+        ids = [f"id-{text}" for text in texts]
+        vectors = self.remote.embedding_function.embed_documents(texts)
+        self.remote.add(ids, texts, vectors, [{"file_name": f"{text}.pdf"} for text in texts])
+        return ids
+
+    def test_embeddings_are_computed_by_the_service(self):
+        texts = ["travel budget", "holidays in August"]
+        np.testing.assert_allclose(self.remote.embedding_function.embed_queries(texts), self.embeddings.encode(texts))
+        np.testing.assert_allclose(self.remote.embedding_function.embed_documents(texts), self.embeddings.encode(texts))
+
+    def test_round_trip(self):
+        self.add(["travel budget", "holidays in August", "parking in December"])
+        self.assertEqual(self.remote.count(), 3)
+
+        (hit,), = self.remote.query_many(self.embeddings.encode(["travel budget"]), k=1)
+        self.assertEqual(
+            (hit.id, hit.document, hit.metadata), ("id-travel budget", "travel budget", {"file_name": "travel budget.pdf"})
+        )
+        self.assertAlmostEqual(hit.score, 0, places=5)
+        (hit,), = self.remote.query_many(
+            self.embeddings.encode(["travel budget"]), k=1, where={"file_name": "parking in December.pdf"}
+        )
+        self.assertEqual(hit.id, "id-parking in December")
+
+        self.assertEqual(self.remote.get_existing_ids(["id-travel budget", "unknown"]), {"id-travel budget"})
+        self.remote.update_metadatas(["id-travel budget"], [{"file_name": "other.pdf"}])
+        self.assertEqual(
+            self.remote.get_metadatas(["id-travel budget"]), {"id-travel budget": {"file_name": "other.pdf"}}
+        )
+        self.remote.delete(where={"file_name": "other.pdf"})
+        self.remote.delete(ids=["id-holidays in August"])
+        self.assertEqual(self.remote.count(), 1)
+
+    def test_export_streams_every_batch(self):
+        texts = [f"text {number}" for number in range(5)]
+        ids = self.add(texts)
+
+        batches = list(self.remote.export(batch_size=2))
+
+        self.assertEqual([len(batch_ids) for batch_ids, _documents, _metadatas, _embeddings in batches], [2, 2, 1])
+        exported_ids = [chunk_id for batch in batches for chunk_id in batch[0]]
+        self.assertEqual(sorted(exported_ids), sorted(ids))
+        embeddings = np.concatenate([batch[3] for batch in batches])
+        exported_texts = [chunk_id.removeprefix("id-") for chunk_id in exported_ids]
+        np.testing.assert_allclose(embeddings, self.embeddings.encode(exported_texts), atol=1e-6)
+
+    def test_stopped_export_leaves_the_service_usable(self):
+        self.add([f"text {number}" for number in range(5)])
+        export = self.remote.export(batch_size=1)
+        next(export)
+        # Other calls of the thread run between the batches
+        self.assertEqual(self.remote.count(), 5)
+        export.close()
+        # The batches left unread released the store for the writes
+        self.add(["more text"])
+        self.assertEqual(self.remote.count(), 6)
+        self.assertEqual(sum(len(batch[0]) for batch in self.remote.export()), 6)
+
+    def test_errors_are_raised_to_the_client(self):
+        with self.assertLogs("rag.vectordb.service", "ERROR"):
+            with self.assertRaisesMessage(RetrievalServiceError, "Unknown operation: missing"):
+                self.remote.call("missing")
+        # The connection is still usable
+        self.assertEqual(self.remote.count(), 0)
+
+    def test_unreachable_service(self):
+        remote = RemoteVectorStore(os.path.join(self.root, "missing.sock"), timeout=1)
+        with self.assertRaises(RetrievalServiceError):
+            remote.count()
+        with self.assertRaises(RetrievalServiceError):
+            list(remote.export())
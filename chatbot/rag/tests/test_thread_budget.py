@@ -0,0 +1,84 @@
+import os
+import sys
+import threading
+from unittest import mock
+
+import numpy as np
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+from .. import thread_budget
+from ..vectordb.embeddings import BaseEmbeddingWrapper
+
+
+def threads_setting(**options):
+    return override_settings(EMBEDDING_THREADS={**settings.EMBEDDING_THREADS, **options})
+
+
+class LaneRecordingEmbeddings(BaseEmbeddingWrapper):
+    """Records the thread and the lane every batch is encoded in"""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def encode(self, texts):
+        self.calls.append((threading.current_thread(), thread_budget.current_lane()))
+        return np.zeros((len(texts), 2), dtype=np.float32)
+
+
+class ThreadBudgetTests(SimpleTestCase):
+    def in_thread(self, function, *args):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(function(*args)))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    @mock.patch("rag.thread_budget.cpu_count", return_value=16)
+    def test_cores_are_divided_between_workers_and_lanes(self, _cpu_count):
+        with threads_setting(WORKERS=2, QUERY=None, INGESTION=None, QUERY_MAX=4):
+            self.assertEqual(thread_budget.thread_budget(), {"query": 4, "ingestion": 4})
+            self.assertEqual(thread_budget.thread_budget(workers=4), {"query": 2, "ingestion": 2})
+            self.assertEqual(thread_budget.thread_budget(workers=1), {"query": 4, "ingestion": 12})
+            self.assertEqual(thread_budget.thread_budget(workers=32), {"query": 1, "ingestion": 1})
+        with threads_setting(WORKERS=2, QUERY=1, INGESTION=16):
+            self.assertEqual(thread_budget.thread_budget(), {"query": 1, "ingestion": 16})
+
+    def test_torch_gets_one_count_for_the_process(self):
+        torch = mock.Mock()
+        with mock.patch.dict(sys.modules, {"torch": torch}), mock.patch.dict(os.environ), \
+                mock.patch.object(thread_budget, "_configured", None), \
+                mock.patch("rag.thread_budget.cpu_count", return_value=8), \
+                threads_setting(WORKERS=1, QUERY=2, INGESTION=None):
+            self.assertEqual(thread_budget.configure(), {"query": 2, "ingestion": 6})
+            self.in_thread(thread_budget.enter_lane, "ingestion")
+            self.in_thread(thread_budget.run_in_lane, "ingestion", thread_budget.current_lane)
+        torch.set_num_threads.assert_called_once_with(2)
+
+    def test_run_in_lane_uses_the_thread_of_the_lane(self):
+        lanes = [thread_budget.run_in_lane("ingestion", thread_budget.current_lane) for _ in range(2)]
+        self.assertEqual(lanes, ["ingestion", "ingestion"])
+        threads = {thread_budget.run_in_lane("ingestion", threading.current_thread) for _ in range(3)}
+        (thread,) = threads
+        self.assertTrue(thread.name.startswith("embedding-ingestion"))
+        self.assertIsNot(thread, threading.current_thread())
+
+        # Called again from the lane, it runs in place instead of waiting for itself
+        nested = thread_budget.run_in_lane(
+            "ingestion", thread_budget.run_in_lane, "ingestion", threading.current_thread
+        )
+        self.assertIs(nested, thread)
+
+    def test_embeddings_are_routed_to_their_lane(self):
+        embeddings = LaneRecordingEmbeddings()
+        embeddings.embed_documents(["a page"])
+        self.in_thread(embeddings.embed_queries, ["a question"])
+        with override_settings(EMBEDDING_BATCHING={**settings.EMBEDDING_BATCHING, "ENABLED": True}):
+            embeddings.embed_query("a question")
+
+        (upload_thread, upload_lane), (request_thread, request_lane), (batch_thread, batch_lane) = embeddings.calls
+        self.assertEqual((upload_lane, request_lane, batch_lane), ("ingestion", "query", "query"))
+        self.assertTrue(upload_thread.name.startswith("embedding-ingestion"))
+        self.assertEqual(batch_thread.name, "embedding-scheduler")
+        self.assertNotIn(threading.current_thread(), {upload_thread, request_thread, batch_thread})
@@ -0,0 +1,83 @@
+import os
+from unittest import mock
+
+from django.conf import settings
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from ..models import RagFile, RagUser
+from ..tracing import render_metrics
+from ..vectordb import add_to_chroma
+from .test_batch import echo
+from .utils import TemporaryIndexMixin, page
+
+
+def bearer(token):
+    return {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+
+
+@override_settings(CONTEXT_COMPRESSION={**settings.CONTEXT_COMPRESSION, "ENABLED": False})
+class TracingTests(TemporaryIndexMixin, TestCase):
+    def setUp(self):
+        self.use_temporary_index()
+        self.user = RagUser.objects.create_user("alice", password="secret")
+
+    def test_server_timing_header(self):
+        with self.assertLogs("rag.requests", "INFO") as logs:
+            response = self.client.get(reverse("rag:get_conversations"), **bearer(AccessToken.for_user(self.user)))
+        self.assertEqual(response.status_code, 200)
+        stages = [entry.split(";")[0] for entry in response["Server-Timing"].split(", ")]
+        self.assertEqual(stages, ["auth", "total"])
+        (record,) = logs.records
+        self.assertEqual(record.endpoint, "rag:get_conversations")
+        self.assertEqual(list(record.stages_ms), ["auth"])
+
+    def test_streamed_response_is_logged_when_it_closes(self):
+        add_to_chroma([page("a.pdf", 0, "The budget for travel is approved.")])
+        RagFile.objects.create(file_name="a.pdf")
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch("rag.llm_model.llm_gateway.invoke", side_effect=echo):
+            with self.assertNoLogs("rag.requests"):
+                response = client.post(reverse("rag:query_batch"), {"queries": ["travel?"]}, format="json")
+            # The LLM is called once the stream is read
+            self.assertNotIn("llm_call", response["Server-Timing"])
+            with self.assertLogs("rag.requests", "INFO") as logs:
+                b"".join(response.streaming_content)
+                response.close()
+        (record,) = logs.records
+        self.assertEqual(record.endpoint, "rag:query_batch")
+        self.assertIn("llm_call", record.stages_ms)
+
+    def test_every_series_has_a_pid_label(self):
+        self.client.get(reverse("rag:get_conversations"), **bearer(AccessToken.for_user(self.user)))
+        samples = [line for line in render_metrics().splitlines() if not line.startswith("#")]
+        self.assertTrue(samples)
+        for line in samples:
+            self.assertIn(f'{{pid="{os.getpid()}"', line)
+
+
+class MetricsAuthTests(TestCase):
+    def get(self, **headers):
+        return self.client.get(reverse("metrics"), **headers)
+
+    def test_credentials_are_required(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response["WWW-Authenticate"], "Bearer")
+
+    @override_settings(METRICS_TOKEN="scraper-token")
+    def test_scraper_token(self):
+        self.assertEqual(self.get(**bearer("scraper-token")).status_code, 200)
+        self.assertEqual(self.get(**bearer("wrong-token")).status_code, 403)
+        self.assertEqual(self.get(HTTP_AUTHORIZATION="Basic scraper-token").status_code, 403)
+
+    def test_admin_token(self):
+        admin = RagUser.objects.create_user("admin", password="secret", role="admin")
+        user = RagUser.objects.create_user("alice", password="secret")
+        response = self.get(**bearer(AccessToken.for_user(admin)))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("# TYPE rag_request_duration_seconds histogram", response.content.decode())
+        self.assertEqual(self.get(**bearer(AccessToken.for_user(user))).status_code, 403)
@@ -0,0 +1,108 @@
+from django.conf import settings
+from django.test import TestCase, override_settings
+
+from ..llm_model import get_context
+from ..models import ChunkLocation, RagFile, RagFileGroup
+from ..serializers import ScopeSerializer
+from ..vectordb import add_to_chroma, content_hash, delete_file_from_chroma, file_filter, get_vector_store
+from .utils import TemporaryIndexMixin, WordEmbeddings, page
+
+SHARED = "Confidential, do not distribute outside the company."
+
+
+class SharedChunksMixin(TemporaryIndexMixin):
+    """a.pdf and b.pdf, each with a text of its own and a shared one"""
+
+    def setUp(self):
+        self.use_temporary_index()
+        add_to_chroma([page("a.pdf", 0, SHARED), page("a.pdf", 1, "The budget for travel is approved.")])
+        add_to_chroma([page("b.pdf", 0, "Holidays are planned in August."), page("b.pdf", 2, SHARED)])
+        self.store = get_vector_store()
+
+
+class DeduplicationTests(SharedChunksMixin, TestCase):
+    def test_shared_chunks_are_stored_once(self):
+        self.assertEqual(self.store.count(), 3)
+        self.assertEqual(ChunkLocation.objects.count(), 4)
+        shared = ChunkLocation.objects.filter(content_hash=content_hash(SHARED))
+        self.assertEqual(sorted(shared.values_list("file_name", "page")), [("a.pdf", 1), ("b.pdf", 3)])
+
+    def test_texts_differing_in_whitespace_are_the_same_chunk(self):
+        add_to_chroma([page("c.pdf", 0, "Confidential,\n do not distribute   outside the company.")])
+        self.assertEqual(self.store.count(), 3)
+        self.assertEqual(ChunkLocation.objects.filter(content_hash=content_hash(SHARED)).count(), 3)
+
+    def test_delete_file_keeps_shared_chunks(self):
+        self.assertTrue(delete_file_from_chroma("a.pdf"))
+
+        self.assertEqual(self.store.count(), 2)
+        self.assertFalse(ChunkLocation.objects.filter(file_name="a.pdf").exists())
+        self.assertEqual(self.store.get_existing_ids([content_hash("The budget for travel is approved.")]), set())
+        # The shared chunk now points to its place in b.pdf
+        shared_hash = content_hash(SHARED)
+        metadata = self.store.get_metadatas([shared_hash])[shared_hash]
+        self.assertEqual(metadata["file_name"], "b.pdf")
+        self.assertEqual(metadata["page"], 2)
+        self.assertEqual(metadata["id"], f"{settings.RAG_MEDIA_URL}b.pdf:3:0")
+
+    def test_changed_page_replaces_its_chunks(self):
+        add_to_chroma([page("a.pdf", 0, SHARED), page("a.pdf", 1, "The budget for travel is rejected.")])
+
+        self.assertEqual(self.store.count(), 3)
+        self.assertEqual(self.store.get_existing_ids([content_hash("The budget for travel is approved.")]), set())
+        self.assertEqual(ChunkLocation.objects.filter(file_name="a.pdf").count(), 2)
+
+    def test_replace_files_returns_the_texts_no_longer_cited(self):
+        locations = [ChunkLocation(content_hash=content_hash(SHARED), file_name="a.pdf", page=1, chunk_index=0)]
+        orphaned = ChunkLocation.replace_files(locations, batch_size=1)
+        self.assertEqual(orphaned, {content_hash("The budget for travel is approved.")})
+        self.assertEqual(ChunkLocation.objects.count(), 3)
+
+
+@override_settings(CONTEXT_COMPRESSION={**settings.CONTEXT_COMPRESSION, "ENABLED": False})
+class ScopedRetrievalTests(SharedChunksMixin, TestCase):
+    def test_file_filter_matches_shared_chunks(self):
+        # The shared chunk is stored with the metadata of a.pdf, it is found in b.pdf by its hash
+        where = file_filter(["b.pdf"])
+        self.assertEqual(
+            where,
+            {"$or": [{"file_name": {"$in": ["b.pdf"]}}, {"content_hash": {"$in": [content_hash(SHARED)]}}]},
+        )
+        hits = self.store.query(WordEmbeddings().embed(SHARED), k=3, where=where)
+        self.assertEqual(sorted(hit.document for hit in hits), sorted([SHARED, "Holidays are planned in August."]))
+        self.assertEqual(file_filter(["a.pdf", "b.pdf"]), {"file_name": {"$in": ["a.pdf", "b.pdf"]}})
+
+    def test_scoped_context_only_cites_the_selected_files(self):
+        context = get_context(self.store, "Is the travel budget approved?", SIMILARITY_THRESHOLD=1.0, file_names={"b.pdf"})
+        # Every chunk passes the threshold, only the scope decides what is in the context
+        self.assertNotIn("travel", context["context"])
+        self.assertIn(SHARED, context["context"])
+        # The shared chunk is cited in b.pdf, where it was found, not in a.pdf where it is stored
+        self.assertIn(f"{settings.RAG_MEDIA_URL}b.pdf:3:0", context["sources"])
+        self.assertFalse(any("a.pdf" in source for source in context["sources"]))
+
+        context = get_context(self.store, "Is the travel budget approved?", SIMILARITY_THRESHOLD=1.0, file_names={"a.pdf"})
+        self.assertIn("The budget for travel is approved.", context["context"])
+        self.assertNotIn("Holidays", context["context"])
+
+    def test_scope_of_files_and_collections(self):
+        a, b, c = (RagFile.objects.create(file_name=name) for name in ("a.pdf", "b.pdf", "c.pdf"))
+        group = RagFileGroup.objects.create(name="hr")
+        group.files.set([b, c])
+
+        def scope(data):
+            serializer = ScopeSerializer(data=data)
+            return serializer.validated_data["file_names"] if serializer.is_valid() else serializer.error_message
+
+        self.assertIsNone(scope({}))
+        self.assertEqual(scope({"files": [a.id]}), {"a.pdf"})
+        self.assertEqual(scope({"collections": [group.id]}), {"b.pdf", "c.pdf"})
+        self.assertEqual(scope({"files": [a.id], "collections": [group.id]}), {"a.pdf", "b.pdf", "c.pdf"})
+        self.assertEqual(scope({"files": [999]}), "Unknown files: [999]")
+        self.assertEqual(scope({"collections": [999]}), "Unknown collections: [999]")
+        empty = RagFileGroup.objects.create(name="empty")
+        self.assertEqual(scope({"collections": [empty.id]}), "The selected collections have no files")
+
+
+class ChromaScopedRetrievalTests(ScopedRetrievalTests):
+    backend = "chroma"
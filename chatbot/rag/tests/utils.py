@@ -0,0 +1,86 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import numpy as np
+from django.conf import settings
+from django.test import override_settings
+from langchain_core.documents import Document
+
+from ..loadtest import pdf_bytes
+from ..stubs import start_stub_elasticsearch
+from ..vectordb import reset_vector_stores
+from ..vectordb.embeddings import EMBEDDING_MODEL_NAME, BaseEmbeddingWrapper
+
+
+class WordEmbeddings(BaseEmbeddingWrapper):
+    """Normalized bag of words, texts sharing words are close without loading a model"""
+
+    DIMENSION = 256
+
+    def embed(self, text):
+        vector = np.zeros(self.DIMENSION, dtype=np.float32)
+        for word in text.lower().replace(".", " ").replace("?", " ").split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.DIMENSION] += 1
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+    def encode(self, texts):
+        return np.array([self.embed(text) for text in texts], dtype=np.float32).reshape(-1, self.DIMENSION)
+
+
+def page(file_name, number, text):
+    return Document(page_content=text, metadata={"source": f"{settings.DATA_PATH}/{file_name}", "page": number})
+
+
+class TemporaryIndexMixin:
+    """DATA_PATH and CHROMA_PATH in a temporary directory, and WordEmbeddings as the embedding model"""
+
+    backend = "flat"
+
+    def use_temporary_index(self, **overrides):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        settings_override = override_settings(
+            DATA_PATH=f"{self.root}/data",
+            CHROMA_PATH=f"{self.root}/index",
+            RAG_RETRIEVAL={**settings.RAG_RETRIEVAL, "BACKEND": self.backend},
+            **overrides,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(settings.DATA_PATH)
+        self.embeddings = WordEmbeddings()
+        patcher = mock.patch.dict(
+            "rag.vectordb.embeddings._embedding_functions",
+            {(settings.EMBEDDING["BACKEND"], EMBEDDING_MODEL_NAME): self.embeddings},
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        reset_vector_stores()
+        self.addCleanup(reset_vector_stores)
+
+
+def write_pdf(path, pages):
+    """A PDF with one line of text per page"""
+    with open(path, "wb") as f:
+        f.write(pdf_bytes([[text] for text in pages]))
+
+
+class StubElasticsearchMixin:
+    """Points ELASTICSEARCH_URL to the Elasticsearch stub of rag/stubs.py, empty for every test"""
+
+    def use_stub_elasticsearch(self):
+        from matching import elastic_search
+
+        server = start_stub_elasticsearch()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        host, port = server.server_address
+        settings_override = override_settings(ELASTICSEARCH_URL=f"http://{host}:{port}")
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        elastic_search.reset()
+        self.addCleanup(elastic_search.reset)
+        return server
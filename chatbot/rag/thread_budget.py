@@ -0,0 +1,107 @@
+"""
+CPU threads of the embedding model.
+
+torch (and the OpenMP and MKL runtimes under it) runs every matrix product on as many threads
+as there are cores. Several workers doing so at the same time, or an upload embedding thousands
+of chunks next to a query, oversubscribe the CPU: the threads wait for each other and the
+latency of the queries spikes. The cores are divided between the worker processes
+(EMBEDDING_THREADS["WORKERS"]), and inside a process between two lanes:
+
+- "query": the thread of the EmbeddingScheduler, or the request thread when batching is off.
+  Few threads, a small batch finishes fastest without the synchronization of many.
+- "ingestion": one thread running the embedding of uploads and rebuilds, with the rest of the
+  budget (onnxruntime). Uploads queue on it instead of competing with each other and with the
+  queries.
+
+torch has one thread count for the whole process: torch.set_num_threads (and the OpenMP and
+MKL settings under it) applies to every thread, the last call wins. A count set per lane would
+change the count of the other lane in the middle of its work, so torch runs both lanes with the
+query count, set once by configure(), and the ingestion lane only keeps uploads from competing
+with each other. onnxruntime gets a session per lane, sized for it. The tokenizers have one
+pool for the process, sized with RAYON_NUM_THREADS before their first use.
+"""
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+# Lane -> (pid, single thread executor), started in the process using it
+_executors = {}
+_executors_lock = threading.Lock()
+_configured = None
+
+
+def cpu_count():
+    # The cores this process may run on, fewer than the machine has in a container with a cpuset
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def thread_budget(workers=None):
+    """Threads of each lane in this process"""
+    options = settings.EMBEDDING_THREADS
+    workers = workers or options["WORKERS"]
+    cores = max(1, cpu_count() // max(1, workers))
+    query = options["QUERY"] or max(1, min(options["QUERY_MAX"], cores // 2))
+    # The query threads are kept free for the queries while an upload is embedded
+    ingestion = options["INGESTION"] or max(1, cores - query)
+    return {"query": query, "ingestion": ingestion}
+
+
+def configure(workers=None):
+    """
+    Sizes the thread pools of the libraries, called before the embedding model is loaded.
+    Variables already set in the environment are left alone.
+    """
+    global _configured
+    if workers is None and _configured:
+        return _configured
+    budget = thread_budget(workers)
+    if _configured == budget:
+        return budget
+    _configured = budget
+    # Read by OpenMP and MKL when torch is imported, torch uses the query count in every lane
+    for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ.setdefault(variable, str(budget["query"]))
+    os.environ.setdefault("RAYON_NUM_THREADS", str(budget["ingestion"]))
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(budget["query"])
+    logger.info(
+        "Embedding threads: %d for queries, %d for ingestion (%d cores, %d workers)",
+        budget["query"], budget["ingestion"], cpu_count(), workers or settings.EMBEDDING_THREADS["WORKERS"],
+    )
+    return budget
+
+
+def enter_lane(lane):
+    """Runs the rest of the current thread in `lane`, its onnxruntime session is used from then on"""
+    _local.lane = lane
+
+
+def current_lane():
+    return getattr(_local, "lane", None)
+
+
+def run_in_lane(lane, function, *args):
+    """Calls `function` on the thread of `lane`, or directly from a thread already in it"""
+    if current_lane() == lane:
+        return function(*args)
+    pid, executor = _executors.get(lane, (None, None))
+    if pid != os.getpid():
+        with _executors_lock:
+            pid, executor = _executors.get(lane, (None, None))
+            # An executor inherited through a fork has no thread
+            if pid != os.getpid():
+                executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f"embedding-{lane}", initializer=enter_lane, initargs=(lane,)
+                )
+                _executors[lane] = (os.getpid(), executor)
+    return executor.submit(function, *args).result()
@@ -0,0 +1,229 @@
+"""
+Timing of the stages of a request.
+
+`with stage("name"):` measures a block. The duration is added to the latency
+histogram of the stage and, when a trace was started for the current request
+(TracingMiddleware does it), to that trace. Stages that run several times in a
+request, or in helper threads started from it, add up. Other measures of the request
+(the tokens of the prompt context...) are added up the same way with `record(name=value)`.
+
+At the end of the request the trace is sent back in the Server-Timing header and
+logged as one structured line on the "rag.requests" logger, with the recorded measures. A streamed
+response is logged when the stream closes, its header only has the stages run before the first byte.
+
+The histograms are served in the Prometheus text format by the /metrics endpoint, with the memory
+of the process. They are kept per process: every series has a `pid` label, so the counters of
+the gunicorn workers stay apart and `sum without (pid) (rate(...))` adds them up. A scrape reaches one
+worker, the series of the others are refreshed by the next scrapes.
+"""
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("rag.timing")
+
+# Stage name -> milliseconds, for the request being handled in this context
+_current_trace = contextvars.ContextVar("rag_trace", default=None)
+# Name -> value of the other measures of the request (token counts...), logged with its stages
+_current_fields = contextvars.ContextVar("rag_trace_fields", default=None)
+
+# Seconds, from 1 ms to a minute
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Texts per call to the embedding model
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# Tokens of a prompt context, counted by the tokenizer of the embedding model
+TOKEN_BUCKETS = (32, 64, 128, 256, 384, 512, 768, 1024, 1536, 2048, 4096)
+
+# Every metric, in the order they are rendered
+REGISTRY = []
+
+
+def _label_text(names, values, extra=None):
+    pairs = [("pid", os.getpid())] + list(zip(names, values)) + ([extra] if extra else [])
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _name, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _value), value in zip(pairs, escaped)) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Label values -> [count per bucket (the last one is +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {count}")
+        return lines
+
+
+class Gauge:
+    """Values read when the metrics are rendered, `collect` returns {label values: value}"""
+
+    def __init__(self, name, help_text, collect, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+        self.labels = tuple(labels)
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for key, value in sorted(self.collect().items()):
+            lines.append(f"{self.name}{_label_text(self.labels, key)} {value}")
+        return lines
+
+
+def process_memory(pid="self"):
+    """
+    Resident memory of a process in bytes: rss, pss (shared pages divided between the processes
+    sharing them) and uss (pages only this process uses). Empty where /proc is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            fields = {line.split(":")[0]: int(line.split()[1]) * 1024 for line in f if line.rstrip().endswith(" kB")}
+    except OSError:
+        return {}
+    return {"rss": fields["Rss"], "pss": fields["Pss"], "uss": fields["Private_Clean"] + fields["Private_Dirty"]}
+
+
+REQUEST_LATENCY = Histogram(
+    "rag_request_duration_seconds", "Time to handle a request", labels=("endpoint", "method", "status")
+)
+STAGE_LATENCY = Histogram("rag_stage_duration_seconds", "Time spent in a stage of a request", labels=("stage",))
+EMBEDDING_BATCH_SIZE = Histogram(
+    "rag_embedding_batch_size", "Texts encoded together by the embedding scheduler", buckets=BATCH_SIZE_BUCKETS
+)
+EMBEDDING_QUEUE_WAIT = Histogram(
+    "rag_embedding_queue_wait_seconds", "Time a text waited in the embedding scheduler before being encoded"
+)
+CONTEXT_EMBEDDING_TOKENS = Histogram(
+    "rag_context_embedding_tokens",
+    "Tokens of the embedding model (not of the LLM) in the retrieved chunks and in the context kept by the "
+    "compression",
+    labels=("kind",), buckets=TOKEN_BUCKETS,
+)
+PROCESS_MEMORY = Gauge(
+    "rag_process_memory_bytes",
+    "Resident memory of the worker, uss is the part not shared with the other workers",
+    lambda: {(kind,): value for kind, value in process_memory().items()},
+    labels=("kind",),
+)
+
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def start_trace():
+    trace = {}
+    _current_trace.set(trace)
+    _current_fields.set({})
+    return trace
+
+
+def get_trace():
+    return _current_trace.get()
+
+
+def get_trace_fields():
+    return _current_fields.get()
+
+
+def end_trace():
+    _current_trace.set(None)
+    _current_fields.set(None)
+
+
+@contextmanager
+def resumed_trace(trace, fields):
+    """Makes `trace` current again, e.g. while a streamed response produces its content"""
+    trace_token = _current_trace.set(trace)
+    fields_token = _current_fields.set(fields)
+    try:
+        yield
+    finally:
+        _current_trace.reset(trace_token)
+        _current_fields.reset(fields_token)
+
+
+def record(**values):
+    """Adds `values` to the fields of the current trace, values recorded several times add up"""
+    fields = _current_fields.get()
+    if fields is not None:
+        for name, value in values.items():
+            fields[name] = fields.get(name, 0) + value
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_LATENCY.observe(elapsed, stage=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace[name] = trace.get(name, 0) + elapsed * 1000
+        logger.debug("%s took %.2f ms", name, elapsed * 1000)
+
+
+def server_timing(trace, total_ms=None):
+    """Server-Timing header value, shown per request in the network tab of the browsers"""
+    entries = [f"{name};dur={duration:.2f}" for name, duration in trace.items()]
+    if total_ms is not None:
+        entries.append(f"total;dur={total_ms:.2f}")
+    return ", ".join(entries)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with the `extra` fields of the record"""
+
+    STANDARD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+    def format(self, record):
+        payload = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self.STANDARD_ATTRIBUTES:
+                payload[key] = value
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
@@ -0,0 +1,307 @@
+import logging
+import os
+import shutil
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from django.conf import settings
+
+
+from langchain_core.documents import Document
+
+from .. import thread_budget
+from ..models import RagFile, ChunkLocation
+from .chunking import SPLITTERS, get_chunker
+from .embeddings import EmbeddingWrapper, get_embedding_function
+from .backends import get_vector_store, reset_vector_stores
+
+logger = logging.getLogger(__name__)
+
+## CURRENT WORKING DIRECTORY OF PYTHON SCRIPTS IS THE ROOT DIRECTORY OF THE PROJECT
+## THEREFORE WE NO LONGER CAN USE PATHS RELATIVE TO THE SCRIPTS PARENT DIRECTORY
+## settings.CHROMA_PATH and settings.DATA_PATH are read on every call, so they can be pointed elsewhere (benchmarks)
+
+# TODO: THESE NEEDS TO BE SET IN THE ADMIN PANEL
+# Characters of the "characters" splitter, the "tokens" one is sized with settings.CHUNKING
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 75
+
+# Texts per forward pass when the embeddings are computed in parallel
+EMBEDDING_BATCH_SIZE = 64
+
+def populator():
+    # Create (or update) the data store.
+    try:
+        documents = load_documents()
+        chunks = split_documents(documents)
+        # If new documents added, the message is set accordingly
+        is_changed = add_to_chroma(chunks)
+        return is_changed
+    except Exception as e:
+        logger.exception("Error populating the vector database: %s", e)
+        return f"Error: {e}"
+
+
+def load_documents(paths=None, workers=1):
+    """Pages of every PDF in DATA_PATH, or of the given files parsed by `workers` processes"""
+    if paths is None:
+        from langchain_community.document_loaders import PyPDFDirectoryLoader
+
+        document_loader = PyPDFDirectoryLoader(settings.DATA_PATH)
+        return document_loader.load()
+    if workers <= 1:
+        return [page for path in paths for page in load_pdf(path)]
+    # Parsing is pure Python, processes get around the GIL
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [page for pages in executor.map(load_pdf, paths) for page in pages]
+
+
+def load_pdf(path):
+    # langchain_community is slow to import, it is loaded with the first file parsed
+    from langchain_community.document_loaders import PyPDFLoader
+
+    return PyPDFLoader(path).load()
+
+
+def split_documents(documents: list[Document], chunk_size=None, chunk_overlap=None, splitter=None):
+    """
+    Chunks of the pages, by the splitter of settings.CHUNKING: `chunk_size` and `chunk_overlap`
+    are tokens for the "tokens" splitter and characters for the "characters" one.
+    """
+    splitter = splitter or settings.CHUNKING["SPLITTER"]
+    if splitter == "tokens":
+        chunker = get_chunker(chunk_size, chunk_overlap)
+        if chunker is not None:
+            return chunker.split_documents(documents)
+        # The sizes are tokens, the character splitter uses its own
+        chunk_size = chunk_overlap = None
+    elif splitter not in SPLITTERS:
+        raise ValueError(f"Unknown splitter: {splitter}")
+    # Imported here, loading langchain_text_splitters takes most of a second
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size or CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP if chunk_overlap is None else chunk_overlap,
+        length_function=len,
+        is_separator_regex=False,
+    )
+    return text_splitter.split_documents(documents)
+
+
+def file_filter(file_names):
+    """
+    `where` filter of the chunks of the given files. A text shared with other files is stored
+    once with the metadata of one of them, those are matched by their content hash instead.
+    """
+    file_names = sorted(file_names)
+    where = {"file_name": {"$in": file_names}}
+    shared = ChunkLocation.shared_hashes(file_names)
+    if shared:
+        where = {"$or": [where, {"content_hash": {"$in": sorted(shared)}}]}
+    return where
+
+
+def file_hash(path):
+    # Same content hash as the one stored on RagFile
+    return RagFile.hash_file(path)
+
+
+def add_file_metadata(chunks: list[Document], directory=None, file_hashes=None):
+    # Tag every chunk with the file it belongs to so it can be found without scanning the IDs
+    directory = directory or settings.DATA_PATH
+    # Content hashes already known by file name, the other files are hashed here
+    hashes = dict(file_hashes or {})
+    for chunk in chunks:
+        source = chunk.metadata.get("source")
+        if not source:
+            continue
+        file_name = os.path.basename(source)
+        if file_name not in hashes:
+            path = os.path.join(directory, file_name)
+            hashes[file_name] = file_hash(path) if os.path.exists(path) else ""
+        chunk.metadata["file_name"] = file_name
+        chunk.metadata["file_hash"] = hashes[file_name]
+        # Modify the source to include only the file name and append it to the base URL.
+        chunk.metadata["source"] = f"{settings.RAG_MEDIA_URL}{file_name}"
+    return chunks
+
+
+def normalize_chunk_text(text):
+    # Chunks that only differ in whitespace (line breaks, indentation) are the same text
+    return " ".join(text.split())
+
+
+def content_hash(text):
+    return hashlib.sha256(normalize_chunk_text(text).encode("utf-8")).hexdigest()
+
+
+def add_to_chroma(chunks: list[Document]):
+    add_file_metadata(chunks)
+
+    # Load the existing database.
+    db = get_vector_store()
+
+    # Calculate Page IDs.
+    chunks_with_ids = calculate_chunk_ids(chunks)
+
+    unique_chunks, locations = deduplicate_chunks(chunks_with_ids)
+
+    # Only look up the hashes of these chunks instead of every ID in the DB.
+    existing_ids = db.get_existing_ids(unique_chunks)
+    logger.info(
+        "Number of chunks: %d, distinct: %d, already stored: %d",
+        len(chunks_with_ids), len(unique_chunks), len(existing_ids),
+    )
+
+    # Only add documents that don't exist in the DB.
+    new_chunks = {
+        chunk_hash: chunk for chunk_hash, chunk in unique_chunks.items() if chunk_hash not in existing_ids
+    }
+
+    if len(new_chunks):
+        logger.info("Added new documents: %d", len(new_chunks))
+        db.add_documents(list(new_chunks.values()), ids=list(new_chunks.keys()))
+    # After the new chunks are stored, the texts they replace are no longer cited anywhere
+    orphaned = save_locations(db, locations)
+    if not new_chunks and not orphaned:
+        logger.info("No new documents to add")
+    return bool(new_chunks or orphaned)
+
+
+def save_locations(db, locations):
+    """
+    Replaces the locations of the files of `locations`, and removes from `db` the chunks that
+    are no longer in any file (the text of a page changed, or the splitter did).
+    """
+    orphaned = ChunkLocation.replace_files(locations)
+    if orphaned:
+        logger.info("Removed chunks no longer in any file: %d", len(orphaned))
+        db.delete(ids=list(orphaned))
+    return orphaned
+
+
+def deduplicate_chunks(chunks):
+    """
+    Repeated texts (headers, footers, appendices...) are stored once under their content hash,
+    every place they appear in is kept in the ChunkLocation table.
+    Returns the distinct chunks keyed by hash and the (unsaved) locations of all chunks.
+    """
+    unique_chunks = {}
+    locations = []
+    for chunk in chunks:
+        chunk_hash = content_hash(chunk.page_content)
+        chunk.metadata["content_hash"] = chunk_hash
+        unique_chunks.setdefault(chunk_hash, chunk)
+        locations.append(ChunkLocation(
+            content_hash=chunk_hash,
+            file_name=chunk.metadata.get("file_name", ""),
+            page=chunk.metadata.get("page") + 1,
+            chunk_index=chunk.metadata["chunk_index"],
+        ))
+    return unique_chunks, locations
+
+
+def embed_texts(texts, workers=1, batch_size=EMBEDDING_BATCH_SIZE):
+    """Embeddings of `texts`, with `workers` threads each encoding some of the batches"""
+    embedding_function = get_embedding_function()
+    if workers <= 1:
+        return embedding_function.embed_documents(texts)
+    batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+    # In the ingestion lane, so they encode at once instead of queueing on the single thread of the lane
+    with ThreadPoolExecutor(max_workers=workers, initializer=thread_budget.enter_lane, initargs=("ingestion",)) as executor:
+        return [embedding for embeddings in executor.map(embedding_function.embed_documents, batches) for embedding in embeddings]
+
+
+def calculate_chunk_ids(chunks):
+    # This will create IDs like "data/monopoly.pdf:6:2"
+    # Page Source : Page Number : Chunk Index
+
+    last_page_id = None
+    current_chunk_index = 0
+
+    for chunk in chunks:
+        source = chunk.metadata.get("source")
+        page = chunk.metadata.get("page") + 1  # Page numbers starts from 1 instead of 0
+        current_page_id = f"{source}:{page}"
+
+        # If the page ID is the same as the last one, increment the index.
+        if current_page_id == last_page_id:
+            current_chunk_index += 1
+        else:
+            current_chunk_index = 0
+
+        # Calculate the chunk ID.
+        chunk_id = f"{current_page_id}:{current_chunk_index}"
+        last_page_id = current_page_id
+
+        # Add it to the page meta-data.
+        chunk.metadata["id"] = chunk_id
+        chunk.metadata["chunk_index"] = current_chunk_index
+
+    return chunks
+
+
+def clear_database():
+    if os.path.exists(settings.CHROMA_PATH):
+        shutil.rmtree(settings.CHROMA_PATH)
+    reset_vector_stores()
+
+
+#documents = load_documents()
+#chunks = split_documents(documents)
+#print(chunks[0])
+
+#from langchain_ollama import OllamaEmbeddings
+
+'''
+def get_embedding_function_ollama():
+    embeddings = OllamaEmbeddings(model="nomic-embed-text")
+    return embeddings
+'''
+def delete_file_from_chroma(filename):
+    """Delete all chunks for a given filename from the vector database"""
+    try:
+        db = get_vector_store()
+
+        # Texts that only appeared in this file are removed
+        orphaned, remaining = ChunkLocation.release_file(filename)
+        if orphaned:
+            db.delete(ids=list(orphaned))
+
+        # Texts shared with other files are kept, but must not point to this file anymore
+        if remaining:
+            reassign_chunks(db, filename, remaining)
+
+        # Chunks stored before deduplication are still one per location
+        db.delete(where={"file_name": filename})
+        return True
+    except Exception as e:
+        logger.exception("Error deleting documents from the vector database: %s", e)
+        return False
+
+
+def reassign_chunks(db, filename, remaining):
+    stored = db.get_metadatas(remaining)
+    file_hashes = dict(
+        RagFile.objects.filter(file_name__in={location.file_name for location in remaining.values()})
+        .values_list("file_name", "file_hash")
+    )
+
+    ids = []
+    metadatas = []
+    for chunk_id, metadata in stored.items():
+        if metadata.get("file_name") != filename:
+            continue
+        location = remaining[chunk_id]
+        ids.append(chunk_id)
+        metadatas.append({
+            **metadata,
+            "file_name": location.file_name,
+            "file_hash": file_hashes.get(location.file_name) or "",
+            "source": f"{settings.RAG_MEDIA_URL}{location.file_name}",
+            "page": location.page - 1,
+            "chunk_index": location.chunk_index,
+            "id": location.citation,
+        })
+    if ids:
+        db.update_metadatas(ids, metadatas)
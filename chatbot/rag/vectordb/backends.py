@@ -0,0 +1,949 @@
+"""
+Retrieval backends.
+
+Every backend stores the chunks (ID, text, metadata and vector) and answers
+nearest neighbour queries. The ingestion pipeline and `get_context` only use the
+`VectorStore` interface, so the backend is picked per deployment with
+`settings.RAG_RETRIEVAL["BACKEND"]`:
+
+- "chroma": the Chroma collection in CHROMA_PATH, with tunable HNSW parameters.
+- "quantized": an in-process store keeping float16, int8 or product-quantized vectors.
+- "flat": exact search over a memory-mapped float32 matrix, for small and medium corpora.
+- "remote": client of the retrieval service (rag/vectordb/service.py), a separate process
+  that owns the embedding model and one of the stores above for every web worker.
+
+Scores are squared L2 distances between normalized vectors (2 - 2 * cosine) for
+every backend, which is what Chroma returns, so the similarity threshold means
+the same thing whichever backend is used.
+
+The stores live in the index root. When `manage.py rebuild_indexes` has been run,
+CHROMA_PATH holds one directory per index version and the CURRENT file names the
+live one. A rebuild writes a new version next to it and replaces CURRENT, every
+process picks the new version up on its next `get_vector_store` call. Without
+CURRENT the root is CHROMA_PATH itself. An index root may also hold the projection reducing
+the vectors before they are stored (see projection.py), the stores opened on it apply it.
+"""
+import copy
+import fcntl
+import functools
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+from django.conf import settings
+from langchain_core.documents import Document
+
+from .embeddings import get_embedding_function
+from .projection import Projection
+from ..tracing import stage
+
+logger = logging.getLogger(__name__)
+
+# Name langchain_chroma used for the collection, kept so existing databases are found
+COLLECTION_NAME = "langchain"
+
+SearchHit = namedtuple("SearchHit", ["id", "document", "metadata", "score"])
+
+
+class VectorStore:
+    """Interface the ingestion pipeline and the retrieval code rely on"""
+
+    # Set by open_vector_store when the index root has one
+    projection = None
+
+    def __init__(self, embedding_function=None):
+        self._embedding_function = embedding_function
+
+    def project(self, embeddings):
+        """
+        Vectors of the embedding model reduced by the projection of the index. Vectors that
+        already have the reduced dimension (exported from a store of the same index) are kept.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.projection is None or embeddings.shape[-1] == self.projection.dimensions:
+            return embeddings
+        if embeddings.shape[-1] != self.projection.input_dimension:
+            raise ValueError(
+                f"Vectors of {embeddings.shape[-1]} dimensions, the projection of the index reduces "
+                f"{self.projection.input_dimension}: rebuild the index with --no-projection after changing the model"
+            )
+        return self.projection.apply(embeddings)
+
+    @property
+    def embedding_function(self):
+        # Loaded on first use, deleting or listing chunks does not need the model
+        if self._embedding_function is None:
+            self._embedding_function = get_embedding_function()
+        return self._embedding_function
+
+    def add(self, ids, documents, embeddings, metadatas=None):
+        raise NotImplementedError
+
+    def get_existing_ids(self, ids):
+        raise NotImplementedError
+
+    def get_metadatas(self, ids):
+        """Returns the metadata of the given chunks, keyed by ID"""
+        raise NotImplementedError
+
+    def update_metadatas(self, ids, metadatas):
+        raise NotImplementedError
+
+    def delete(self, ids=None, where=None):
+        raise NotImplementedError
+
+    def query(self, embedding, k=4, where=None):
+        """Returns the `k` closest chunks to `embedding` as a list of `SearchHit`"""
+        return self.query_many([embedding], k=k, where=where)[0]
+
+    def query_many(self, embeddings, k=4, where=None):
+        """Searches several embeddings at once, one list of `SearchHit` per embedding"""
+        raise NotImplementedError
+
+    def export(self, batch_size=1000):
+        """Yields (ids, documents, metadatas, embeddings) batches of everything stored"""
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
+
+    def add_documents(self, documents, ids):
+        texts = [document.page_content for document in documents]
+        embeddings = self.embedding_function.embed_documents(texts)
+        self.add(ids, texts, embeddings, [document.metadata for document in documents])
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None):
+        return self.similarity_search_by_vectors_with_score([embedding], k=k, filter=filter)[0]
+
+    def similarity_search_by_vectors_with_score(self, embeddings, k=4, filter=None):
+        with stage("vector_search"):
+            results = self.query_many(embeddings, k=k, where=filter)
+        return [
+            [(Document(page_content=hit.document, metadata=hit.metadata), hit.score) for hit in hits]
+            for hits in results
+        ]
+
+    def similarity_search_with_score(self, query, k=4, filter=None):
+        with stage("query_embedding"):
+            embedding = self.embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k=k, filter=filter)
+
+
+class ChromaVectorStore(VectorStore):
+    """
+    Chroma collection with configurable HNSW parameters.
+    M and ef_construction only apply when the collection is created,
+    ef_search is also applied to an existing collection.
+    """
+
+    def __init__(self, embedding_function=None, path=None, collection_name=COLLECTION_NAME,
+                 M=None, ef_construction=None, ef_search=None):
+        super().__init__(embedding_function)
+        import chromadb
+
+        options = settings.RAG_RETRIEVAL
+        self.M = M or options["HNSW_M"]
+        self.ef_construction = ef_construction or options["HNSW_EF_CONSTRUCTION"]
+        self.ef_search = ef_search or options["HNSW_EF_SEARCH"]
+
+        self.client = chromadb.PersistentClient(path=path or index_root())
+        try:
+            self.collection = self.client.get_collection(collection_name)
+            self._apply_ef_search()
+        except Exception:
+            self.collection = self.client.create_collection(collection_name, metadata={
+                "hnsw:space": "l2",
+                "hnsw:M": self.M,
+                "hnsw:construction_ef": self.ef_construction,
+                "hnsw:search_ef": self.ef_search,
+            })
+
+    def _apply_ef_search(self):
+        metadata = self.collection.metadata or {}
+        # Chroma 1.x keeps it in the configuration, older versions only read the metadata
+        configuration = getattr(self.collection, "configuration", None)
+        hnsw = (configuration or {}).get("hnsw") or {}
+        if hnsw.get("ef_search", metadata.get("hnsw:search_ef")) == self.ef_search:
+            return
+        try:
+            if configuration is not None:
+                self.collection.modify(configuration={"hnsw": {"ef_search": self.ef_search}})
+            else:
+                self.collection.modify(metadata={**metadata, "hnsw:search_ef": self.ef_search})
+        except Exception as e:
+            logger.warning("Could not set ef_search on the Chroma collection: %s", e)
+
+    def add(self, ids, documents, embeddings, metadatas=None):
+        embeddings = self.project(embeddings)
+        batch_size = self.client.get_max_batch_size()
+        for i in range(0, len(ids), batch_size):
+            self.collection.upsert(
+                ids=list(ids[i:i + batch_size]),
+                documents=list(documents[i:i + batch_size]),
+                embeddings=np.asarray(embeddings[i:i + batch_size], dtype=np.float32),
+                metadatas=list(metadatas[i:i + batch_size]) if metadatas else None,
+            )
+
+    def get_existing_ids(self, ids):
+        existing = set()
+        ids = list(ids)
+        for i in range(0, len(ids), 1000):
+            existing.update(self.collection.get(ids=ids[i:i + 1000], include=[])["ids"])
+        return existing
+
+    def get_metadatas(self, ids):
+        stored = self.collection.get(ids=list(ids), include=["metadatas"])
+        return dict(zip(stored["ids"], stored["metadatas"]))
+
+    def update_metadatas(self, ids, metadatas):
+        self.collection.update(ids=list(ids), metadatas=list(metadatas))
+
+    def delete(self, ids=None, where=None):
+        if ids is None and not where:
+            return
+        self.collection.delete(ids=list(ids) if ids is not None else None, where=where or None)
+
+    def query_many(self, embeddings, k=4, where=None):
+        if not len(embeddings):
+            return []
+        # A single call searches every embedding
+        results = self.collection.query(
+            query_embeddings=self.project(embeddings),
+            n_results=k,
+            where=where or None,
+            include=["documents", "metadatas", "distances"],
+        )
+        return [
+            [
+                SearchHit(chunk_id, document, metadata or {}, distance)
+                for chunk_id, document, metadata, distance in zip(ids, documents, metadatas, distances)
+            ]
+            for ids, documents, metadatas, distances in zip(
+                results["ids"], results["documents"], results["metadatas"], results["distances"]
+            )
+        ]
+
+    def export(self, batch_size=1000):
+        offset = 0
+        while True:
+            batch = self.collection.get(
+                include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=offset
+            )
+            if not len(batch["ids"]):
+                return
+            offset += len(batch["ids"])
+            yield batch["ids"], batch["documents"], batch["metadatas"], np.asarray(batch["embeddings"], dtype=np.float32)
+
+    def count(self):
+        return self.collection.count()
+
+
+def matches_where(metadata, where):
+    """Evaluates a Chroma style `where` filter against one metadata dict"""
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_where(metadata, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, operand in condition.items():
+                if operator == "$eq" and value != operand:
+                    return False
+                if operator == "$ne" and value == operand:
+                    return False
+                if operator == "$in" and value not in operand:
+                    return False
+                if operator == "$nin" and value in operand:
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(scores, k):
+    """Indices of the `k` highest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def sync_file(path):
+    with open(path, "rb+") as f:
+        os.fsync(f.fileno())
+
+
+class LocalVectorStore(VectorStore):
+    """
+    Base of the in-process stores. Without a `path` nothing is persisted, which is what the
+    benchmarks use. With one, the store is kept in append-only files of a "generation":
+
+    - `<array>-<generation>.bin`: the rows of each per-row array (vectors, codes...), raw.
+    - `records-<generation>.jsonl`: one line per chunk added (ID, text, metadata), and one per
+      metadata update.
+    - `manifest.json`: the generation and how many rows and bytes of records of it are
+      committed. It is written last and renamed over the previous one.
+
+    An add appends its rows and records to the files, then commits a new manifest, so its
+    cost does not grow with the store. Readers only use what the manifest they read
+    commits: an add in progress is invisible, and another process picks the changes up by
+    reading the new rows only. A delete writes the store again as the next generation, the
+    files of the previous one are kept for the readers still loading it. Writers of every
+    process are serialized by a lock on the `.lock` file.
+    """
+
+    MANIFEST_FILE = "manifest.json"
+    LOCK_FILE = ".lock"
+
+    # Attributes holding one row per chunk, and the ones fitted once (PQ codebooks)
+    row_arrays = ()
+    static_arrays = ()
+
+    def __init__(self, embedding_function=None, path=None):
+        super().__init__(embedding_function)
+        self.path = path
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.rows = {}
+        # Metadata key -> {value: rows}, built by the first filtered query on the key
+        self._value_rows = {}
+        self.dimension = None
+        self._lock = threading.RLock()
+        # Held by the thread writing, while it has the lock of the directory
+        self._lock_file = None
+        # Manifest loaded: its identity on disk and its content
+        self._manifest_key = None
+        self.manifest = None
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+        self._reload_if_changed()
+
+    # Vector storage, implemented by the subclasses
+
+    def _encode_rows(self, vectors):
+        """The rows of the row_arrays storing the (normalized) `vectors`, by attribute name"""
+        raise NotImplementedError
+
+    def _inner_products(self, query):
+        """Inner products of the (normalized) query with every stored vector"""
+        raise NotImplementedError
+
+    def _inner_products_many(self, queries):
+        """Same for a (queries, dimension) matrix, returns a (rows, queries) matrix"""
+        return np.stack([self._inner_products(query) for query in queries], axis=1)
+
+    def _inner_products_rows(self, queries, rows):
+        """Same for the given rows only, the search of a filtered query reads no other vector"""
+        return self._vectors(rows) @ queries.T
+
+    def _vectors(self, rows):
+        """Reconstructs the stored vectors of the given rows"""
+        raise NotImplementedError
+
+    # Persistence
+
+    def _file(self, name, generation=None):
+        if generation is not None:
+            stem, extension = os.path.splitext(name)
+            name = f"{stem}-{generation}{extension}"
+        return os.path.join(self.path, name)
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock:
+            if not self.path or self._lock_file is not None:
+                yield
+                return
+            with open(self._file(self.LOCK_FILE), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._lock_file = lock_file
+                try:
+                    yield
+                finally:
+                    # Closing the file releases the lock
+                    self._lock_file = None
+
+    def _row_bytes(self, name):
+        dtype, shape = self.manifest["arrays"][name]
+        return np.dtype(dtype).itemsize * int(np.prod(shape))
+
+    def _map_arrays(self, manifest):
+        """The row arrays committed by `manifest`, memory-mapped so the workers share their pages"""
+        for name, (dtype, shape) in manifest["arrays"].items():
+            if manifest["rows"]:
+                array = np.memmap(
+                    self._file(f"{name}.bin", manifest["generation"]), dtype=dtype, mode="r",
+                    shape=(manifest["rows"], *shape),
+                )
+            else:
+                array = np.empty((0, *shape), dtype=dtype)
+            setattr(self, name, array)
+
+    def _apply_records(self, lines):
+        for line in lines:
+            record = json.loads(line)
+            if "update" in record:
+                row = self.rows.get(record["update"])
+                if row is not None:
+                    self.metadatas[row] = record["metadata"]
+                continue
+            self.rows[record["id"]] = len(self.ids)
+            self.ids.append(record["id"])
+            self.documents.append(record["document"])
+            self.metadatas.append(record["metadata"])
+
+    def _read_records(self, start, end):
+        with open(self._file("records.jsonl", self.manifest["generation"]), "rb") as f:
+            f.seek(start)
+            return f.read(end - start).decode("utf-8").splitlines()
+
+    def _reload_if_changed(self):
+        if not self.path:
+            return
+        manifest_path = self._file(self.MANIFEST_FILE)
+        try:
+            stat = os.stat(manifest_path)
+        except FileNotFoundError:
+            return
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key == self._manifest_key:
+            return
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        previous = self.manifest
+        self.manifest = manifest
+        if previous is not None and previous["generation"] == manifest["generation"]:
+            # Same generation: only rows were added or metadata updated since, read from where we stopped
+            self._apply_records(self._read_records(previous["records_size"], manifest["records_size"]))
+        else:
+            self.ids, self.documents, self.metadatas, self.rows = [], [], [], {}
+            self._apply_records(self._read_records(0, manifest["records_size"]))
+            for name in self.static_arrays:
+                path = self._file(f"{name}.npy", manifest["generation"])
+                setattr(self, name, np.load(path) if os.path.exists(path) else None)
+        self.dimension = manifest["dimension"]
+        self._map_arrays(manifest)
+        self._value_rows = {}
+        self._manifest_key = key
+
+    def _commit(self, manifest):
+        """Makes `manifest` the current one, after the files it refers to are on disk"""
+        manifest_path = self._file(self.MANIFEST_FILE)
+        tmp_path = f"{manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, manifest_path)
+        stat = os.stat(manifest_path)
+        self._manifest_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self.manifest = manifest
+
+    def _append(self, rows, records):
+        """Appends `rows` (by array name) and the `records` lines to the files of the generation"""
+        manifest = dict(self.manifest)
+        for name, array in rows.items():
+            path = self._file(f"{name}.bin", manifest["generation"])
+            with open(path, "ab") as f:
+                # Drops what a writer interrupted before its commit left
+                f.truncate(manifest["rows"] * self._row_bytes(name))
+                f.write(np.ascontiguousarray(array).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        path = self._file("records.jsonl", manifest["generation"])
+        data = "".join(f"{json.dumps(record)}\n" for record in records).encode("utf-8")
+        with open(path, "ab") as f:
+            f.truncate(manifest["records_size"])
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        manifest["rows"] += len(next(iter(rows.values()))) if rows else 0
+        manifest["records_size"] += len(data)
+        self._commit(manifest)
+        self._map_arrays(manifest)
+
+    def _rewrite(self):
+        """Writes the whole store as the next generation and commits it"""
+        generation = self.manifest["generation"] + 1 if self.manifest else 1
+        arrays = {}
+        for name in self.row_arrays:
+            array = np.ascontiguousarray(getattr(self, name))
+            arrays[name] = (array.dtype.str, list(array.shape[1:]))
+            with open(self._file(f"{name}.bin", generation), "wb") as f:
+                f.write(array.tobytes())
+            sync_file(self._file(f"{name}.bin", generation))
+        for name in self.static_arrays:
+            if getattr(self, name) is not None:
+                np.save(self._file(f"{name}.npy", generation), getattr(self, name))
+        records_path = self._file("records.jsonl", generation)
+        with open(records_path, "wb") as f:
+            for chunk_id, document, metadata in zip(self.ids, self.documents, self.metadatas):
+                f.write(f"{json.dumps({'id': chunk_id, 'document': document, 'metadata': metadata})}\n".encode("utf-8"))
+            records_size = f.tell()
+        sync_file(records_path)
+        self._commit({
+            "generation": generation, "rows": len(self.ids), "records_size": records_size,
+            "dimension": self.dimension, "arrays": arrays,
+        })
+        self._map_arrays(self.manifest)
+        self._remove_generations_before(generation - 1)
+
+    def _remove_generations_before(self, generation):
+        for name in os.listdir(self.path):
+            stem, _extension = os.path.splitext(name)
+            number = stem.rsplit("-", 1)[-1]
+            if "-" in stem and number.isdigit() and int(number) < generation:
+                os.remove(os.path.join(self.path, name))
+
+    # VectorStore interface
+
+    def add(self, ids, documents, embeddings, metadatas=None):
+        vectors = normalize(self.project(embeddings))
+        metadatas = metadatas or [{} for _ in ids]
+        records = [
+            {"id": chunk_id, "document": document, "metadata": dict(metadata or {})}
+            for chunk_id, document, metadata in zip(ids, documents, metadatas)
+        ]
+        with self._write_lock():
+            self._reload_if_changed()
+            self.dimension = vectors.shape[1]
+            rows = self._encode_rows(vectors)
+            # Same semantics as Chroma's upsert
+            replaced = [chunk_id for chunk_id in ids if chunk_id in self.rows]
+            if replaced:
+                self._delete_rows({self.rows[chunk_id] for chunk_id in replaced})
+            if self.path and self.manifest and not replaced:
+                self._append(rows, records)
+            else:
+                for name, array in rows.items():
+                    stored = getattr(self, name)
+                    setattr(self, name, array if stored is None or not len(stored) else np.concatenate([stored, array]))
+            self._apply_records(json.dumps(record) for record in records)
+            self._value_rows = {}
+            if self.path and (replaced or not self.manifest):
+                self._rewrite()
+
+    def get_existing_ids(self, ids):
+        with self._lock:
+            self._reload_if_changed()
+            return {chunk_id for chunk_id in ids if chunk_id in self.rows}
+
+    def get_metadatas(self, ids):
+        with self._lock:
+            self._reload_if_changed()
+            return {chunk_id: self.metadatas[self.rows[chunk_id]] for chunk_id in ids if chunk_id in self.rows}
+
+    def update_metadatas(self, ids, metadatas):
+        with self._write_lock():
+            self._reload_if_changed()
+            records = [
+                {"update": chunk_id, "metadata": dict(metadata)}
+                for chunk_id, metadata in zip(ids, metadatas) if chunk_id in self.rows
+            ]
+            if not records:
+                return
+            if self.path:
+                self._append({}, records)
+            self._apply_records(json.dumps(record) for record in records)
+            self._value_rows = {}
+
+    def delete(self, ids=None, where=None):
+        with self._write_lock():
+            self._reload_if_changed()
+            rows = set()
+            if ids is not None:
+                rows.update(self.rows[chunk_id] for chunk_id in ids if chunk_id in self.rows)
+                if where:
+                    rows = {row for row in rows if matches_where(self.metadatas[row], where)}
+            elif where:
+                rows.update(row for row, metadata in enumerate(self.metadatas) if matches_where(metadata, where))
+            if rows:
+                self._delete_rows(rows)
+                if self.path:
+                    self._rewrite()
+
+    def _delete_rows(self, rows):
+        mask = np.ones(len(self.ids), dtype=bool)
+        mask[list(rows)] = False
+        for name in self.row_arrays:
+            setattr(self, name, np.asarray(getattr(self, name))[mask])
+        self.ids = [chunk_id for chunk_id, keep in zip(self.ids, mask) if keep]
+        self.documents = [document for document, keep in zip(self.documents, mask) if keep]
+        self.metadatas = [metadata for metadata, keep in zip(self.metadatas, mask) if keep]
+        self.rows = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        self._value_rows = {}
+
+    def _rows_with_values(self, key, values):
+        index = self._value_rows.get(key)
+        if index is None:
+            index = {}
+            for row, metadata in enumerate(self.metadatas):
+                index.setdefault(metadata.get(key), []).append(row)
+            index = self._value_rows[key] = {value: np.array(rows) for value, rows in index.items()}
+        found = [index[value] for value in set(values) if value in index]
+        return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int64)
+
+    def _matching_rows(self, where):
+        """
+        Sorted rows whose metadata matches the Chroma style `where`. Equality and $in conditions
+        are looked up in an index of the values of the key, the other ones scan the metadata.
+        """
+        matched = None
+        for key, condition in where.items():
+            if key in ("$and", "$or"):
+                parts = [self._matching_rows(clause) for clause in condition]
+                combine = np.intersect1d if key == "$and" else np.union1d
+                rows = functools.reduce(combine, parts) if parts else np.arange(len(self.ids))
+            elif not isinstance(condition, dict):
+                rows = self._rows_with_values(key, [condition])
+            elif condition.keys() == {"$eq"}:
+                rows = self._rows_with_values(key, [condition["$eq"]])
+            elif condition.keys() == {"$in"}:
+                rows = self._rows_with_values(key, condition["$in"])
+            else:
+                rows = np.flatnonzero([matches_where(metadata, {key: condition}) for metadata in self.metadatas])
+            matched = rows if matched is None else np.intersect1d(matched, rows)
+        return matched if matched is not None else np.arange(len(self.ids))
+
+    def query_many(self, embeddings, k=4, where=None):
+        if not len(embeddings):
+            return []
+        queries = normalize(self.project(np.atleast_2d(np.asarray(embeddings, dtype=np.float32))))
+        with self._lock:
+            self._reload_if_changed()
+            if not self.ids:
+                return [[] for _ in queries]
+            # Only the vectors of the matching rows are scored, a query scoped to a few files reads a few rows
+            rows = self._matching_rows(where) if where else None
+            # The search runs on a shallow copy, outside the lock, so concurrent queries do not wait for
+            # each other. Writers replace the arrays and lists rather than change them, apart from rows
+            # appended after the ones the copy scores.
+            snapshot = copy.copy(self)
+        if rows is not None and not len(rows):
+            return [[] for _ in queries]
+        if rows is not None:
+            scores = snapshot._inner_products_rows(queries, rows)
+        else:
+            scores = snapshot._inner_products_many(queries)
+
+        results = []
+        for column in scores.T:
+            hits = []
+            for position in top_k(column, k):
+                row = int(rows[position]) if rows is not None else position
+                hits.append(SearchHit(
+                    snapshot.ids[row], snapshot.documents[row], snapshot.metadatas[row], float(2 - 2 * column[position])
+                ))
+            results.append(hits)
+        return results
+
+    def export(self, batch_size=1000):
+        with self._lock:
+            self._reload_if_changed()
+            for i in range(0, len(self.ids), batch_size):
+                rows = np.arange(i, min(i + batch_size, len(self.ids)))
+                yield (
+                    self.ids[i:i + batch_size],
+                    self.documents[i:i + batch_size],
+                    self.metadatas[i:i + batch_size],
+                    self._vectors(rows),
+                )
+
+    def count(self):
+        with self._lock:
+            self._reload_if_changed()
+            return len(self.ids)
+
+
+def kmeans(vectors, k, iterations=20, seed=0):
+    """Plain Lloyd's k-means, used to train the product quantization codebooks"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    squared_norms = (vectors ** 2).sum(axis=1)
+    for _ in range(iterations):
+        distances = squared_norms[:, None] - 2 * vectors @ centroids.T + (centroids ** 2).sum(axis=1)[None, :]
+        assignment = distances.argmin(axis=1)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
+
+
+class QuantizedVectorStore(LocalVectorStore):
+    """
+    In-process store keeping compressed vectors:
+
+    - "float16": half precision, 2x smaller than float32 and almost as exact.
+    - "int8": every vector is scaled to [-127, 127] and stored as int8 with its scale,
+      4x smaller than float32.
+    - "pq": product quantization, the vector is split in `subspaces` parts and each part
+      is replaced by the index of its closest centroid (1 byte). With 96 subspaces a
+      768-d vector takes 96 bytes instead of 3072. The codebooks are trained on the first
+      vectors added, rebuild the index to retrain them on a grown corpus.
+    """
+
+    # Rows scored at once, bounds the temporary float32 copy of the int8 codes
+    BLOCK_SIZE = 65536
+
+    def __init__(self, embedding_function=None, path=None, mode=None, subspaces=None, centroids=None):
+        options = settings.RAG_RETRIEVAL
+        self.mode = mode or options["QUANTIZATION"]
+        if self.mode not in ("float16", "int8", "pq"):
+            raise ValueError(f"Unknown quantization mode: {self.mode}")
+        self.subspaces = subspaces or options["PQ_SUBSPACES"]
+        self.centroids = centroids or options["PQ_CENTROIDS"]
+        self.codes = None
+        self.scales = None
+        self.codebooks = None
+        super().__init__(embedding_function, path)
+
+    def train(self, vectors):
+        vectors = normalize(vectors)
+        dimension = vectors.shape[1]
+        if dimension % self.subspaces:
+            raise ValueError(f"Dimension {dimension} is not divisible by {self.subspaces} subspaces")
+        sub_dimension = dimension // self.subspaces
+        k = min(self.centroids, len(vectors))
+        self.codebooks = np.stack([
+            kmeans(vectors[:, i * sub_dimension:(i + 1) * sub_dimension], k, seed=i)
+            for i in range(self.subspaces)
+        ]).astype(np.float32)
+
+    @property
+    def row_arrays(self):
+        return ("codes", "scales") if self.mode == "int8" else ("codes",)
+
+    @property
+    def static_arrays(self):
+        return ("codebooks",) if self.mode == "pq" else ()
+
+    def _encode_rows(self, vectors):
+        if self.mode == "float16":
+            return {"codes": vectors.astype(np.float16)}
+        if self.mode == "int8":
+            scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+            return {"codes": np.round(vectors / scales[:, None]).astype(np.int8), "scales": scales.astype(np.float32)}
+
+        if self.codebooks is None:
+            self.train(vectors)
+        sub_dimension = self.codebooks.shape[2]
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        for i, codebook in enumerate(self.codebooks):
+            part = vectors[:, i * sub_dimension:(i + 1) * sub_dimension]
+            distances = -2 * part @ codebook.T + (codebook ** 2).sum(axis=1)[None, :]
+            codes[:, i] = distances.argmin(axis=1)
+        return {"codes": codes}
+
+    def _inner_products(self, query):
+        if self.mode in ("float16", "int8"):
+            return self._inner_products_many(query[None, :])[:, 0]
+
+        # Asymmetric distance: the query is compared with every centroid once,
+        # then each stored vector is scored with table lookups.
+        sub_dimension = self.codebooks.shape[2]
+        table = np.einsum("mkd,md->mk", self.codebooks, query.reshape(self.subspaces, sub_dimension))
+        return table[np.arange(self.subspaces), self.codes].sum(axis=1)
+
+    def _inner_products_many(self, queries):
+        if self.mode == "pq":
+            return super()._inner_products_many(queries)
+        scores = np.empty((len(self.codes), len(queries)), dtype=np.float32)
+        for i in range(0, len(self.codes), self.BLOCK_SIZE):
+            block = self.codes[i:i + self.BLOCK_SIZE]
+            scores[i:i + len(block)] = block.astype(np.float32) @ queries.T
+            if self.scales is not None:
+                scores[i:i + len(block)] *= self.scales[i:i + len(block), None]
+        return scores
+
+    def _vectors(self, rows):
+        if self.mode == "float16":
+            return self.codes[rows].astype(np.float32)
+        if self.mode == "int8":
+            return self.codes[rows].astype(np.float32) * self.scales[rows, None]
+        return np.concatenate([self.codebooks[i][self.codes[rows, i]] for i in range(self.subspaces)], axis=1)
+
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.codes, self.scales, self.codebooks) if array is not None)
+
+
+
+class FlatVectorStore(LocalVectorStore):
+    """
+    Exact search with a single matrix product over the normalized vectors.
+
+    The float32 vectors live in `vectors-<generation>.bin` and are memory-mapped, so
+    every worker process maps the same file and shares its pages through the OS
+    page cache instead of holding a private copy. Adds append to the file, readers
+    map the committed rows again on their next query.
+    """
+
+    row_arrays = ("vectors",)
+
+    def __init__(self, embedding_function=None, path=None):
+        self.vectors = None
+        super().__init__(embedding_function, path)
+
+    def _encode_rows(self, vectors):
+        return {"vectors": np.ascontiguousarray(vectors, dtype=np.float32)}
+
+    def _inner_products(self, query):
+        return self.vectors @ query
+
+    def _inner_products_many(self, queries):
+        return self.vectors @ queries.T
+
+    def _vectors(self, rows):
+        return np.asarray(self.vectors[rows], dtype=np.float32)
+
+    def nbytes(self):
+        return self.vectors.nbytes if self.vectors is not None else 0
+
+
+BACKENDS = {
+    "chroma": lambda root: ChromaVectorStore(path=root),
+    "quantized": lambda root: QuantizedVectorStore(
+        path=os.path.join(root, f"quantized-{settings.RAG_RETRIEVAL['QUANTIZATION']}")
+    ),
+    "flat": lambda root: FlatVectorStore(path=os.path.join(root, "flat")),
+    # The service follows the live index version itself
+    "remote": lambda root: remote_vector_store(),
+}
+
+POINTER_FILE = "CURRENT"
+
+# One store per backend and index root, per process
+_vector_stores = {}
+_vector_stores_lock = threading.Lock()
+# Pointer file mtime and the root it named, so the file is only read again when it changes
+_pointer = (None, None)
+
+
+def index_root():
+    """Directory of the live index version, CHROMA_PATH itself before the first rebuild"""
+    global _pointer
+    pointer_path = os.path.join(settings.CHROMA_PATH, POINTER_FILE)
+    try:
+        mtime = os.stat(pointer_path).st_mtime_ns
+    except FileNotFoundError:
+        return settings.CHROMA_PATH
+    if _pointer[0] != (pointer_path, mtime):
+        with open(pointer_path) as f:
+            _pointer = ((pointer_path, mtime), os.path.join(settings.CHROMA_PATH, f.read().strip()))
+    return _pointer[1]
+
+
+def index_versions():
+    """Names of the index version directories, oldest first"""
+    if not os.path.isdir(settings.CHROMA_PATH):
+        return []
+    return sorted(
+        name for name in os.listdir(settings.CHROMA_PATH)
+        if name.startswith("v") and os.path.isdir(os.path.join(settings.CHROMA_PATH, name))
+    )
+
+
+def new_index_version():
+    """Creates the directory of a new, not yet live, index version and returns its name"""
+    version = datetime.now().strftime("v%Y%m%d-%H%M%S-%f")
+    os.makedirs(os.path.join(settings.CHROMA_PATH, version))
+    return version
+
+
+def activate_index_version(version):
+    """Makes `version` the live index, atomically for every reader"""
+    pointer_path = os.path.join(settings.CHROMA_PATH, POINTER_FILE)
+    tmp_path = f"{pointer_path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pointer_path)
+
+
+def prune_index_versions(keep=1):
+    """Removes the versions older than the live one, apart from the `keep` most recent"""
+    live = os.path.basename(index_root())
+    versions = index_versions()
+    if live not in versions:
+        return []
+    older = versions[:versions.index(live)]
+    removed = older[:max(0, len(older) - keep)]
+    for version in removed:
+        shutil.rmtree(os.path.join(settings.CHROMA_PATH, version))
+    return removed
+
+
+def remote_vector_store():
+    from .service import RemoteVectorStore
+
+    return RemoteVectorStore()
+
+
+def storage_backend(backend=None):
+    """Backend keeping the chunks on disk, for "remote" the one the retrieval service serves"""
+    backend = backend or settings.RAG_RETRIEVAL["BACKEND"]
+    return settings.RAG_RETRIEVAL["SERVICE_BACKEND"] if backend == "remote" else backend
+
+
+def open_vector_store(backend=None, root=None):
+    """A new store of `backend` in `root`, e.g. an index version that is being built"""
+    backend = backend or settings.RAG_RETRIEVAL["BACKEND"]
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown retrieval backend: {backend}")
+    root = root or index_root()
+    store = BACKENDS[backend](root)
+    # The retrieval service applies the projection of the index it serves
+    if backend != "remote":
+        store.projection = Projection.load(root)
+    return store
+
+
+def get_vector_store(backend=None):
+    backend = backend or settings.RAG_RETRIEVAL["BACKEND"]
+    key = (backend, index_root())
+    store = _vector_stores.get(key)
+    if store is None:
+        with _vector_stores_lock:
+            store = _vector_stores.get(key)
+            if store is None:
+                # Stores of a replaced version are dropped, their files may be removed soon
+                for old_key in [old_key for old_key in _vector_stores if old_key[0] == backend]:
+                    del _vector_stores[old_key]
+                store = _vector_stores[key] = open_vector_store(backend, key[1])
+    return store
+
+
+def copy_vector_store(source, target, batch_size=1000):
+    """Copies every chunk with its vector from one backend to another, without embedding again"""
+    copied = 0
+    for ids, documents, metadatas, embeddings in source.export(batch_size):
+        target.add(ids, documents, embeddings, metadatas)
+        copied += len(ids)
+    return copied
+
+
+def reset_vector_stores():
+    # Needed after the files of the stores are removed
+    global _pointer
+    with _vector_stores_lock:
+        _vector_stores.clear()
+        _pointer = (None, None)
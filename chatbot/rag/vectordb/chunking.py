@@ -0,0 +1,162 @@
+"""
+Token-aware chunking of the pages.
+
+RecursiveCharacterTextSplitter measures the chunks in characters and splits every piece again
+with the next separator until it fits, a page of text is scanned many times. The model does
+not see characters: all-mpnet-base-v2 truncates its input at 384 tokens, and 500 characters
+of tables, numbers or code can be more tokens than that.
+
+TokenChunker tokenizes the batch of pages in one call to the tokenizer of the embedding model
+(Rust, parallel) and cuts each page once, at sentence and paragraph boundaries: the tokens of a
+sentence are found from their offsets in the page, nothing is tokenized twice. The segments are
+then packed into chunks of at most `chunk_tokens` tokens, the last segments of a chunk starting
+the next one up to `overlap_tokens`. A segment longer than a chunk is cut between two words.
+The chunks are slices of the page text, so they only depend on the text and the tokenizer: the
+same page always gives the same chunks, and the same IDs (see calculate_chunk_ids and
+content_hash).
+"""
+import logging
+import os
+import re
+from functools import lru_cache
+
+import numpy as np
+from django.conf import settings
+from langchain_core.documents import Document
+
+from .embeddings import EMBEDDING_MODEL_NAME, onnx_model_path
+
+logger = logging.getLogger(__name__)
+
+# max_seq_length of all-mpnet-base-v2, the tokens after it are not embedded
+EMBEDDING_MAX_TOKENS = 384
+# [CLS] and [SEP] are added to every text embedded
+SPECIAL_TOKENS = 2
+
+SPLITTERS = ("tokens", "characters")
+
+# End of a sentence (with its closing quotes or brackets) followed by whitespace, or a blank line
+BOUNDARY = re.compile(r"[.!?][\"')\]]*\s+|\n\s*\n\s*")
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(model_name=EMBEDDING_MODEL_NAME):
+    """
+    The tokenizer of the embedding model, without truncation nor padding. Read from the ONNX
+    export if there is one, otherwise from the Hugging Face cache sentence-transformers fills.
+    """
+    from tokenizers import Tokenizer
+
+    path = os.path.join(onnx_model_path(model_name), "tokenizer.json")
+    if not os.path.exists(path):
+        from huggingface_hub import hf_hub_download
+
+        path = hf_hub_download(model_name, "tokenizer.json")
+    tokenizer = Tokenizer.from_file(path)
+    tokenizer.no_truncation()
+    tokenizer.no_padding()
+    return tokenizer
+
+
+def segment_bounds(text):
+    """(start, end) of the sentences and paragraphs of `text`, the whitespace after them included"""
+    bounds = []
+    start = 0
+    for match in BOUNDARY.finditer(text):
+        bounds.append((start, match.end()))
+        start = match.end()
+    if start < len(text):
+        bounds.append((start, len(text)))
+    return bounds
+
+
+class TokenChunker:
+    def __init__(self, tokenizer, chunk_tokens=128, overlap_tokens=16, max_tokens=EMBEDDING_MAX_TOKENS):
+        if chunk_tokens + SPECIAL_TOKENS > max_tokens:
+            raise ValueError(f"Chunks of {chunk_tokens} tokens are longer than the {max_tokens} the model embeds")
+        if overlap_tokens >= chunk_tokens:
+            raise ValueError(f"The overlap ({overlap_tokens} tokens) must be smaller than the chunks ({chunk_tokens})")
+        self.tokenizer = tokenizer
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+
+    def split_documents(self, documents):
+        # One encoding per page, the segments are counted from the offsets of its tokens
+        encodings = self.tokenizer.encode_batch([document.page_content for document in documents], add_special_tokens=False)
+        chunks = []
+        for document, encoding in zip(documents, encodings):
+            text = document.page_content
+            for start, end in self._pack(self._segments(text, encoding)):
+                content = text[start:end].strip()
+                if content:
+                    chunks.append(Document(page_content=content, metadata=dict(document.metadata)))
+        return chunks
+
+    def _segments(self, text, encoding):
+        """(start, end, tokens) of the segments of `text`, cut in pieces of at most chunk_tokens"""
+        bounds = segment_bounds(text)
+        if not encoding.offsets:
+            return [(start, end, 0) for start, end in bounds]
+        token_starts = np.fromiter((start for start, _end in encoding.offsets), dtype=np.int64)
+        # Index of the first token of every segment, and the end of the last one
+        firsts = np.searchsorted(token_starts, [start for start, _end in bounds] + [len(text)]).tolist()
+        segments = []
+        for (start, end), first, last in zip(bounds, firsts, firsts[1:]):
+            while last - first > self.chunk_tokens:
+                cut = first + self.chunk_tokens
+                # Back to the first token of the word, unless the word alone is longer than a chunk
+                word_ids = encoding.word_ids
+                while cut > first + 1 and word_ids[cut] is not None and word_ids[cut] == word_ids[cut - 1]:
+                    cut -= 1
+                if cut == first + 1:
+                    cut = first + self.chunk_tokens
+                segments.append((start, int(token_starts[cut]), cut - first))
+                start, first = int(token_starts[cut]), cut
+            segments.append((start, end, last - first))
+        return segments
+
+    def _pack(self, segments):
+        """(start, end) of the chunks, greedily filled with whole segments"""
+        current = []
+        tokens = 0
+        for segment in segments:
+            if current and tokens + segment[2] > self.chunk_tokens:
+                yield current[0][0], current[-1][1]
+                # The last segments, up to overlap_tokens, start the next chunk
+                kept = []
+                kept_tokens = 0
+                for previous in reversed(current):
+                    if kept_tokens + previous[2] > min(self.overlap_tokens, self.chunk_tokens - segment[2]):
+                        break
+                    kept.insert(0, previous)
+                    kept_tokens += previous[2]
+                current, tokens = kept, kept_tokens
+            current.append(segment)
+            tokens += segment[2]
+        if current:
+            yield current[0][0], current[-1][1]
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model_name=EMBEDDING_MODEL_NAME):
+    """load_tokenizer, None if the tokenizer cannot be loaded"""
+    try:
+        return load_tokenizer(model_name)
+    except (ImportError, OSError) as e:
+        # Not downloaded and offline: the failure is cached, not retried for every upload or query
+        logger.warning("Tokenizer of %s unavailable, the pages are split by characters: %s", model_name, e)
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_chunker(chunk_tokens=None, overlap_tokens=None, model_name=EMBEDDING_MODEL_NAME):
+    """The chunker of the settings, None if the tokenizer of the model cannot be loaded"""
+    options = settings.CHUNKING
+    tokenizer = get_tokenizer(model_name)
+    if tokenizer is None:
+        return None
+    return TokenChunker(
+        tokenizer,
+        chunk_tokens=chunk_tokens or options["CHUNK_TOKENS"],
+        overlap_tokens=options["OVERLAP_TOKENS"] if overlap_tokens is None else overlap_tokens,
+    )
@@ -0,0 +1,274 @@
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+from django.conf import settings
+
+from .. import thread_budget
+from ..tracing import EMBEDDING_BATCH_SIZE, EMBEDDING_QUEUE_WAIT
+
+EMBEDDING_MODEL_NAME = 'sentence-transformers/all-mpnet-base-v2'
+
+# Files of an ONNX export (see manage.py export_onnx_embeddings), next to the tokenizer.json
+ONNX_MODEL = "model.onnx"
+ONNX_INT8_MODEL = "model-int8.onnx"
+ONNX_CONFIG = "embedding_config.json"
+# Texts per run of the ONNX session, what sentence-transformers uses
+ONNX_BATCH_SIZE = 32
+
+# Loaded models, shared by every caller in the process
+_embedding_functions = {}
+_embedding_functions_lock = threading.Lock()
+
+
+class EmbeddingScheduler:
+    """
+    Encodes texts submitted by concurrent callers together. The first text waiting starts a
+    batch and the texts queued behind it join, up to `max_batch` texts (a larger submission is
+    encoded on its own). A text alone in the queue is encoded at once, when others are queued
+    with it the batch waits for more until `max_wait` seconds after the first was submitted.
+    `encode` is called with the list of texts from one thread, started by calling
+    `initializer`, and every caller gets the rows of its own texts back.
+    """
+
+    def __init__(self, encode, max_batch=32, max_wait=0.005, initializer=None):
+        self.encode = encode
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.initializer = initializer
+        self._queue = queue.Queue()
+        # Submission that did not fit in the previous batch, it starts the next one
+        self._next = None
+        threading.Thread(target=self._run, name="embedding-scheduler", daemon=True).start()
+
+    def embed(self, texts):
+        future = Future()
+        self._queue.put((list(texts), future, time.perf_counter()))
+        return future.result()
+
+    def _collect(self):
+        pending = [self._next or self._queue.get()]
+        self._next = None
+        size = len(pending[0][0])
+        deadline = pending[0][2] + self.max_wait
+        while size < self.max_batch:
+            # Texts queued while the previous batch was encoded mean concurrent callers, a lone
+            # text would only pay the wait
+            timeout = deadline - time.perf_counter() if len(pending) > 1 else 0
+            try:
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if size + len(item[0]) > self.max_batch:
+                self._next = item
+                break
+            pending.append(item)
+            size += len(item[0])
+        return pending
+
+    def _run(self):
+        if self.initializer is not None:
+            self.initializer()
+        while True:
+            pending = self._collect()
+            started = time.perf_counter()
+            texts = [text for item_texts, _future, _submitted in pending for text in item_texts]
+            EMBEDDING_BATCH_SIZE.observe(len(texts))
+            for item_texts, _future, submitted in pending:
+                EMBEDDING_QUEUE_WAIT.observe(started - submitted)
+            try:
+                vectors = self.encode(texts)
+            except Exception as e:
+                for _texts, future, _submitted in pending:
+                    future.set_exception(e)
+                continue
+            start = 0
+            for item_texts, future, _submitted in pending:
+                future.set_result(vectors[start:start + len(item_texts)])
+                start += len(item_texts)
+
+
+class BaseEmbeddingWrapper:
+    """The methods the vector stores call, over `encode` (list of texts -> float32 matrix)"""
+
+    def __init__(self):
+        # Before the libraries running the model start their thread pools
+        thread_budget.configure()
+        self._scheduler = None
+        self._scheduler_pid = None
+        self._scheduler_lock = threading.Lock()
+
+    def encode(self, texts):
+        raise NotImplementedError
+
+    @property
+    def scheduler(self):
+        # Started on first use in the process using it, the thread would not survive a fork
+        # (the gunicorn master loads the model before forking the workers)
+        if self._scheduler_pid != os.getpid():
+            with self._scheduler_lock:
+                if self._scheduler_pid != os.getpid():
+                    options = settings.EMBEDDING_BATCHING
+                    self._scheduler = EmbeddingScheduler(
+                        self.encode, options["MAX_BATCH"], options["MAX_WAIT_MS"] / 1000,
+                        initializer=lambda: thread_budget.enter_lane("query"),
+                    )
+                    self._scheduler_pid = os.getpid()
+        return self._scheduler
+
+    # The vector store expects this method, run on the ingestion threads
+    def embed_documents(self, texts):
+        embeddings = thread_budget.run_in_lane("ingestion", self.encode, texts)
+        return embeddings.tolist()  # Ensure embeddings are a list, not an array
+
+    # Method to embed a single query, batched with the queries of concurrent requests
+    def embed_query(self, query):
+        if settings.EMBEDDING_BATCHING["ENABLED"]:
+            return self.scheduler.embed([query])[0]
+        return self.embed_queries([query])[0]
+
+    # Several queries in one forward pass, on the query threads
+    def embed_queries(self, queries):
+        if thread_budget.current_lane() is None:
+            thread_budget.enter_lane("query")
+        return self.encode(list(queries))
+
+
+# Wrapper class to make SentenceTransformer compatible
+class EmbeddingWrapper(BaseEmbeddingWrapper):
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME):
+        super().__init__()
+        # Imported with the model, torch takes seconds to import and most processes never embed
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts):
+        return self.model.encode(list(texts))
+
+
+def onnx_model_path(model_name=EMBEDDING_MODEL_NAME):
+    """Directory of the ONNX export of a model, written by `manage.py export_onnx_embeddings`"""
+    return os.path.join(settings.EMBEDDING["ONNX_PATH"], model_name.replace("/", "--"))
+
+
+class OnnxEmbeddingWrapper(BaseEmbeddingWrapper):
+    """
+    The same model exported to ONNX and run by onnxruntime, without torch. The transformer
+    runs in the ONNX graph, the tokenization, pooling and normalization of sentence-transformers
+    are done here from the settings saved with the export (ONNX_CONFIG).
+
+    The session starts its thread pool when it is created, which would not survive a fork: it
+    is created in the process running the model, the gunicorn master only checks the files.
+    Every thread budget lane has its own session, sized for it, the ingestion one is only
+    created when something is ingested.
+    """
+
+    def __init__(self, model_name=EMBEDDING_MODEL_NAME, path=None, quantized=None):
+        super().__init__()
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError:
+            raise ImportError("The onnx embedding backend needs onnxruntime and tokenizers: pip install onnxruntime tokenizers")
+
+        path = path or onnx_model_path(model_name)
+        quantized = settings.EMBEDDING["QUANTIZED"] if quantized is None else quantized
+        model_file = os.path.join(path, ONNX_INT8_MODEL if quantized else ONNX_MODEL)
+        if not os.path.exists(model_file):
+            raise FileNotFoundError(
+                f"No ONNX model at {model_file}, export it with `manage.py export_onnx_embeddings {model_name}`"
+            )
+
+        with open(os.path.join(path, ONNX_CONFIG)) as f:
+            self.config = json.load(f)
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, "tokenizer.json"))
+        self.tokenizer.enable_truncation(self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_token_id"], pad_token=self.config["pad_token"])
+
+        self.model_file = model_file
+        self.quantized = quantized
+        # Lane -> session, of the process in _sessions_pid
+        self._sessions = {}
+        self._sessions_pid = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        lane = thread_budget.current_lane() or "query"
+        if self._sessions_pid != os.getpid() or lane not in self._sessions:
+            with self._session_lock:
+                if self._sessions_pid != os.getpid():
+                    self._sessions = {}
+                    self._sessions_pid = os.getpid()
+                if lane not in self._sessions:
+                    self._sessions[lane] = self._create_session(thread_budget.configure()[lane])
+        return self._sessions[lane]
+
+    def _create_session(self, threads):
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        session_options.intra_op_num_threads = threads
+        session_options.inter_op_num_threads = 1
+        # Idle threads would spin waiting for work, taking the cores of the other lane and workers
+        session_options.add_session_config_entry("session.intra_op.allow_spinning", "0")
+        session = onnxruntime.InferenceSession(self.model_file, session_options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in session.get_inputs()}
+        return session
+
+    def encode(self, texts):
+        texts = list(texts)
+        vectors = np.empty((len(texts), self.config["dimension"]), dtype=np.float32)
+        # Longest first like sentence-transformers, texts of similar length share a batch and
+        # little of it is padding
+        order = sorted(range(len(texts)), key=lambda row: -len(texts[row]))
+        for start in range(0, len(order), ONNX_BATCH_SIZE):
+            rows = order[start:start + ONNX_BATCH_SIZE]
+            vectors[rows] = self._encode_batch([texts[row] for row in rows])
+        return vectors
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        feed = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": attention_mask,
+        }
+        session = self.session
+        if "token_type_ids" in self.input_names:
+            feed["token_type_ids"] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+        hidden = session.run(None, feed)[0]
+
+        if self.config["pooling"] == "cls":
+            pooled = hidden[:, 0]
+        else:
+            mask = attention_mask[:, :, None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.config["normalize"]:
+            pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled
+
+
+EMBEDDING_BACKENDS = {
+    "torch": EmbeddingWrapper,
+    "onnx": OnnxEmbeddingWrapper,
+}
+
+
+def get_embedding_function(model_name=EMBEDDING_MODEL_NAME, backend=None):
+    # The model is loaded once per process instead of on every call
+    backend = backend or settings.EMBEDDING["BACKEND"]
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    if (backend, model_name) not in _embedding_functions:
+        # Concurrent first requests would each load their own copy of the model
+        with _embedding_functions_lock:
+            if (backend, model_name) not in _embedding_functions:
+                _embedding_functions[backend, model_name] = EMBEDDING_BACKENDS[backend](model_name)
+    return _embedding_functions[backend, model_name]
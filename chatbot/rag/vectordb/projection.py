@@ -0,0 +1,97 @@
+"""
+Projection of the embeddings to fewer dimensions before they are stored.
+
+An index version may hold a `projection.npz` next to its stores. Every store opened on it
+reduces the vectors of the embedding model with it, the ones added and the queries alike,
+so the index keeps `dimensions` floats per chunk instead of 768:
+
+- "pca": the vectors are projected on the principal axes fitted on a sample of the corpus
+  (`manage.py reduce_vectors`).
+- "matryoshka": the first `dimensions` coordinates are kept, for models trained so that
+  a prefix of the embedding is an embedding (not the case of all-mpnet-base-v2).
+
+The reduced vectors are normalized again, the scores keep their meaning. The projection is
+fitted once per index version: `rebuild_indexes` copies it into the new version, and a new
+one is fitted by building a new version with `reduce_vectors`.
+"""
+import os
+import shutil
+
+import numpy as np
+
+PROJECTION_FILE = "projection.npz"
+METHODS = ("pca", "matryoshka")
+
+
+class Projection:
+    def __init__(self, method, input_dimension, dimensions, components=None):
+        if method not in METHODS:
+            raise ValueError(f"Unknown projection method: {method}")
+        if dimensions >= input_dimension:
+            raise ValueError(f"Cannot reduce {input_dimension} dimensions to {dimensions}")
+        self.method = method
+        self.input_dimension = input_dimension
+        self.dimensions = dimensions
+        # (dimensions, input_dimension), the principal axes as rows
+        self.components = components
+
+    @classmethod
+    def fit(cls, method, vectors, dimensions):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if method == "matryoshka":
+            return cls(method, vectors.shape[1], dimensions)
+        if len(vectors) < dimensions:
+            raise ValueError(f"Fitting {dimensions} components needs at least as many vectors, got {len(vectors)}")
+        # The right singular vectors of the centered sample are the principal axes
+        _u, _s, axes = np.linalg.svd(vectors - vectors.mean(axis=0), full_matrices=False)
+        return cls(method, vectors.shape[1], dimensions, axes[:dimensions].astype(np.float32))
+
+    def apply(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.method == "matryoshka":
+            reduced = vectors[..., :self.dimensions]
+        else:
+            # Not centered: the inner products of the projected vectors stay close to the original
+            # ones, normalizing centered vectors would rank the neighbours differently
+            reduced = vectors @ self.components.T
+        norms = np.linalg.norm(reduced, axis=-1, keepdims=True)
+        return reduced / np.maximum(norms, 1e-12)
+
+    def kept_energy(self, vectors):
+        """Share of the squared norm of `vectors` the projection keeps, for PCA"""
+        if self.method != "pca":
+            return None
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return float(((vectors @ self.components.T) ** 2).sum() / (vectors ** 2).sum())
+
+    def save(self, root):
+        path = os.path.join(root, PROJECTION_FILE)
+        arrays = {"method": np.array(self.method), "input_dimension": np.array(self.input_dimension),
+                  "dimensions": np.array(self.dimensions)}
+        if self.method == "pca":
+            arrays["components"] = self.components
+        # Written next to the target and renamed, like the vector files
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, root):
+        """The projection of the index in `root`, None if its vectors are not reduced"""
+        path = os.path.join(root, PROJECTION_FILE)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as arrays:
+            return cls(
+                str(arrays["method"]), int(arrays["input_dimension"]), int(arrays["dimensions"]),
+                arrays["components"] if "components" in arrays else None,
+            )
+
+
+def copy_projection(source_root, target_root):
+    """Gives the index in `target_root` the projection of the one in `source_root`, if any"""
+    path = os.path.join(source_root, PROJECTION_FILE)
+    if os.path.exists(path):
+        shutil.copy2(path, os.path.join(target_root, PROJECTION_FILE))
+        return True
+    return False
@@ -0,0 +1,338 @@
+"""
+Retrieval service: one process owning the embedding model and the vector index for every web
+worker, started with `manage.py run_retrieval_service`. The workers use the "remote" backend,
+a `RemoteVectorStore` talking to the service over a Unix socket, so they load neither the
+model nor the index, and the service is the only process writing to the index.
+
+Messages are JSON objects prefixed by their length (4 bytes, big-endian). A request names an
+operation and its arguments, `{"op": "query", "embeddings": ..., "k": 5}`, the answer holds
+either `result` or `error`. Vectors travel as base64 float32 buffers. A connection carries
+any number of requests, one at a time, and every client thread keeps its own connection.
+`export` streams the whole index instead: one `{"batch": ...}` message per batch, then
+`{"result": null}`, on a connection of its own.
+
+Texts sent to be embedded by concurrent requests are encoded together, in one pass through
+the model (EmbeddingScheduler). Writes to the index are serialized, searches run concurrently.
+"""
+import base64
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+import types
+
+import numpy as np
+from django.conf import settings
+
+from .. import thread_budget
+from .backends import SearchHit, VectorStore, get_vector_store, storage_backend
+from .embeddings import EmbeddingScheduler, get_embedding_function
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct("!I")
+
+# Texts per embedding request sent by a client, larger inputs are split so that queries
+# from other workers get into the next batch instead of waiting for a whole upload
+CLIENT_EMBEDDING_BATCH = 64
+CLIENT_WRITE_BATCH = 1000
+
+
+class RetrievalServiceError(Exception):
+    """The retrieval service could not be reached or failed to answer"""
+
+
+def pack_array(array):
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    return {"shape": list(array.shape), "data": base64.b64encode(array.tobytes()).decode("ascii")}
+
+
+def unpack_array(value):
+    return np.frombuffer(base64.b64decode(value["data"]), dtype=np.float32).reshape(value["shape"])
+
+
+def send_message(sock, payload):
+    data = json.dumps(payload).encode("utf-8")
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def _receive_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def receive_message(sock):
+    """The next message, None when the other side closed the connection"""
+    header = _receive_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    data = _receive_exactly(sock, HEADER.unpack(header)[0])
+    if data is None:
+        return None
+    return json.loads(data)
+
+
+class RetrievalService:
+    """The operations served, each one a method named after it"""
+
+    WRITE_OPERATIONS = {"add", "update_metadatas", "delete"}
+
+    def __init__(self, backend=None, max_batch=None, max_wait_ms=None):
+        self.backend = storage_backend(backend)
+        if self.backend == "remote":
+            raise ValueError("The retrieval service needs a local backend, set RAG_RETRIEVAL['SERVICE_BACKEND']")
+        # The only process embedding, its budget is the whole machine
+        thread_budget.configure(workers=1)
+        embedding_function = get_embedding_function()
+        self.encode = lambda texts: np.asarray(embedding_function.encode(texts), dtype=np.float32)
+        self.scheduler = EmbeddingScheduler(
+            self.encode,
+            max_batch or settings.RAG_RETRIEVAL["SERVICE_MAX_BATCH"],
+            (settings.EMBEDDING_BATCHING["MAX_WAIT_MS"] if max_wait_ms is None else max_wait_ms) / 1000,
+            initializer=lambda: thread_budget.enter_lane("query"),
+        )
+        self._write_lock = threading.Lock()
+
+    @property
+    def store(self):
+        # Looked up on every call to follow the live index version after a rebuild
+        return get_vector_store(self.backend)
+
+    def handle(self, request):
+        operation = request.pop("op", None)
+        method = getattr(self, f"op_{operation}", None)
+        if method is None:
+            raise ValueError(f"Unknown operation: {operation}")
+        if operation in self.WRITE_OPERATIONS:
+            with self._write_lock:
+                return method(**request)
+        return method(**request)
+
+    def op_ping(self):
+        return {"backend": self.backend, "pid": os.getpid()}
+
+    def op_embed(self, texts, lane="query"):
+        if lane == "ingestion":
+            return pack_array(thread_budget.run_in_lane("ingestion", self.encode, texts))
+        return pack_array(self.scheduler.embed(texts))
+
+    def op_query(self, embeddings, k=4, where=None):
+        results = self.store.query_many(unpack_array(embeddings), k=k, where=where)
+        return [[list(hit) for hit in hits] for hits in results]
+
+    def op_add(self, ids, documents, embeddings, metadatas=None):
+        self.store.add(ids, documents, unpack_array(embeddings), metadatas)
+
+    def op_get_existing_ids(self, ids):
+        return sorted(self.store.get_existing_ids(ids))
+
+    def op_get_metadatas(self, ids):
+        return self.store.get_metadatas(ids)
+
+    def op_update_metadatas(self, ids, metadatas):
+        self.store.update_metadatas(ids, metadatas)
+
+    def op_delete(self, ids=None, where=None):
+        self.store.delete(ids=ids, where=where)
+
+    def op_count(self):
+        return self.store.count()
+
+    def op_export(self, batch_size=1000):
+        # A generator, its batches are sent as they are read
+        for ids, documents, metadatas, embeddings in self.store.export(batch_size=batch_size):
+            yield {"ids": ids, "documents": documents, "metadatas": metadatas, "embeddings": pack_array(embeddings)}
+
+
+class RetrievalRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = receive_message(self.request)
+            except (OSError, ValueError) as e:
+                logger.warning("Dropping a client connection: %s", e)
+                return
+            if request is None:
+                return
+            try:
+                result = self.server.service.handle(request)
+            except Exception as e:
+                logger.exception("Retrieval service operation failed: %s", e)
+                response = {"error": f"{type(e).__name__}: {e}"}
+            else:
+                if isinstance(result, types.GeneratorType):
+                    if not self.send_batches(result):
+                        return
+                    continue
+                response = {"result": result}
+            if not self.send(response):
+                return
+
+    def send(self, response):
+        try:
+            send_message(self.request, response)
+        except OSError:
+            return False
+        return True
+
+    def send_batches(self, batches):
+        """Sends the batches of a streamed operation then its end, False when the client went away"""
+        while True:
+            try:
+                batch = next(batches, None)
+            except Exception as e:
+                logger.exception("Retrieval service operation failed: %s", e)
+                return self.send({"error": f"{type(e).__name__}: {e}"})
+            if batch is None:
+                return self.send({"result": None})
+            if not self.send({"batch": batch}):
+                # Releases what the generator holds, e.g. the lock of a local store
+                batches.close()
+                return False
+
+
+class RetrievalServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # Every thread of every web worker opens a connection, they may all arrive at once
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, socket_path, service):
+        self.service = service
+        # A socket file left by a service that did not stop cleanly would make bind fail
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, RetrievalRequestHandler)
+        # Only the user (and group) running the web workers may connect
+        os.chmod(socket_path, 0o660)
+
+
+class RemoteEmbeddings:
+    """Embedding function of the remote store, same methods as EmbeddingWrapper"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def embed_queries(self, queries, lane="query"):
+        queries = list(queries)
+        vectors = [
+            unpack_array(self.store.call("embed", texts=queries[start:start + CLIENT_EMBEDDING_BATCH], lane=lane))
+            for start in range(0, len(queries), CLIENT_EMBEDDING_BATCH)
+        ]
+        return np.concatenate(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+
+    def embed_query(self, query):
+        return self.embed_queries([query])[0]
+
+    # Embedded on the ingestion threads of the service, away from the queries
+    def embed_documents(self, texts):
+        return self.embed_queries(texts, lane="ingestion").tolist()
+
+
+class RemoteVectorStore(VectorStore):
+    """Client of the retrieval service, the "remote" backend"""
+
+    def __init__(self, socket_path=None, timeout=None):
+        super().__init__(RemoteEmbeddings(self))
+        self.socket_path = socket_path or settings.RAG_RETRIEVAL["SERVICE_SOCKET"]
+        self.timeout = timeout or settings.RAG_RETRIEVAL["SERVICE_TIMEOUT"]
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # Connected in blocking mode, with a timeout a full accept queue fails instead of waiting
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        sock.settimeout(self.timeout)
+        return sock
+
+    def call(self, op, **params):
+        # A connection broken by a restart of the service is opened again once
+        for attempt in range(2):
+            sock = getattr(self._local, "sock", None)
+            try:
+                if sock is None:
+                    sock = self._local.sock = self._connect()
+                send_message(sock, {"op": op, **params})
+                response = receive_message(sock)
+                if response is None:
+                    raise ConnectionError("The retrieval service closed the connection")
+                break
+            except OSError as e:
+                if sock is not None:
+                    sock.close()
+                self._local.sock = None
+                if attempt:
+                    raise RetrievalServiceError(f"Retrieval service at {self.socket_path} unavailable: {e}") from e
+        if "error" in response:
+            raise RetrievalServiceError(response["error"])
+        return response["result"]
+
+    def add(self, ids, documents, embeddings, metadatas=None):
+        ids = list(ids)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        for start in range(0, len(ids), CLIENT_WRITE_BATCH):
+            end = start + CLIENT_WRITE_BATCH
+            self.call(
+                "add",
+                ids=ids[start:end],
+                documents=list(documents[start:end]),
+                embeddings=pack_array(embeddings[start:end]),
+                metadatas=list(metadatas[start:end]) if metadatas else None,
+            )
+
+    def get_existing_ids(self, ids):
+        return set(self.call("get_existing_ids", ids=list(ids)))
+
+    def get_metadatas(self, ids):
+        return self.call("get_metadatas", ids=list(ids))
+
+    def update_metadatas(self, ids, metadatas):
+        self.call("update_metadatas", ids=list(ids), metadatas=list(metadatas))
+
+    def delete(self, ids=None, where=None):
+        self.call("delete", ids=list(ids) if ids is not None else None, where=where)
+
+    def query_many(self, embeddings, k=4, where=None):
+        if not len(embeddings):
+            return []
+        results = self.call("query", embeddings=pack_array(embeddings), k=k, where=where)
+        return [[SearchHit(*hit) for hit in hits] for hits in results]
+
+    def export(self, batch_size=1000):
+        # Read on a connection of its own, the calls of this thread can run between the batches
+        try:
+            sock = self._connect()
+        except OSError as e:
+            raise RetrievalServiceError(f"Retrieval service at {self.socket_path} unavailable: {e}") from e
+        try:
+            send_message(sock, {"op": "export", "batch_size": batch_size})
+            while True:
+                response = receive_message(sock)
+                if response is None:
+                    raise RetrievalServiceError("The retrieval service closed the connection during an export")
+                if "error" in response:
+                    raise RetrievalServiceError(response["error"])
+                if "batch" not in response:
+                    return
+                batch = response["batch"]
+                yield batch["ids"], batch["documents"], batch["metadatas"], unpack_array(batch["embeddings"])
+        except OSError as e:
+            raise RetrievalServiceError(f"Retrieval service at {self.socket_path} failed during an export: {e}") from e
+        finally:
+            # Stopping early leaves batches unread, the connection cannot carry other requests
+            sock.close()
+
+    def count(self):
+        return self.call("count")
@@ -2,10 +2,14 @@ from django.shortcuts import render, redirect
 from ..forms import FileUploadForm
 from ..models import UploadedFile
 from ..models import RagFile 
+from ..models import RagFileGroup
 from ..vectordb import populator, delete_file_from_chroma
-from ..serializers import RagFileSerializer
+from ..ingestion import ingestion_lock
+from ..serializers import RagFileSerializer, RagFileGroupSerializer
 from ..permissions import IsAdmin, IsUser
+from ..tracing import stage
 
+import logging
 import os
 from django.conf import settings
 from django.shortcuts import get_object_or_404
@@ -15,8 +19,9 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework import status
-from matching.elastic_search import setup_elasticsearch, index_pdf_content, delete_file_from_elasticsearch, file_exists_in_elasticsearch
-import pdfplumber
+from matching.elastic_search import setup_elasticsearch, index_pdf_content, delete_file_from_elasticsearch
+
+logger = logging.getLogger(__name__)
 
 @api_view(['DELETE'])
 @permission_classes([IsAuthenticated, IsAdmin])
@@ -25,12 +30,14 @@ def delete_rag_file(request, rag_file_id):
         # Find the RagFile object by its ID
         rag_file = RagFile.objects.get(id=rag_file_id)
         
-        # Delete it from the folder
-        RagFile.delete_rag_file_from_folder(rag_file.file_name)
+        # A rebuild of the indexes does not switch to its new version while the file is removed
+        with stage("ingestion_lock"), ingestion_lock():
+            # Delete it from the folder
+            RagFile.delete_rag_file_from_folder(rag_file.file_name)
 
-        # Delete from vector database and elasticsearch
-        chroma_deleted = delete_file_from_chroma(rag_file.file_name)
-        es_deleted = delete_file_from_elasticsearch(rag_file.file_name)
+            # Delete from vector database and elasticsearch
+            chroma_deleted = delete_file_from_chroma(rag_file.file_name)
+            es_deleted = delete_file_from_elasticsearch(rag_file.file_name)
 
         if not chroma_deleted or not es_deleted:
             return Response(
@@ -64,6 +71,42 @@ def get_rag_files(request):
 
 
 
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def file_groups(request):
+    """
+    GET lists the collections of files queries and searches can be restricted to,
+    POST creates one from a "name" and the IDs of its "files" (admins only).
+    """
+    if request.method == 'GET':
+        serializer = RagFileGroupSerializer(RagFileGroup.objects.prefetch_related('files').select_related('user'), many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
+    if not IsAdmin().has_permission(request, None):
+        return Response({"error": "Only admins can create collections."}, status=status.HTTP_403_FORBIDDEN)
+    serializer = RagFileGroupSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response({"error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+    serializer.save(user=request.user)
+    return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+@api_view(['PUT', 'DELETE'])
+@permission_classes([IsAuthenticated, IsAdmin])
+def file_group(request, group_id):
+    """PUT renames a collection or replaces its files, DELETE removes it (the files are kept)"""
+    group = get_object_or_404(RagFileGroup, id=group_id)
+    if request.method == 'DELETE':
+        group.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    serializer = RagFileGroupSerializer(group, data=request.data, partial=True)
+    if not serializer.is_valid():
+        return Response({"error": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+    serializer.save()
+    return Response(serializer.data, status=status.HTTP_200_OK)
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated, IsAdmin]) 
 def upload_file(request):
@@ -76,25 +119,40 @@ def upload_file(request):
     if not files:
         return Response({"error": "No files provided"}, status=status.HTTP_400_BAD_REQUEST)
 
-    errors = []
-    success_files = []
-    existing_files = []
-    error_files = []
-
     # Ensure Elasticsearch is set up
     if not setup_elasticsearch():
         return Response({
             "error": "Failed to setup Elasticsearch"
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    for file in files:
-        filename = file.name
+    # A rebuild of the indexes does not switch to its new version while files are added
+    with stage("ingestion_lock"), ingestion_lock():
+        return store_uploaded_files(request, files)
+
+
+def store_uploaded_files(request, files):
+    errors = []
+    success_files = []
+    existing_files = []
+    error_files = []
+
+    # Hash all uploads up front so duplicates are found with a single query on RagFile.
+    # By position, the same name may be uploaded twice with different contents
+    uploads = [(file.name, RagFile.compute_hash(file.chunks())) for file in files]
+    known_files = RagFile.find_existing(uploads)
+    # Hashes of the files saved, by name
+    file_hashes = {}
+    seen = set()
+
+    for file, (filename, file_hash) in zip(files, uploads):
         try:
-            # Check if file already exists in Elasticsearch
-            if file_exists_in_elasticsearch(filename):
-                print(f"File {filename} already exists in Elasticsearch, skipping")
+            # Skip files that are already stored (same name or same content), including repeats within this upload
+            if (filename, file_hash) in known_files or filename in seen or file_hash in seen:
+                logger.info("File %s already exists, skipping", filename)
                 existing_files.append(filename)
                 continue
+            seen.update((filename, file_hash))
+            file_hashes[filename] = file_hash
 
             # Save the file to the rag_database directory
             file_path = os.path.join(settings.DATA_PATH, filename)
@@ -105,18 +163,21 @@ def upload_file(request):
             
             # Index the file in Elasticsearch
             try:
-                with pdfplumber.open(file_path) as pdf:
+                # pdfminer is slow to import, it is loaded with the first upload instead of at startup
+                import pdfplumber
+
+                with stage("es_index"), pdfplumber.open(file_path) as pdf:
                     for i, page in enumerate(pdf.pages):
                         page_text = page.extract_text()
                         if page_text:
                             index_pdf_content(filename, i + 1, page_text)
             except Exception as e:
-                print(f"Error indexing {filename}: {e}")
+                logger.exception("Error indexing %s: %s", filename, e)
                 error_files.append(filename)
                 
         except Exception as e:
             error_files.append(filename)
-            print(f"Error processing {filename}: {e}")
+            logger.exception("Error processing %s: %s", filename, e)
 
     # Prepare response message
     if len(success_files) > 0 or len(existing_files) > 0:
@@ -128,10 +189,12 @@ def upload_file(request):
         
         # Run vector database population only if there are new files
         if success_files:
-            is_vectordb_changed = populator()
+            with stage("vector_ingest"):
+                is_vectordb_changed = populator()
             try:
                 # Sync RagFile model
-                RagFile.sync_rag_files(request.user)
+                with stage("db_write"):
+                    RagFile.sync_rag_files(request.user, file_hashes)
             except Exception as e:
                 return Response({
                     "message": "Files uploaded but model sync failed",
@@ -3,17 +3,24 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework import status
 from django.shortcuts import get_object_or_404
+from django.http import StreamingHttpResponse
+from django.conf import settings
+import json
+import logging
 
 from ..models import Query
 from ..models import Conversation
-from ..llm_model import query_llm
+from ..llm_model import query_llm, query_llm_batch
+from ..llm_gateway import LLMError
 from ..serializers import QuerySerializer
 from ..serializers import ConversationSerializer
+from ..serializers import ScopeSerializer
 from ..permissions import IsAdmin, IsUser
+from ..tracing import stage
 
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 
-
+logger = logging.getLogger(__name__)
 
 
 
@@ -22,53 +29,62 @@ from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 def query(request):
     query_text = request.data.get('query')  # Get query text from request
     conversation_id = request.data.get('conversation_id')
-    print(conversation_id)
     # Validate input
     if not query_text.strip():
         return Response({"error": "Your query is empty!"}, status=status.HTTP_400_BAD_REQUEST)
-
-    # If the id is not provided that means we are creating new conversation
-    conversation = None
-    if conversation_id:
-        # Make sure provided id exists among conversations
-        try:
-            conversation = Conversation.objects.get(id=conversation_id)
-        except Conversation.DoesNotExist:
-            return Response({"error": "Invalid conversation ID!"}, status=status.HTTP_404_NOT_FOUND)
-    else:
-        # If no conversation ID is provided, create a new conversation
-        conversation = Conversation.objects.create(
-            created_at=None,  # Will be set later when the first query is added
-            last_modified=None,
-            user=request.user
-        )
-    # Access the queries JSON field
-    queries = conversation.queries.all() 
+    # Optional "files" and "collections" the answer is restricted to
+    scope = ScopeSerializer(data=request.data)
+    if not scope.is_valid():
+        return Response({"error": scope.error_message}, status=status.HTTP_400_BAD_REQUEST)
+
+    with stage("history_load"):
+        # If the id is not provided that means we are creating new conversation
+        conversation = None
+        if conversation_id:
+            # Make sure provided id exists among conversations
+            try:
+                conversation = Conversation.objects.get(id=conversation_id)
+            except Conversation.DoesNotExist:
+                return Response({"error": "Invalid conversation ID!"}, status=status.HTTP_404_NOT_FOUND)
+        else:
+            # If no conversation ID is provided, create a new conversation
+            conversation = Conversation.objects.create(
+                created_at=None,  # Will be set later when the first query is added
+                last_modified=None,
+                user=request.user
+            )
+        # Access the queries JSON field
+        queries = conversation.queries.all() 
     
-    # Initialize chat history
-    chat_history = []
-
-    # Loop through the queries and populate chat history
-    if len(queries) == 0:
-        chat_history.append(SystemMessage(content="No conversation history is available."))
-    for query in queries:
-        human_input = query.query_text
-        ai_response = query.response_text
-
-        # Append HumanMessage and AIMessage to chat_history
-        chat_history.append(HumanMessage(content=human_input))
-        chat_history.append(AIMessage(content=ai_response))
-
-    response = query_llm(query_text, chat_history)
-    # Save the query to the database, associating it with the authenticated user
-    comma_seperated_sources = ",".join(response["sources"])
-    query_instance = Query.objects.create(user=request.user, query_text=query_text, response_text=response["response_text"], sources=comma_seperated_sources)
-
-    # Adding the query to the conversation
-    conversation.queries.add(query_instance)
+        # Initialize chat history
+        chat_history = []
+
+        # Loop through the queries and populate chat history
+        if len(queries) == 0:
+            chat_history.append(SystemMessage(content="No conversation history is available."))
+        for query in queries:
+            human_input = query.query_text
+            ai_response = query.response_text
+
+            # Append HumanMessage and AIMessage to chat_history
+            chat_history.append(HumanMessage(content=human_input))
+            chat_history.append(AIMessage(content=ai_response))
+
+    try:
+        response = query_llm(query_text, chat_history, file_names=scope.validated_data["file_names"])
+    except LLMError as e:
+        logger.warning("No answer from the LLM: %s", e)
+        return Response({"error": "The language model is not available right now, please try again."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    with stage("db_write"):
+        # Save the query to the database, associating it with the authenticated user
+        comma_seperated_sources = ",".join(response["sources"])
+        query_instance = Query.objects.create(user=request.user, query_text=query_text, response_text=response["response_text"], sources=comma_seperated_sources)
+
+        # Adding the query to the conversation
+        conversation.queries.add(query_instance)
     
-    # Updating the fields, "last_modified", and "created_at" depending on the newly added query(for last_modified especially)
-    conversation.update_timestamps()
+        # Updating the fields, "last_modified", and "created_at" depending on the newly added query(for last_modified especially)
+        conversation.update_timestamps()
 
     response["conversation_id"] = conversation.id
     response["query_id"] = query_instance.id
@@ -79,6 +95,47 @@ def query(request):
 
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def query_batch(request):
+    """
+    Answers a list of independent questions, e.g. for evaluation jobs.
+    Results are streamed back as one JSON object per line as soon as each answer is ready.
+    Nothing is saved to the conversations.
+    """
+    query_texts = request.data.get('queries')
+
+    # Validate input
+    if not isinstance(query_texts, list) or not query_texts:
+        return Response({"error": "A non-empty list of queries is required!"}, status=status.HTTP_400_BAD_REQUEST)
+    if not all(isinstance(query_text, str) and query_text.strip() for query_text in query_texts):
+        return Response({"error": "Queries must be non-empty strings!"}, status=status.HTTP_400_BAD_REQUEST)
+    max_queries = settings.RAG_QUERY_BATCH["MAX_QUERIES"]
+    if len(query_texts) > max_queries:
+        return Response({"error": f"At most {max_queries} queries can be sent at once!"}, status=status.HTTP_400_BAD_REQUEST)
+    # Optional "files" and "collections" the answers are restricted to, like /query/
+    scope = ScopeSerializer(data=request.data)
+    if not scope.is_valid():
+        return Response({"error": scope.error_message}, status=status.HTTP_400_BAD_REQUEST)
+
+    # The retrieval runs before the response starts, a failure is still an error status
+    try:
+        answers = query_llm_batch(query_texts, file_names=scope.validated_data["file_names"])
+    except Exception as e:
+        logger.exception("Error retrieving the contexts of a batch: %s", e)
+        return Response({"error": "The documents could not be searched, please try again."}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    def stream():
+        # Closed by the server when the client disconnects, which cancels the answers not started
+        try:
+            for index, result in answers:
+                yield json.dumps({"index": index, **result}) + "\n"
+        finally:
+            answers.close()
+
+    return StreamingHttpResponse(stream(), content_type="application/x-ndjson")
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_queries(request):
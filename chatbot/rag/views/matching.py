@@ -5,7 +5,8 @@ from rest_framework import status
 from django.shortcuts import get_object_or_404
 from matching.search import perform_search
 from ..models import Search, SearchHistory
-from ..serializers import SearchSerializer
+from ..serializers import ScopeSerializer, SearchSerializer
+from ..tracing import stage
 from itertools import groupby
 from operator import itemgetter
 
@@ -24,9 +25,13 @@ def search(request):
             {"error": "Query text is required"}, 
             status=status.HTTP_400_BAD_REQUEST
         )
+    # Optional "files" and "collections" the search is restricted to
+    scope = ScopeSerializer(data=request.data)
+    if not scope.is_valid():
+        return Response({"error": scope.error_message}, status=status.HTTP_400_BAD_REQUEST)
     
     # Perform the search
-    search_response = perform_search(query_text, request)
+    search_response = perform_search(query_text, request, file_names=scope.validated_data["file_names"])
     
     
     # Check for errors
@@ -48,36 +53,38 @@ def search(request):
     if not search_results:
         return Response({'results': []}, status=status.HTTP_200_OK)
 
-    # Sort results by filename and then by score in descending order
-    sorted_results = sorted(search_results, key=lambda x: (x['filename'], -x['score']))
+    with stage("result_grouping"):
+        # Sort results by filename and then by score in descending order
+        sorted_results = sorted(search_results, key=lambda x: (x['filename'], -x['score']))
     
-    # Group results by filename
-    grouped_results = []
-    for filename, group in groupby(sorted_results, key=itemgetter('filename')):
-        group_list = list(group)
-        # Sort the group by score in descending order
-        group_list.sort(key=lambda x: x['score'], reverse=True)
-        grouped_results.append({
-            'filename': filename,
-            'matches': group_list
-        })
-    
-    # Sort groups by the highest score in each group
-    grouped_results.sort(key=lambda x: max(item['score'] for item in x['matches']), reverse=True)
+        # Group results by filename
+        grouped_results = []
+        for filename, group in groupby(sorted_results, key=itemgetter('filename')):
+            group_list = list(group)
+            # Sort the group by score in descending order
+            group_list.sort(key=lambda x: x['score'], reverse=True)
+            grouped_results.append({
+                'filename': filename,
+                'matches': group_list
+            })
     
+        # Sort groups by the highest score in each group
+        grouped_results.sort(key=lambda x: max(item['score'] for item in x['matches']), reverse=True)
+
     response_data = {
         'results': grouped_results
     }
     
-    search_instance = Search.objects.create(
-        user=request.user,
-        search_text=query_text,
-        response_text=response_data
-    )
+    with stage("db_write"):
+        search_instance = Search.objects.create(
+            user=request.user,
+            search_text=query_text,
+            response_text=response_data
+        )
 
-    search_history, created = SearchHistory.objects.get_or_create(user=request.user)
-    search_history.searches.add(search_instance)
-    search_history.update_timestamps()
+        search_history, created = SearchHistory.objects.get_or_create(user=request.user)
+        search_history.searches.add(search_instance)
+        search_history.update_timestamps()
 
     return Response(response_data, status=status.HTTP_200_OK)
 
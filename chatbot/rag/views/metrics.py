@@ -0,0 +1,39 @@
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_GET
+from rest_framework.exceptions import AuthenticationFailed
+
+from ..authentication import TimedJWTAuthentication
+from ..tracing import render_metrics
+
+
+def can_read_metrics(request):
+    """
+    The scraper sends METRICS_TOKEN as a bearer token, people use their admin JWT. The client
+    address is not checked: behind the reverse proxy every request comes from the proxy.
+    """
+    header = request.META.get("HTTP_AUTHORIZATION", "")
+    scheme, _, credentials = header.partition(" ")
+    if scheme.lower() != "bearer" or not credentials:
+        return False
+    if settings.METRICS_TOKEN and hmac.compare_digest(credentials.encode(), settings.METRICS_TOKEN.encode()):
+        return True
+    try:
+        authenticated = TimedJWTAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return authenticated is not None and getattr(authenticated[0], "role", None) == "admin"
+
+
+@require_GET
+def metrics(request):
+    """Latency histograms of this process in the Prometheus text format"""
+    if not request.META.get("HTTP_AUTHORIZATION"):
+        response = HttpResponse(status=401)
+        response["WWW-Authenticate"] = "Bearer"
+        return response
+    if not can_read_metrics(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")